@@ -0,0 +1,118 @@
+"""
+Compares the cache backends: lookup latency in one process and hit ratio
+across worker processes.
+
+Latency is measured on a hit and a miss of a customer-sized entry, through
+the Cache facade as the app uses it. The hit ratio run starts --workers
+processes that each look up the same --keys keys in random order, loading
+and storing every miss: with the per-process memory backend every worker
+misses every key once, while the shared memory and network backends load
+each key once for the whole host. The network backend talks to the local
+stand-in of fake_cache, optionally with --latency-ms added per reply.
+
+Usage:
+    python -m backend.benchmarks.bench_cache [--backends memory,shm,network] [--workers 4]
+        [--keys 2000] [--lookups 20000] [--latency-ms 0]
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+from backend.benchmarks.fake_cache import FakeCache, start
+from backend.utils import cache
+
+ENTRY = {"customer_id": "cus_0123456789", "subscription_id": "sub_0123456789"}
+
+
+def _factory(backend, shm_path, cache_url):
+    if backend == "shm":
+        from backend.utils.shm_cache import SharedMemoryBackend
+
+        return lambda: SharedMemoryBackend(shm_path, slots=16384, slot_size=512)
+    if backend == "network":
+        from backend.utils.network_cache import NetworkBackend
+
+        return lambda: NetworkBackend(cache_url, timeout=1)
+    return cache.MemoryBackend
+
+
+def measure_latency(lookups):
+    store = cache.Cache("bench-latency", maxsize=lookups)
+    store.set("hit", ENTRY)
+    results = {}
+    for name, key in (("hit", "hit"), ("miss", "missing")):
+        samples = []
+        for _ in range(lookups):
+            start = time.perf_counter()
+            store.get(key)
+            samples.append(time.perf_counter() - start)
+        samples.sort()
+        results[name] = (statistics.median(samples), samples[int(len(samples) * 0.99)])
+    return results
+
+
+def _worker(backend, shm_path, cache_url, keys, lookups, seed, ready, results):
+    cache.configure(_factory(backend, shm_path, cache_url))
+    store = cache.Cache("bench-shared", maxsize=keys)
+    rng = random.Random(seed)
+    ready.wait()
+    for _ in range(lookups):
+        key = f"user{rng.randrange(keys)}@example.com"
+        if store.get(key) is None:
+            store.set(key, ENTRY)
+    results.put((cache.cache_requests.value("bench-shared", "hit"), cache.cache_requests.value("bench-shared", "miss")))
+
+
+def measure_hit_ratio(backend, shm_path, cache_url, workers, keys, lookups):
+    context = multiprocessing.get_context("spawn")
+    ready = context.Event()
+    results = context.Queue()
+    processes = [
+        context.Process(target=_worker, args=(backend, shm_path, cache_url, keys, lookups, seed, ready, results))
+        for seed in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    ready.set()
+    counts = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    hits = sum(hit for hit, _ in counts)
+    misses = sum(miss for _, miss in counts)
+    return hits / (hits + misses), misses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", default="memory,shm,network")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--keys", type=int, default=2000)
+    parser.add_argument("--lookups", type=int, default=20000, help="lookups per worker and per latency measure")
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every reply of the network stand-in")
+    args = parser.parse_args()
+
+    server, cache_url = start(FakeCache(args.latency_ms / 1000))
+    shm_path = os.path.join(tempfile.mkdtemp(prefix="bench-cache-"), "cache")
+    print(f"{'backend':<8} {'hit p50 us':>10} {'hit p99 us':>10} {'miss p50 us':>11} {'hit ratio':>10} {'loads':>7}")
+    try:
+        for backend in args.backends.split(","):
+            cache.configure(_factory(backend, shm_path, cache_url))
+            latency = measure_latency(args.lookups)
+            ratio, loads = measure_hit_ratio(backend, shm_path, cache_url, args.workers, args.keys, args.lookups)
+            print(
+                f"{backend:<8} {latency['hit'][0] * 1e6:>10.1f} {latency['hit'][1] * 1e6:>10.1f} "
+                f"{latency['miss'][0] * 1e6:>11.1f} {ratio:>10.1%} {loads:>7}"
+            )
+    finally:
+        server.shutdown()
+        if os.path.exists(shm_path):
+            os.unlink(shm_path)
+        os.rmdir(os.path.dirname(shm_path))
+
+
+if __name__ == "__main__":
+    main()
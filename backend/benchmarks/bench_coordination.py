@@ -0,0 +1,159 @@
+"""
+Checks that webhook workers on many nodes share the queue without
+processing an event twice or losing a write, and measures their throughput.
+
+The script enqueues --events webhook events spread over --customers
+customers in the database of the DB_* settings (the webhook_events table is
+truncated, so use a throwaway database), then starts --workers processes,
+each standing in for a node, that drain the queue until it is empty. Each
+event's handler does a read-modify-write of its customer's counter with
+--work-ms of work in between, as handlers projecting Stripe state do, and
+logs the event. At the end every counter must equal its customer's number of
+events and every event must be logged once.
+
+--mode naive drains with the claim query used before coordination, without
+SKIP LOCKED or customer locks, to show what the checks catch.
+
+Usage:
+    python -m backend.benchmarks.bench_coordination [--workers 1,4,16] [--events 2000]
+        [--customers 50] [--work-ms 2] [--batch-size 100] [--poll-ms 100] [--mode coordinated|naive]
+"""
+import json
+import time
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from sqlalchemy import text
+
+from backend.db import stripe_db, webhooks
+from backend.db.models import Base, WebhookEvent
+
+EVENT_TYPE = "bench.coordination"
+
+
+@webhooks.handler(EVENT_TYPE)
+def count_event(obj, sess):
+    value = sess.execute(
+        text("SELECT n FROM bench_counters WHERE customer = :customer"), {"customer": obj["customer"]}
+    ).scalar()
+    time.sleep(obj["work"])
+    sess.execute(
+        text("UPDATE bench_counters SET n = :n WHERE customer = :customer"),
+        {"n": value + 1, "customer": obj["customer"]},
+    )
+    sess.execute(text("INSERT INTO bench_event_log (seq) VALUES (:seq)"), {"seq": obj["seq"]})
+
+
+def naive_drain(batch_size):
+    # The claim before coordination: every worker reads the same oldest events
+    with stripe_db.session_scope() as sess:
+        events = (
+            sess.query(WebhookEvent)
+            .filter(WebhookEvent.processed_at == None)
+            .order_by(WebhookEvent.received_at)
+            .limit(batch_size)
+            .all()
+        )
+        for row in events:
+            with sess.begin_nested():
+                webhooks.dispatch(json.loads(row.payload), sess)
+            row.processed_at = datetime.utcnow()
+        return len(events)
+
+
+def prepare(engine, events, customers, work):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS bench_counters (customer VARCHAR PRIMARY KEY, n INTEGER)")
+        conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS bench_event_log (seq INTEGER)")
+        conn.exec_driver_sql("TRUNCATE webhook_events, bench_counters, bench_event_log")
+        conn.exec_driver_sql(
+            f"INSERT INTO bench_counters SELECT 'cus_coord' || i, 0 FROM generate_series(0, {customers - 1}) AS i"
+        )
+        conn.execute(
+            text("""
+                INSERT INTO webhook_events (id, type, payload, received_at, attempts, customer_id)
+                SELECT 'evt_coord_' || i, :type,
+                       json_build_object(
+                           'type', :type,
+                           'data', json_build_object('object', json_build_object(
+                               'object', 'bench', 'customer', 'cus_coord' || (i % :customers), 'seq', i,
+                               'work', :work))
+                       )::text,
+                       now() + i * interval '1 microsecond', 0, 'cus_coord' || (i % :customers)
+                FROM generate_series(0, :events - 1) AS i
+            """),
+            {"type": EVENT_TYPE, "customers": customers, "work": work, "events": events},
+        )
+        conn.exec_driver_sql("ANALYZE webhook_events")
+
+
+def _pending(engine):
+    with engine.connect() as conn:
+        return conn.exec_driver_sql("SELECT count(*) FROM webhook_events WHERE processed_at IS NULL").scalar()
+
+
+def _worker(mode, batch_size, poll, ready, go):
+    engine = stripe_db.get_engine()
+    stripe_db.warm_pool()
+    drain = naive_drain if mode == "naive" else webhooks.drain
+    ready.put(True)
+    go.wait()
+    while True:
+        if drain(batch_size) == 0:
+            if not _pending(engine):
+                return
+            # Like webhooks.run_worker, a worker that found nothing claimable waits before polling again
+            time.sleep(poll)
+
+
+def run(workers, mode, batch_size, poll):
+    context = multiprocessing.get_context("spawn")
+    ready = context.Queue()
+    go = context.Event()
+    processes = [context.Process(target=_worker, args=(mode, batch_size, poll, ready, go)) for _ in range(workers)]
+    for process in processes:
+        process.start()
+    # Spawned interpreters take a while to import the app; time only the draining
+    for _ in processes:
+        ready.get()
+    start = time.perf_counter()
+    go.set()
+    for process in processes:
+        process.join()
+    return time.perf_counter() - start
+
+
+def check(engine, events):
+    with engine.connect() as conn:
+        counted = conn.exec_driver_sql("SELECT sum(n) FROM bench_counters").scalar()
+        logged, distinct = conn.exec_driver_sql("SELECT count(*), count(DISTINCT seq) FROM bench_event_log").one()
+    return {"lost_updates": logged - counted, "duplicates": logged - distinct, "missing": events - distinct}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,4,16")
+    parser.add_argument("--events", type=int, default=2000)
+    parser.add_argument("--customers", type=int, default=50)
+    parser.add_argument("--work-ms", type=float, default=2)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--poll-ms", type=float, default=100, help="wait of a worker that claimed nothing")
+    parser.add_argument("--mode", choices=("coordinated", "naive"), default="coordinated")
+    args = parser.parse_args()
+
+    engine = stripe_db.get_engine()
+    Base.metadata.create_all(engine)
+    print(f"{'workers':>7} {'seconds':>8} {'events/s':>9} {'lost':>6} {'dupes':>6} {'missing':>8}")
+    for workers in [int(n) for n in args.workers.split(",")]:
+        prepare(engine, args.events, args.customers, args.work_ms / 1000)
+        elapsed = run(workers, args.mode, args.batch_size, args.poll_ms / 1000)
+        result = check(engine, args.events)
+        print(
+            f"{workers:>7} {elapsed:>8.2f} {args.events / elapsed:>9.0f} {result['lost_updates']:>6} "
+            f"{result['duplicates']:>6} {result['missing']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
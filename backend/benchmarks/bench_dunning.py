@@ -0,0 +1,189 @@
+"""
+Measures the dunning scheduler on a renewal-day spike of failed payments.
+
+The script seeds --subscriptions users with active subscriptions in the
+database of the DB_* settings (the users, subscription and dunning tables
+are truncated, so use a throwaway database) and a matching customer on the
+fake Stripe server, then runs three phases:
+
+- failures: every subscription's invoice.payment_failed goes through
+  stripe_db.handle_payment_failed, in webhook-worker-sized batches.
+- retries: every entry is made due and dunning.run_due retries the
+  payments, with --decline-rate of them declined by the fake.
+- revocations: the grace period of the entries still unpaid ends and
+  run_due revokes their access in batches. For comparison, the same
+  revocations are then made one transaction per entry, as
+  handle_payment_failed did when it revoked access on the spot.
+
+For each phase it reports the time, entries per second, DB statements,
+transactions and Stripe calls.
+
+Usage:
+    python -m backend.benchmarks.bench_dunning [--subscriptions 10000] [--decline-rate 0.3]
+        [--batch-size 500] [--concurrency 8] [--latency-ms 30]
+"""
+import os
+import time
+import argparse
+import threading
+from datetime import datetime
+
+from backend.benchmarks.fake_stripe import FakeStripe, start
+from backend.benchmarks.load import QueryCounter
+
+WEBHOOK_BATCH = 100
+
+
+class CommitCounter:
+    """
+    Counts committed transactions, via engine events.
+    """
+
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "commit", self._on_commit)
+
+    def _on_commit(self, conn):
+        with self._lock:
+            self.count += 1
+
+
+def seed(engine, fake, subscriptions):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("TRUNCATE users, subscription, dunning_schedule CASCADE")
+        conn.exec_driver_sql(f"""
+            INSERT INTO users (id, email, password, first_name, last_name, role, is_subscribed, access)
+            SELECT md5('u' || i)::uuid, 'dunning' || i || '@example.com', 'x', 'Bench', 'User', 2, true, true
+            FROM generate_series(0, {subscriptions - 1}) AS i
+        """)
+        conn.exec_driver_sql(f"""
+            INSERT INTO subscription (id, price_id, user_id, session_id, active, stripe_customer_id,
+                                      is_paused, cancel_at_period_end)
+            SELECT md5('s' || i)::uuid, 'price_bench', md5('u' || i)::uuid, 'cs_dunning_' || i, true,
+                   'cus_dunning' || i, false, false
+            FROM generate_series(0, {subscriptions - 1}) AS i
+        """)
+        conn.exec_driver_sql("ANALYZE")
+    for i in range(subscriptions):
+        fake.add_customer(f"dunning{i}@example.com", "Bench")
+
+
+def schedule_failures(subscriptions):
+    from backend.db import stripe_db
+
+    for first in range(0, subscriptions, WEBHOOK_BATCH):
+        with stripe_db.session_scope() as sess:
+            for i in range(first, min(first + WEBHOOK_BATCH, subscriptions)):
+                stripe_db.handle_payment_failed({"id": f"in_dunning{i}", "customer": f"cus_dunning{i}"}, sess)
+
+
+def make_due(engine, end_grace=False):
+    # Moves the schedule instead of the clock: due now, and past the grace period if end_grace
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if end_grace:
+            conn.exec_driver_sql(
+                "UPDATE dunning_schedule SET grace_ends_at = now() at time zone 'utc' - interval '1 second' "
+                "WHERE due_at IS NOT NULL"
+            )
+        conn.exec_driver_sql(
+            "UPDATE dunning_schedule SET due_at = now() at time zone 'utc' - interval '1 second' "
+            "WHERE due_at IS NOT NULL"
+        )
+
+
+def restore_access(engine):
+    # Undoes the revocations so the per-entry comparison revokes the same entries
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql(
+            "UPDATE subscription SET active = true FROM dunning_schedule d WHERE d.subscription_id = subscription.id"
+        )
+        conn.exec_driver_sql(
+            "UPDATE users SET access = true FROM subscription s, dunning_schedule d "
+            "WHERE d.subscription_id = s.id AND s.user_id = users.id"
+        )
+        conn.exec_driver_sql(
+            "UPDATE dunning_schedule SET revoked_at = NULL, due_at = grace_ends_at WHERE revoked_at IS NOT NULL"
+        )
+
+
+def revoke_one_by_one():
+    from backend.db import coordination, stripe_db
+    from backend.db.models import DunningEntry, Subscription, User
+
+    with stripe_db.session_scope() as sess:
+        entries = sess.query(DunningEntry.subscription_id, DunningEntry.stripe_customer_id).filter(
+            DunningEntry.due_at != None
+        ).all()
+    for subscription_id, customer_id in entries:
+        with stripe_db.session_scope() as sess:
+            coordination.lock_customer(sess, customer_id)
+            subscription = sess.get(Subscription, subscription_id)
+            user = sess.get(User, subscription.user_id)
+            subscription.active = False
+            user.access = False
+            entry = sess.get(DunningEntry, subscription_id)
+            entry.due_at = None
+            entry.revoked_at = datetime.utcnow()
+            stripe_db.forget_account_on_commit(sess, user.email)
+    return len(entries)
+
+
+def measure(name, fn, queries, commits, fake):
+    queries.count = commits.count = 0
+    calls = fake.total_calls()
+    start_time = time.perf_counter()
+    entries = fn()
+    elapsed = time.perf_counter() - start_time
+    print(
+        f"{name:<24} {entries:>8} {elapsed:>8.2f} {entries / elapsed:>10.0f} {queries.count:>8} "
+        f"{commits.count:>7} {fake.total_calls() - calls:>7}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscriptions", type=int, default=10000)
+    parser.add_argument("--decline-rate", type=float, default=0.3)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    args = parser.parse_args()
+
+    fake = FakeStripe(latency=args.latency_ms / 1000, decline_rate=args.decline_rate)
+    server, url = start(fake)
+    # Config reads the environment at import time, so this runs before the app is imported
+    os.environ["STRIPE_API_BASE"] = url
+    os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+    os.environ["STRIPE_MAX_IN_FLIGHT"] = str(max(args.concurrency, 1))
+    from backend.db import dunning, stripe_db
+
+    engine = stripe_db.get_engine()
+    queries = QueryCounter(engine)
+    commits = CommitCounter(engine)
+    try:
+        seed(engine, fake, args.subscriptions)
+        print(f"{'phase':<24} {'entries':>8} {'seconds':>8} {'entries/s':>10} {'queries':>8} {'commits':>7} {'stripe':>7}")
+
+        def failures():
+            schedule_failures(args.subscriptions)
+            return args.subscriptions
+
+        def due():
+            return dunning.run_due(args.batch_size, args.concurrency)["claimed"]
+
+        measure("failures", failures, queries, commits, fake)
+        make_due(engine)
+        measure("retries", due, queries, commits, fake)
+        make_due(engine, end_grace=True)
+        measure("revocations, batched", due, queries, commits, fake)
+        restore_access(engine)
+        measure("revocations, per entry", revoke_one_by_one, queries, commits, fake)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
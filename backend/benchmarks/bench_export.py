@@ -0,0 +1,98 @@
+"""
+Measures throughput and memory of the streaming subscription export.
+
+The script seeds users and subscriptions in the database of the DB_*
+settings (its tables are dropped and recreated, so use a throwaway
+database), then runs the export in each format and page size and reports
+rows per second, output size and how much peak RSS grew. Peak RSS only
+ever rises within a process, so each run happens in a fresh process and
+its growth is measured from the peak reached once the app is imported and
+connected.
+
+Usage:
+    python -m backend.benchmarks.bench_export [--rows 1000000] [--page-sizes 1000,5000,20000] [--skip-seed]
+"""
+import time
+import argparse
+import resource
+import multiprocessing
+
+from backend.db import export, stripe_db
+from backend.db.models import Base
+
+
+def seed(engine, rows):
+    # Every tenth user has no subscription, to exercise the outer join
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql(f"""
+            INSERT INTO users (id, email, password, first_name, last_name, is_subscribed)
+            SELECT md5(i::text)::uuid, 'user' || i || '@example.com', 'x', 'First' || i, 'Last' || i, mod(i, 10) <> 0
+            FROM generate_series(1, {rows}) AS i
+        """)
+        conn.exec_driver_sql(f"""
+            INSERT INTO subscription (id, price_id, user_id, session_id, created_at, updated_at, active, is_paused,
+                                      cancel_at_period_end, last_four_card, auto_renew_date, stripe_customer_id,
+                                      stripe_subscription_id)
+            SELECT md5('s' || i)::uuid, 'price_bench', md5(i::text)::uuid, 'cs_' || i, now(), now(), mod(i, 7) <> 0,
+                   mod(i, 7) = 0, false, '4242', '2030-01-01', 'cus_' || i, 'sub_' || i
+            FROM generate_series(1, {rows}) AS i
+            WHERE mod(i, 10) <> 0
+        """)
+        conn.exec_driver_sql("ANALYZE")
+
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run(fmt, page_size, results):
+    stripe_db.warm_pool()
+    rss_before = _max_rss_mb()
+    start = time.perf_counter()
+    rows = size = 0
+    for chunk in export.export(fmt, page_size):
+        size += len(chunk)
+        rows += chunk.count("\n")
+    elapsed = time.perf_counter() - start
+    if fmt == "csv":
+        rows -= 1
+    results.put((rows, size, elapsed, _max_rss_mb() - rss_before))
+
+
+def run(fmt, page_size):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_run, args=(fmt, page_size, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--page-sizes", default="1000,5000,20000")
+    parser.add_argument("--formats", default="ndjson,csv")
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse the rows from a previous run")
+    args = parser.parse_args()
+
+    if not args.skip_seed:
+        engine = stripe_db.get_engine()
+        Base.metadata.drop_all(engine)
+        Base.metadata.create_all(engine)
+        print(f"Seeding {args.rows} users and subscriptions...")
+        seed(engine, args.rows)
+
+    print(f"{'format':<8} {'page':>7} {'rows':>9} {'MB':>8} {'seconds':>8} {'rows/s':>9} {'RSS +MB':>8}")
+    for fmt in args.formats.split(","):
+        for page_size in [int(size) for size in args.page_sizes.split(",")]:
+            rows, size, elapsed, rss_growth = run(fmt, page_size)
+            print(
+                f"{fmt:<8} {page_size:>7} {rows:>9} {size / 1e6:>8.1f} {elapsed:>8.2f} "
+                f"{rows / elapsed:>9.0f} {rss_growth:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
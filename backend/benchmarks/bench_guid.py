@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of GUID conversion on bulk inserts and loads, comparing the
+previous process_bind_param/process_result_value implementation with the
+CHAR(32) and BINARY(16) variants of the current GUID type.
+
+Runs against an in-memory SQLite database, so it needs no setup.
+
+Usage:
+    python -m backend.benchmarks.bench_guid [--rows 100000]
+"""
+import time
+import uuid
+import argparse
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, insert, select
+from sqlalchemy.types import TypeDecorator, CHAR
+
+from backend.utils.mysql_uuid import GUID
+
+
+class LegacyGUID(TypeDecorator):
+    # The per-value implementation GUID used before bind/result processors
+    impl = CHAR
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        return dialect.type_descriptor(CHAR(32))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+        if not isinstance(value, uuid.UUID):
+            # The original "%.32x" % uuid.UUID(value) raises TypeError on Python 3.10+
+            return "%.32x" % int(uuid.UUID(value))
+        return value.hex
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return value
+        return uuid.UUID(value)
+
+
+def run(type_, rows):
+    engine = create_engine("sqlite://")
+    metadata = MetaData()
+    table = Table(
+        "guids", metadata,
+        Column("pk", Integer, primary_key=True),
+        Column("id", type_),
+        Column("ref", type_),
+    )
+    metadata.create_all(engine)
+    values = [{"id": uuid.uuid4(), "ref": str(uuid.uuid4())} for _ in range(rows)]
+    with engine.begin() as conn:
+        start = time.perf_counter()
+        conn.execute(insert(table), values)
+        inserted = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded = conn.execute(select(table.c.id, table.c.ref)).fetchall()
+        fetched = time.perf_counter() - start
+    assert len(loaded) == rows
+    return inserted, fetched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    args = parser.parse_args()
+
+    print(f"{'type':20} {'insert ms':>10} {'load ms':>10}")
+    for name, type_ in (
+        ("legacy CHAR(32)", LegacyGUID()),
+        ("GUID CHAR(32)", GUID()),
+        ("GUID BINARY(16)", GUID(binary=True)),
+    ):
+        inserted, fetched = run(type_, args.rows)
+        print(f"{name:20} {inserted * 1000:>10.1f} {fetched * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Measures latency of the hot lookups on users, rejected_tokens and
+subscription with and without the indexes declared in models.py.
+
+The script creates and seeds tables in the given database, so point it at a
+throwaway Postgres instance.
+
+Usage:
+    python -m backend.benchmarks.bench_indexes --database-uri postgresql://... [--rows 1000000]
+"""
+import time
+import random
+import hashlib
+import argparse
+import statistics
+
+from sqlalchemy import create_engine
+
+from backend.db.models import Base
+
+INDEXES = {
+    "ix_rejected_tokens_token_digest": "rejected_tokens (token_digest)",
+    "ix_rejected_tokens_created_at": "rejected_tokens (created_at)",
+    "ix_rejected_tokens_expires_at": "rejected_tokens (expires_at)",
+    "ix_subscription_user_id_active": "subscription (user_id, active)",
+    "ix_subscription_stripe_customer_id": "subscription (stripe_customer_id)",
+}
+
+
+def _token(i):
+    return hashlib.md5(str(i).encode()).hexdigest() * 12
+
+
+def _user_id(i):
+    return hashlib.md5(str(i).encode()).hexdigest()
+
+
+QUERIES = {
+    "rejected token by token": (
+        "SELECT 1 FROM rejected_tokens WHERE token = %(token)s LIMIT 1",
+        lambda i: {"token": _token(i)},
+    ),
+    "rejected token by digest": (
+        "SELECT 1 FROM rejected_tokens WHERE token_digest = %(digest)s LIMIT 1",
+        lambda i: {"digest": hashlib.sha256(_token(i).encode()).hexdigest()},
+    ),
+    "subscription by user_id": (
+        "SELECT id FROM subscription WHERE user_id = %(user_id)s",
+        lambda i: {"user_id": _user_id(i)},
+    ),
+    "subscription by user_id and active": (
+        "SELECT id FROM subscription WHERE user_id = %(user_id)s AND active",
+        lambda i: {"user_id": _user_id(i)},
+    ),
+    "subscription by stripe_customer_id": (
+        "SELECT id FROM subscription WHERE stripe_customer_id = %(customer)s",
+        lambda i: {"customer": f"cus_{i}"},
+    ),
+}
+
+
+def seed(conn, rows):
+    conn.exec_driver_sql(f"""
+        INSERT INTO users (id, email, password, is_subscribed)
+        SELECT md5(i::text)::uuid, 'user' || i || '@example.com', 'x', true
+        FROM generate_series(1, {rows}) AS i
+    """)
+    conn.exec_driver_sql(f"""
+        INSERT INTO subscription (id, price_id, user_id, session_id, active, stripe_customer_id)
+        SELECT md5('s' || i)::uuid, 'price_bench', md5(i::text)::uuid, 'cs_' || i, mod(i, 10) <> 0, 'cus_' || i
+        FROM generate_series(1, {rows}) AS i
+    """)
+    conn.exec_driver_sql(f"""
+        INSERT INTO rejected_tokens (id, created_at, token, token_digest, expires_at)
+        SELECT md5('t' || i)::uuid, t.created_at, t.token,
+               encode(sha256(convert_to(t.token, 'UTF8')), 'hex'), t.created_at + interval '1 day'
+        FROM generate_series(1, {rows}) AS i,
+             LATERAL (SELECT repeat(md5(i::text), 12) AS token,
+                             now() - (i || ' seconds')::interval AS created_at) AS t
+    """)
+    conn.exec_driver_sql("ANALYZE")
+
+
+def measure(conn, rows, samples):
+    results = {}
+    for name, (sql, params) in QUERIES.items():
+        timings = []
+        for _ in range(samples):
+            bound = params(random.randint(1, rows))
+            start = time.perf_counter()
+            conn.exec_driver_sql(sql, bound).fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        timings.sort()
+        results[name] = (statistics.median(timings), timings[int(len(timings) * 0.95) - 1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-uri", required=True)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--samples", type=int, default=200)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_uri)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        print(f"Seeding {args.rows} users, subscriptions and rejected tokens...")
+        seed(conn, args.rows)
+
+        for index in INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index}")
+        before = measure(conn, args.rows, args.samples)
+
+        for index, target in INDEXES.items():
+            conn.exec_driver_sql(f"CREATE INDEX {index} ON {target}")
+        conn.exec_driver_sql("ANALYZE")
+        after = measure(conn, args.rows, args.samples)
+
+    print(f"{'query':40} {'before p50/p95 ms':>20} {'after p50/p95 ms':>20}")
+    for name in QUERIES:
+        print(
+            f"{name:40} {before[name][0]:>9.3f}/{before[name][1]:<10.3f} "
+            f"{after[name][0]:>9.3f}/{after[name][1]:<10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+Measures the batched purge of expired rejected tokens on a synthetic table,
+and the revocation-cache sync query before and after the purge.
+
+The DB_* settings are read from the environment like the app does, and the
+rejected_tokens table is truncated and reseeded, so point them at a
+throwaway Postgres database.
+
+Usage:
+    python -m backend.benchmarks.bench_purge [--rows 5000000] [--expired-ratio 0.9]
+"""
+import time
+import argparse
+
+from backend.db import stripe_db
+from backend.db.models import Base
+
+
+def seed(conn, rows, expired_ratio):
+    # Token ages are spread evenly so that expired_ratio of them are older than the 1 day lifetime
+    span_days = 1 / (1 - expired_ratio)
+    conn.exec_driver_sql("TRUNCATE rejected_tokens")
+    conn.exec_driver_sql(f"""
+        INSERT INTO rejected_tokens (id, created_at, token, token_digest, expires_at)
+        SELECT md5('t' || i)::uuid, t.created_at, repeat(md5(i::text), 12),
+               md5(i::text) || md5(i::text), t.created_at + interval '1 day'
+        FROM generate_series(1, {rows}) AS i,
+             LATERAL (SELECT now() - i * interval '1 day' * {span_days} / {rows} AS created_at) AS t
+    """)
+    conn.exec_driver_sql("ANALYZE rejected_tokens")
+
+
+def time_sync_query(samples=5):
+    start = time.perf_counter()
+    for _ in range(samples):
+        stripe_db._revocations_synced_at = None
+        stripe_db.warm_revocation_cache()
+    return (time.perf_counter() - start) * 1000 / samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5_000_000)
+    parser.add_argument("--expired-ratio", type=float, default=0.9)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    engine = stripe_db.get_engine()
+    Base.metadata.create_all(engine)
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        print(f"Seeding {args.rows} rejected tokens...")
+        seed(conn, args.rows, args.expired_ratio)
+        before_rows = conn.exec_driver_sql("SELECT count(*) FROM rejected_tokens").scalar()
+
+    warm_before = time_sync_query()
+    start = time.perf_counter()
+    purged = stripe_db.purge_expired_rejected_tokens(args.batch_size)
+    elapsed = time.perf_counter() - start
+    warm_after = time_sync_query()
+
+    print(f"rows before purge:      {before_rows}")
+    print(f"rows purged:            {purged} in {elapsed:.1f}s ({purged / elapsed:.0f} rows/s)")
+    print(f"cache warm before/after: {warm_before:.1f} ms / {warm_after:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
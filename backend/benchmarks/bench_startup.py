@@ -0,0 +1,171 @@
+"""
+Measures cold start: how long importing the app takes and how long a fresh
+worker process needs to answer its first requests.
+
+Every run starts a new interpreter, so nothing is cached between runs. The
+import time is measured inside a child process that only imports
+backend.main. Time to first request is measured from spawning uvicorn to
+the first 200 from GET / (the worker is accepting traffic) and to the first
+completed checkout (the first request needing the database, JWT and
+Stripe). Workers use the fake Stripe server and the database in the DB_*
+settings, whose users are truncated and reseeded as in the load benchmark.
+
+The modes set WARM_UP and WARM_UP_BLOCKING for the workers: "off" runs no
+warm-up hooks, "background" runs them after startup and "blocking" before
+the worker accepts traffic. Pass --root to measure another checkout of the
+repository, e.g. a worktree of an older commit, and --save-baseline and
+--compare to put two runs side by side.
+
+Usage:
+    python -m backend.benchmarks.bench_startup [--runs 5] [--modes off,background,blocking]
+        [--root DIR] [--save-baseline FILE] [--compare FILE]
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import subprocess
+import http.client
+from pathlib import Path
+
+from backend.benchmarks.fake_stripe import FakeStripe, start
+from backend.benchmarks.load import PRODUCT_NAME, configure_environment, mint_token, seed
+
+ROOT = Path(__file__).resolve().parents[2]
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import backend.main; print(time.perf_counter() - t)"
+MODES = {
+    "off": {"WARM_UP": "", "WARM_UP_BLOCKING": "false"},
+    "background": {"WARM_UP_BLOCKING": "false"},
+    "blocking": {"WARM_UP_BLOCKING": "true"},
+}
+
+
+def measure_import(root):
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET], cwd=root, check=True, capture_output=True, text=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _request(port, method, path, headers=None, timeout=30):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    try:
+        conn.request(method, path, headers=headers or {})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+def measure_first_requests(root, env, token, timeout=60):
+    """
+    Starts a worker and times its first requests.
+
+    Returns:
+      A dict of seconds from spawning the worker to its first answer to GET /
+      ("ready") and to its first completed checkout ("first_checkout"), and
+      the checkout's own latency in seconds ("checkout_latency").
+    """
+    port = _free_port()
+    started = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=root,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while True:
+            try:
+                if _request(port, "GET", "/", timeout=5) == 200:
+                    break
+            except OSError:
+                pass
+            if worker.poll() is not None or time.perf_counter() - started > timeout:
+                raise RuntimeError("The worker did not start")
+            time.sleep(0.005)
+        ready = time.perf_counter() - started
+
+        status = _request(port, "POST", "/create-checkout-session", {"Authorization": f"Bearer {token}"})
+        if status != 200:
+            raise RuntimeError(f"The first checkout answered {status}")
+        first_checkout = time.perf_counter() - started
+        return {"ready": ready, "first_checkout": first_checkout, "checkout_latency": first_checkout - ready}
+    finally:
+        worker.terminate()
+        worker.wait()
+
+
+def print_results(results, baseline=None):
+    print(f"{'measure':32} {'median ms':>10} {'min ms':>8}" + (f" {'baseline':>10} {'change':>8}" if baseline else ""))
+    for name, values in results.items():
+        line = f"{name:32} {statistics.median(values) * 1000:>10.0f} {min(values) * 1000:>8.0f}"
+        if baseline and name in baseline:
+            before = statistics.median(baseline[name])
+            after = statistics.median(values)
+            line += f" {before * 1000:>10.0f} {(after - before) / before:>+8.0%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--modes", default="off,background,blocking")
+    parser.add_argument("--root", default=str(ROOT), help="the repository checkout to measure")
+    parser.add_argument("--latency-ms", type=float, default=30, help="simulated Stripe round-trip")
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--compare", metavar="FILE")
+    args = parser.parse_args()
+
+    fake = FakeStripe(PRODUCT_NAME, args.latency_ms / 1000)
+    stripe_server, stripe_url = start(fake)
+    configure_environment(stripe_url)
+
+    from sqlalchemy import create_engine
+
+    from backend.config import Config
+    from backend.db import stripe_db
+    from backend.db.models import Base
+
+    engine = create_engine(stripe_db.DATABASE_URI)
+    Base.metadata.create_all(engine)
+    email = seed(engine, fake, 1)[0]
+    token = mint_token(Config().JWT_SECRET, email)
+    engine.dispose()
+
+    results = {"import backend.main": []}
+    try:
+        for _ in range(args.runs):
+            results["import backend.main"].append(measure_import(args.root))
+        for mode in args.modes.split(","):
+            env = dict(os.environ, **MODES[mode])
+            for _ in range(args.runs):
+                for name, seconds in measure_first_requests(args.root, env, token).items():
+                    results.setdefault(f"{mode}: {name}", []).append(seconds)
+    finally:
+        stripe_server.shutdown()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+
+if __name__ == "__main__":
+    main()
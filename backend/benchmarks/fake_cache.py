@@ -0,0 +1,151 @@
+"""
+A local stand-in for a Redis-compatible cache server, used to run the
+network cache backend without one.
+
+It speaks enough of RESP for NetworkBackend (PING, SELECT, GET, SET with
+PX, DEL and SCAN with MATCH), keeps everything in one dict, and can add a
+fixed latency to every reply to model the network round-trip. Point the app
+at it with CACHE_BACKEND=network and CACHE_URL=redis://127.0.0.1:<port>/0.
+
+Usage:
+    python -m backend.benchmarks.fake_cache [--port 16379] [--latency-ms 0]
+"""
+import time
+import fnmatch
+import argparse
+import threading
+from collections import Counter
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+
+
+class FakeCache:
+    """
+    The in-memory state behind the fake server.
+    """
+
+    def __init__(self, latency=0.0):
+        """
+        Initializes the fake.
+
+        Args:
+          latency (float): Seconds added to every reply.
+        """
+        self.latency = latency
+        self.calls = Counter()
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def handle(self, args):
+        # Returns the reply: bytes for bulk strings, int, list, None, or an Exception for an error
+        name = args[0].upper().decode()
+        self.calls[name] += 1
+        with self._lock:
+            if name == "PING":
+                return "PONG"
+            if name == "SELECT":
+                return "OK"
+            if name == "GET":
+                entry = self._live(args[1])
+                return None if entry is None else entry[0]
+            if name == "SET":
+                expires_at = None
+                options = [arg.upper() for arg in args[3:]]
+                if b"PX" in options:
+                    expires_at = time.monotonic() + int(args[3 + options.index(b"PX") + 1]) / 1000
+                self._data[args[1]] = (args[2], expires_at)
+                return "OK"
+            if name == "DEL":
+                return sum(self._data.pop(key, None) is not None for key in args[1:])
+            if name == "SCAN":
+                # Lists everything in one pass, which a client must accept from a real server too
+                options = [arg.upper() for arg in args[2:]]
+                pattern = args[2 + options.index(b"MATCH") + 1].decode() if b"MATCH" in options else "*"
+                keys = [key for key in list(self._data) if self._live(key) and fnmatch.fnmatchcase(key.decode(), pattern)]
+                return [b"0", keys]
+        return Exception(f"ERR unknown command '{name}'")
+
+
+def _encode(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, Exception):
+        return b"-%s\r\n" % str(reply).encode()
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode()
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(_encode(item) for item in reply)
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+def _handler_for(fake):
+    class Handler(StreamRequestHandler):
+        def _read_command(self):
+            line = self.rfile.readline()
+            if not line.startswith(b"*"):
+                return None
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(self.rfile.readline()[1:])
+                args.append(self.rfile.read(length + 2)[:-2])
+            return args
+
+        def handle(self):
+            while True:
+                args = self._read_command()
+                if not args:
+                    return
+                reply = fake.handle(args)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                self.wfile.write(_encode(reply))
+                self.wfile.flush()
+
+    return Handler
+
+
+class _Server(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+def start(fake, port=0):
+    """
+    Serves the fake on a background thread.
+
+    Args:
+      fake (FakeCache): The state to serve.
+      port (int): The port to listen on; 0 picks a free one.
+
+    Returns:
+      The running server and its redis:// URL.
+    """
+    server = _Server(("127.0.0.1", port), _handler_for(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"redis://127.0.0.1:{server.server_address[1]}/0"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=16379)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    server, url = start(FakeCache(args.latency_ms / 1000), args.port)
+    print(f"Fake cache listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""
+A local stand-in for the Stripe API used by the load benchmarks.
+
+It serves the endpoints the app calls with plausible objects, adds a fixed
+latency to every response to model the network round-trip, and counts the
+requests it receives so a benchmark can report Stripe calls per request.
+Point both the SDK and the async client at it by setting
+``STRIPE_API_BASE`` to its URL before the app is imported.
+
+Usage:
+    python -m backend.benchmarks.fake_stripe [--port 12111] [--latency-ms 30]
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import parse_qsl, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PRODUCT_ID = "prod_bench"
+PRICE_ID = "price_bench"
+PERIOD_SECONDS = 30 * 86400
+
+
+def customer_id(email):
+    return "cus_" + email.split("@")[0]
+
+
+class FakeStripe:
+    """
+    The in-memory state behind the fake API.
+
+    Customers are registered up front with add_customer, or created through
+    POST /v1/customers; each has one active subscription and one card.
+    """
+
+    def __init__(self, product_name="bench", latency=0.03, addons=20, decline_rate=0.0):
+        """
+        Initializes the fake.
+
+        Args:
+          product_name (str): The name of the subscription product.
+          latency (float): Seconds added to every response.
+          addons (int): How many one-time add-on products to list alongside
+            it, for multi-item carts.
+          decline_rate (float): The share of invoice payments declined.
+        """
+        self.product_name = product_name
+        self.latency = latency
+        self.addons = addons
+        self.decline_rate = decline_rate
+        self.calls = Counter()
+        self._customers = {}
+        self._sessions = 0
+        self.checkout_sessions = {}
+        self._lock = threading.Lock()
+
+    def add_customer(self, email, name=None):
+        cid = customer_id(email)
+        self._customers[cid] = {"id": cid, "object": "customer", "email": email, "name": name}
+        return cid
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _count(self, route):
+        with self._lock:
+            self.calls[route] += 1
+
+    def payment_method(self, cid):
+        return {
+            "id": "pm_" + cid[4:],
+            "object": "payment_method",
+            "customer": cid,
+            "type": "card",
+            "card": {"brand": "visa", "last4": "4242", "exp_month": 12, "exp_year": 2030},
+        }
+
+    def subscription(self, cid, expand_payment_method=False):
+        payment_method = self.payment_method(cid)
+        return {
+            "id": "sub_" + cid[4:],
+            "object": "subscription",
+            "customer": cid,
+            "status": "active",
+            "current_period_end": int(time.time()) + PERIOD_SECONDS,
+            "cancel_at_period_end": False,
+            "pause_collection": None,
+            "default_payment_method": payment_method if expand_payment_method else payment_method["id"],
+            "items": {"object": "list", "data": [{"price": self.price()}], "has_more": False},
+        }
+
+    def price(self):
+        return {
+            "id": PRICE_ID,
+            "object": "price",
+            "product": PRODUCT_ID,
+            "currency": "usd",
+            "unit_amount": 1000,
+            "recurring": {"interval": "month"},
+        }
+
+    def product(self, expand_price=False):
+        product = {"id": PRODUCT_ID, "object": "product", "name": self.product_name, "active": True}
+        product["default_price"] = self.price() if expand_price else PRICE_ID
+        return product
+
+    def prices(self):
+        # Every active price with its product expanded: the subscription and the add-ons
+        price = dict(self.price(), product=self.product())
+        prices = [price]
+        for k in range(self.addons):
+            prices.append({
+                "id": f"{PRICE_ID}_addon_{k}",
+                "object": "price",
+                "currency": "usd",
+                "unit_amount": 500,
+                "recurring": None,
+                "product": {
+                    "id": f"{PRODUCT_ID}_addon_{k}",
+                    "object": "product",
+                    "name": f"{self.product_name} add-on {k}",
+                    "active": True,
+                    "default_price": f"{PRICE_ID}_addon_{k}",
+                },
+            })
+        return prices
+
+    def customer(self, cid, expand=()):
+        customer = dict(self._customers[cid])
+        customer["invoice_settings"] = {"default_payment_method": "pm_" + cid[4:]}
+        subscription = self.subscription(cid, "subscriptions.data.default_payment_method" in expand)
+        customer["subscriptions"] = _list([subscription])
+        return customer
+
+    def handle(self, method, path, params):
+        """
+        Answers one API request.
+
+        Returns:
+          A (status, body) tuple.
+        """
+        parts = path.strip("/").split("/")[1:]
+        route = f"{method} /v1/{parts[0]}" + ("/:id" if len(parts) > 1 else "")
+        self._count(route)
+        time.sleep(self.latency)
+
+        expand = [value for key, value in params if key.startswith("expand")]
+        params = dict(params)
+        resource = parts[0] if parts else ""
+
+        if resource == "customers" and len(parts) == 1:
+            if method == "POST":
+                cid = self.add_customer(params["email"], params.get("name"))
+                return 200, self.customer(cid)
+            cid = customer_id(params.get("email", ""))
+            return 200, _list([self.customer(cid)] if cid in self._customers else [])
+        if resource == "customers":
+            cid = parts[1]
+            if cid not in self._customers:
+                return _not_found("customer", cid)
+            return 200, self.customer(cid, expand)
+        if resource == "products":
+            return 200, _list([self.product("data.default_price" in expand)])
+        if resource == "prices":
+            return 200, self.price() if len(parts) > 1 else _list(self.prices())
+        if resource == "subscriptions" and len(parts) == 1:
+            cid = params.get("customer")
+            return 200, _list([self.subscription(cid)] if cid in self._customers else [])
+        if resource == "subscriptions":
+            cid = "cus_" + parts[1][4:]
+            if cid not in self._customers:
+                return _not_found("subscription", parts[1])
+            subscription = self.subscription(cid, "default_payment_method" in expand)
+            if method == "DELETE":
+                subscription["status"] = "canceled"
+            if method == "POST" and params.get("pause_collection[behavior]"):
+                subscription["pause_collection"] = {"behavior": params["pause_collection[behavior]"], "resumes_at": None}
+            return 200, subscription
+        if resource == "payment_methods" and len(parts) == 1:
+            cid = params.get("customer")
+            return 200, _list([self.payment_method(cid)] if cid in self._customers else [])
+        if resource == "payment_methods":
+            return 200, self.payment_method("cus_" + parts[1][3:])
+        if resource == "invoices" and method == "POST" and parts[-1] == "pay":
+            if random.random() < self.decline_rate:
+                return 402, {"error": {"type": "card_error", "code": "card_declined", "message": "Your card was declined."}}
+            return 200, {"id": parts[1], "object": "invoice", "status": "paid", "paid": True}
+        if resource == "checkout" and method == "POST":
+            with self._lock:
+                self._sessions += 1
+                session_id = f"cs_bench_{self._sessions}"
+                session = self.checkout_sessions[session_id] = {
+                    "id": session_id,
+                    "object": "checkout.session",
+                    "url": f"https://checkout.stripe.test/{session_id}",
+                    "expires_at": int(time.time()) + 86400,
+                    "status": "open",
+                    "customer_email": params.get("customer_email"),
+                    "mode": params.get("mode"),
+                }
+            return 200, session
+        if resource == "checkout" and len(parts) > 2:
+            session = self.checkout_sessions.get(parts[2])
+            return (200, session) if session else _not_found("checkout session", parts[2])
+        return _not_found("route", path)
+
+
+def _list(data):
+    return {"object": "list", "data": data, "has_more": False, "url": ""}
+
+
+def _not_found(kind, value):
+    return 404, {"error": {"type": "invalid_request_error", "message": f"No such {kind}: '{value}'"}}
+
+
+def _handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _respond(self):
+            url = urlsplit(self.path)
+            params = parse_qsl(url.query)
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                params += parse_qsl(self.rfile.read(length).decode())
+            status, body = fake.handle(self.command, url.path, params)
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.send_header("Request-Id", "req_bench")
+            self.end_headers()
+            self.wfile.write(payload)
+
+        do_GET = do_POST = do_DELETE = _respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start(fake, port=0):
+    """
+    Serves the fake on a background thread.
+
+    Args:
+      fake (FakeStripe): The state to serve.
+      port (int): The port to listen on; 0 picks a free one.
+
+    Returns:
+      The running server and its base URL.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), _handler_for(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--product", default="bench")
+    args = parser.parse_args()
+
+    fake = FakeStripe(args.product, args.latency_ms / 1000)
+    server, url = start(fake, args.port)
+    print(f"Fake Stripe listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
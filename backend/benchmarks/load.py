@@ -0,0 +1,395 @@
+"""
+End-to-end load benchmark of the API endpoints.
+
+Starts the app with uvicorn in this process, pointed at the fake Stripe
+server in fake_stripe and at the Postgres database given by the DB_*
+settings, seeds users with subscriptions, then drives each endpoint at
+increasing concurrency. For every endpoint and concurrency level it reports
+p50/p95/p99 latency, throughput, the number of DB queries and Stripe calls
+per request, and the response status codes.
+
+The users, subscription, rejected_tokens and webhook_events tables are
+truncated and reseeded, so point the DB_* settings at a throwaway database.
+
+Results can be saved as a baseline and later runs compared against it; the
+comparison exits non-zero when a run regresses beyond the tolerance.
+
+Usage:
+    python -m backend.benchmarks.load [--levels 1,8,32] [--requests 300] [--latency-ms 30]
+        [--cart-size 10] [--endpoints checkout,payment-details] [--save-baseline FILE] [--compare FILE]
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import argparse
+import platform
+import threading
+from collections import Counter
+from datetime import datetime
+
+from backend.benchmarks.fake_stripe import PRICE_ID, FakeStripe, customer_id, start
+
+PRODUCT_NAME = "bench"
+
+
+def percentile(sorted_values, pct):
+    index = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class QueryCounter:
+    """
+    Counts statements the app sends to the database, via engine events.
+    """
+
+    def __init__(self, *engines):
+        from sqlalchemy import event
+
+        self.count = 0
+        self._lock = threading.Lock()
+        for engine in set(engines):
+            event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        with self._lock:
+            self.count += 1
+
+
+def configure_environment(stripe_url):
+    # Config reads the environment at import time, so this runs before the app is imported
+    os.environ["STRIPE_API_BASE"] = stripe_url
+    os.environ["STRIPE_PRODUCT"] = PRODUCT_NAME
+    os.environ.setdefault("STRIPE_SECRET_KEY", "sk_test_bench")
+    os.environ.setdefault("STRIPE_WEBHOOK_SECRET", "whsec_bench")
+    os.environ.setdefault("JWT_SECRET", "bench-secret")
+    os.environ.setdefault("FE_BASE_URL", "http://localhost:3000")
+    # Keep the periodic jobs quiet so they do not add queries to the measured runs
+    os.environ.setdefault("WEBHOOK_POLL_SECONDS", "3600")
+    os.environ.setdefault("RECONCILE_INTERVAL_SECONDS", "86400")
+    os.environ.setdefault("REVOCATION_PURGE_SECONDS", "86400")
+    os.environ.setdefault("DUNNING_INTERVAL_SECONDS", "86400")
+
+
+def seed(engine, fake, users):
+    """
+    Recreates the benchmark users, each with an active subscription and a
+    matching customer on the fake Stripe server.
+
+    Returns:
+      The seeded emails, in order.
+    """
+    emails = [f"bench{i}@example.com" for i in range(users)]
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql("TRUNCATE users, subscription, rejected_tokens, webhook_events CASCADE")
+        conn.exec_driver_sql(f"""
+            INSERT INTO users (id, email, password, first_name, last_name, role, is_subscribed)
+            SELECT md5('u' || i)::uuid, 'bench' || i || '@example.com', 'x', 'Bench', 'User', 2, true
+            FROM generate_series(0, {users - 1}) AS i
+        """)
+        conn.exec_driver_sql(f"""
+            INSERT INTO subscription (id, price_id, user_id, session_id, active, stripe_customer_id,
+                                      is_paused, cancel_at_period_end)
+            SELECT md5('s' || i)::uuid, 'price_bench', md5('u' || i)::uuid, 'cs_seed_' || i, true,
+                   'cus_bench' || i, false, false
+            FROM generate_series(0, {users - 1}) AS i
+        """)
+        conn.exec_driver_sql("ANALYZE")
+    for email in emails:
+        fake.add_customer(email, "Bench")
+    return emails
+
+
+def mint_token(secret, email):
+    import jwt
+
+    now = int(time.time())
+    payload = {"sub": str(uuid.uuid4()), "iat": now, "exp": now + 3600, "user-email": email, "user-name": "Bench"}
+    return jwt.encode(payload, secret, "HS256")
+
+
+def cart_request(token, size):
+    # The subscription plus size - 1 add-ons, so checkout cost can be compared across cart sizes
+    items = [{"product": PRODUCT_NAME}] + [
+        {"price_id": f"{PRICE_ID}_addon_{k}", "quantity": 1 + k % 3} for k in range(size - 1)
+    ]
+    body = json.dumps({"items": items})
+    return body, {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+
+
+def signed_event(secret, fake, email, n):
+    # Signs the payload the way Stripe does, so /webhook accepts it
+    event = {
+        "id": f"evt_bench_{n}_{uuid.uuid4().hex[:8]}",
+        "object": "event",
+        "type": "customer.subscription.updated",
+        "data": {"object": fake.subscription(customer_id(email))},
+    }
+    payload = json.dumps(event)
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+    return payload, {"Stripe-Signature": f"t={timestamp},v1={signature}", "Content-Type": "application/json"}
+
+
+class Scenario:
+    """
+    One endpoint to drive, with how to build its n-th request.
+    """
+
+    def __init__(self, name, method, path, users, build=None, consumes_users=False):
+        """
+        Initializes the scenario.
+
+        Args:
+          name (str): The name results are reported under.
+          method (str): The HTTP method.
+          path (str): The request path.
+          users (list): The (email, token) pairs requests are spread over.
+          build (callable): Returns (body, headers) for request n given its
+            user's email and token; requests are sent with only a bearer
+            token when omitted.
+          consumes_users (bool): Whether a request uses its user up, as
+            /unsubscribe does; each request then gets a user of its own.
+        """
+        self.name = name
+        self.method = method
+        self.path = path
+        self.users = users
+        self.build = build
+        self.consumes_users = consumes_users
+        self._next_user = 0
+
+    def requests(self, count):
+        if self.consumes_users:
+            picked = self.users[self._next_user:self._next_user + count]
+            self._next_user += count
+        else:
+            picked = [self.users[i % len(self.users)] for i in range(count)]
+        for n, (email, token) in enumerate(picked):
+            if self.build:
+                body, headers = self.build(n, email, token)
+            else:
+                body, headers = None, {"Authorization": f"Bearer {token}"}
+            yield body, headers
+
+
+async def drive(base_url, scenario, count, concurrency):
+    import httpx
+
+    requests = list(scenario.requests(count))
+    latencies = []
+    statuses = Counter()
+    pending = iter(requests)
+
+    async def worker(client):
+        for body, headers in pending:
+            start = time.perf_counter()
+            response = await client.request(scenario.method, scenario.path, content=body, headers=headers)
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[response.status_code] += 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return sorted(latencies), statuses, elapsed
+
+
+def wait_for_webhooks(engine, timeout=60):
+    # Webhooks are processed in the background; wait so their cost lands on the webhook run
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with engine.connect() as conn:
+            pending = conn.exec_driver_sql(
+                "SELECT count(*) FROM webhook_events WHERE processed_at IS NULL AND attempts = 0"
+            ).scalar()
+        if not pending:
+            return
+        time.sleep(0.1)
+
+
+def run_level(base_url, scenario, count, concurrency, queries, fake, admin_engine):
+    queries_before, calls_before = queries.count, fake.total_calls()
+    latencies, statuses, elapsed = asyncio.run(drive(base_url, scenario, count, concurrency))
+    if scenario.name == "webhook":
+        wait_for_webhooks(admin_engine)
+    done = len(latencies)
+    return {
+        "endpoint": scenario.name,
+        "concurrency": concurrency,
+        "requests": done,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "throughput_rps": round(done / elapsed, 1),
+        "db_queries_per_request": round((queries.count - queries_before) / done, 2),
+        "stripe_calls_per_request": round((fake.total_calls() - calls_before) / done, 2),
+        "statuses": {str(code): n for code, n in sorted(statuses.items())},
+    }
+
+
+def start_app(app):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def print_results(results):
+    print(
+        f"{'endpoint':24} {'conc':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} "
+        f"{'db/req':>7} {'stripe/req':>10}  statuses"
+    )
+    for r in results:
+        statuses = " ".join(f"{code}x{n}" for code, n in r["statuses"].items())
+        print(
+            f"{r['endpoint']:24} {r['concurrency']:>5} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+            f"{r['p99_ms']:>9.1f} {r['throughput_rps']:>8.1f} {r['db_queries_per_request']:>7.2f} "
+            f"{r['stripe_calls_per_request']:>10.2f}  {statuses}"
+        )
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints each result next to its baseline counterpart.
+
+    Latency and throughput regress when they are worse by more than
+    tolerance as a fraction; the per-request query and Stripe call counts
+    regress on any increase beyond tolerance as an absolute count.
+
+    Returns:
+      The list of regression descriptions.
+    """
+    previous = {(r["endpoint"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    print(f"\nCompared with baseline from {baseline['meta']['created_at']}:")
+    print(f"{'endpoint':24} {'conc':>5} {'p95 ms':>19} {'req/s':>17} {'db/req':>13} {'stripe/req':>13}")
+    for r in results:
+        old = previous.get((r["endpoint"], r["concurrency"]))
+        if old is None:
+            continue
+        checks = (
+            ("p95_ms", r["p95_ms"] > old["p95_ms"] * (1 + tolerance)),
+            ("throughput_rps", r["throughput_rps"] < old["throughput_rps"] * (1 - tolerance)),
+            ("db_queries_per_request", r["db_queries_per_request"] > old["db_queries_per_request"] + tolerance),
+            ("stripe_calls_per_request", r["stripe_calls_per_request"] > old["stripe_calls_per_request"] + tolerance),
+        )
+        for metric, regressed in checks:
+            if regressed:
+                regressions.append(f"{r['endpoint']} @ {r['concurrency']}: {metric} {old[metric]} -> {r[metric]}")
+        print(
+            f"{r['endpoint']:24} {r['concurrency']:>5} {old['p95_ms']:>8.1f} -> {r['p95_ms']:<8.1f}"
+            f"{old['throughput_rps']:>7.1f} -> {r['throughput_rps']:<7.1f}"
+            f"{old['db_queries_per_request']:>5.2f} -> {r['db_queries_per_request']:<5.2f}"
+            f"{old['stripe_calls_per_request']:>5.2f} -> {r['stripe_calls_per_request']:<5.2f}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="1,8,32", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=300, help="requests per endpoint and level")
+    parser.add_argument("--users", type=int, default=200, help="seeded users the requests are spread over")
+    parser.add_argument("--latency-ms", type=float, default=30, help="simulated Stripe round-trip")
+    parser.add_argument("--cart-size", type=int, default=10, help="items in the checkout-cart requests")
+    parser.add_argument("--endpoints", help="comma-separated subset of endpoints to run")
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--compare", metavar="FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+
+    fake = FakeStripe(PRODUCT_NAME, args.latency_ms / 1000, addons=max(args.cart_size - 1, 0))
+    stripe_server, stripe_url = start(fake)
+    configure_environment(stripe_url)
+
+    from sqlalchemy import create_engine
+
+    from backend.config import Config
+    from backend.db import stripe_db
+    from backend.db.models import Base
+    from backend.main import app
+
+    conf = Config()
+    # Seeding and bookkeeping use their own engine so they are not counted
+    admin_engine = create_engine(stripe_db.DATABASE_URI)
+    Base.metadata.create_all(admin_engine)
+    # /unsubscribe deletes its user, so it gets a fresh user for every request
+    consumed = args.requests * len(levels)
+    emails = seed(admin_engine, fake, args.users + consumed)
+    users = [(email, mint_token(conf.JWT_SECRET, email)) for email in emails]
+    shared, disposable = users[:args.users], users[args.users:]
+
+    scenarios = [
+        Scenario("root", "GET", "/", shared),
+        Scenario("checkout", "POST", "/create-checkout-session", shared),
+        Scenario(
+            "checkout-cart", "POST", "/create-checkout-session", shared,
+            build=lambda n, email, token: cart_request(token, args.cart_size),
+        ),
+        Scenario("payment-details", "GET", "/payment-details", shared),
+        Scenario("update-payment-method", "POST", "/update-payment-method", shared),
+        Scenario("toggle-auto-renewal", "POST", "/toggle-auto-renewal", shared),
+        Scenario("renewtoken", "POST", "/renewtoken", shared),
+        Scenario(
+            "webhook", "POST", "/webhook", shared,
+            build=lambda n, email, token: signed_event(conf.STRIPE_WEBHOOK_SECRET, fake, email, n),
+        ),
+        Scenario("unsubscribe", "POST", "/unsubscribe", disposable, consumes_users=True),
+    ]
+    if args.endpoints:
+        wanted = args.endpoints.split(",")
+        scenarios = [scenario for scenario in scenarios if scenario.name in wanted]
+
+    queries = QueryCounter(stripe_db.get_engine(), stripe_db.get_read_engine())
+    server, thread, base_url = start_app(app)
+    results = []
+    try:
+        for scenario in scenarios:
+            for concurrency in levels:
+                results.append(run_level(base_url, scenario, args.requests, concurrency, queries, fake, admin_engine))
+    finally:
+        server.should_exit = True
+        thread.join()
+        stripe_server.shutdown()
+
+    print_results(results)
+    report = {
+        "meta": {
+            "created_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "python": platform.python_version(),
+            "levels": levels,
+            "requests": args.requests,
+            "users": args.users,
+            "stripe_latency_ms": args.latency_ms,
+            "cart_size": args.cart_size,
+        },
+        "results": results,
+    }
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,3 +20,57 @@ class Config:
     STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
     FE_BASE_URL = os.getenv("FE_BASE_URL")
     STRIPE_PRODUCT = os.getenv("STRIPE_PRODUCT")
+    REVOCATION_SYNC_SECONDS = int(os.getenv("REVOCATION_SYNC_SECONDS", "30"))
+    CATALOG_CACHE_TTL = int(os.getenv("CATALOG_CACHE_TTL", "3600"))
+    PRICE_INDEX_REFRESH_SECONDS = int(os.getenv("PRICE_INDEX_REFRESH_SECONDS", "60"))
+    CUSTOMER_CACHE_SIZE = int(os.getenv("CUSTOMER_CACHE_SIZE", "10000"))
+    CUSTOMER_CACHE_TTL = int(os.getenv("CUSTOMER_CACHE_TTL", "900"))
+    STRIPE_API_BASE = os.getenv("STRIPE_API_BASE", "https://api.stripe.com")
+    STRIPE_MAX_CONNECTIONS = int(os.getenv("STRIPE_MAX_CONNECTIONS", "20"))
+    STRIPE_TIMEOUT = float(os.getenv("STRIPE_TIMEOUT", "30"))
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+    DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+    DB_REPLICA_PORT = os.getenv("DB_REPLICA_PORT")
+    WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+    WEBHOOK_POLL_SECONDS = float(os.getenv("WEBHOOK_POLL_SECONDS", "5"))
+    WEBHOOK_MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "5"))
+    RECONCILE_INTERVAL_SECONDS = int(os.getenv("RECONCILE_INTERVAL_SECONDS", "300"))
+    RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", "50"))
+    REVOCATION_PURGE_SECONDS = int(os.getenv("REVOCATION_PURGE_SECONDS", "3600"))
+    REVOCATION_PURGE_BATCH_SIZE = int(os.getenv("REVOCATION_PURGE_BATCH_SIZE", "5000"))
+    STRIPE_MAX_IN_FLIGHT = int(os.getenv("STRIPE_MAX_IN_FLIGHT", "20"))
+    STRIPE_MAX_RETRIES = int(os.getenv("STRIPE_MAX_RETRIES", "3"))
+    STRIPE_RETRY_BASE_DELAY = float(os.getenv("STRIPE_RETRY_BASE_DELAY", "0.5"))
+    STRIPE_RETRY_MAX_DELAY = float(os.getenv("STRIPE_RETRY_MAX_DELAY", "8"))
+    CHECKOUT_SESSION_CACHE_TTL = int(os.getenv("CHECKOUT_SESSION_CACHE_TTL", "600"))
+    BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "200"))
+    BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+    BULK_API_MAX_USERS = int(os.getenv("BULK_API_MAX_USERS", "1000"))
+    EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "5000"))
+    JWT_CACHE_SIZE = int(os.getenv("JWT_CACHE_SIZE", "10000"))
+    JWT_CACHE_TTL = int(os.getenv("JWT_CACHE_TTL", "300"))
+    # Where the customer, checkout, account and token caches live: memory (per process), shm (per host) or network
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory")
+    CACHE_SHM_PATH = os.getenv("CACHE_SHM_PATH", "/dev/shm/stripe-api-cache")
+    CACHE_SHM_SLOTS = int(os.getenv("CACHE_SHM_SLOTS", "8192"))
+    CACHE_SHM_SLOT_SIZE = int(os.getenv("CACHE_SHM_SLOT_SIZE", "8192"))
+    CACHE_URL = os.getenv("CACHE_URL", "redis://127.0.0.1:6379/0")
+    CACHE_NETWORK_TIMEOUT = float(os.getenv("CACHE_NETWORK_TIMEOUT", "0.05"))
+    CACHE_KEY_PREFIX = os.getenv("CACHE_KEY_PREFIX", "stripe-api")
+    CACHE_INVALIDATION = os.getenv("CACHE_INVALIDATION", "true").lower() == "true"
+    # Hours after a failed payment at which it is retried, and after which access is revoked if still unpaid
+    DUNNING_RETRY_HOURS = os.getenv("DUNNING_RETRY_HOURS", "24,72,120")
+    DUNNING_GRACE_HOURS = float(os.getenv("DUNNING_GRACE_HOURS", "168"))
+    DUNNING_INTERVAL_SECONDS = int(os.getenv("DUNNING_INTERVAL_SECONDS", "60"))
+    DUNNING_BATCH_SIZE = int(os.getenv("DUNNING_BATCH_SIZE", "500"))
+    DUNNING_CONCURRENCY = int(os.getenv("DUNNING_CONCURRENCY", "8"))
+    DUNNING_LEASE_SECONDS = int(os.getenv("DUNNING_LEASE_SECONDS", "600"))
+    # Comma-separated main.WARM_UP_HOOKS run at startup, in the background unless WARM_UP_BLOCKING
+    WARM_UP = os.getenv("WARM_UP", "database,revocations,catalog,jwt,stripe")
+    WARM_UP_BLOCKING = os.getenv("WARM_UP_BLOCKING", "false").lower() == "true"
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
@@ -0,0 +1,286 @@
+import asyncio
+import logging
+from functools import partial
+
+from anyio import to_thread
+from sqlalchemy import inspect
+
+from backend.config import Config
+from backend.db import stripe_db
+from backend.db.stripe_client import get_client
+from backend.utils.cache import MemoryBackend
+from backend.utils.lazy import lazy_import
+
+stripe = lazy_import("stripe")
+
+# Async counterparts of the Stripe-facing helpers in stripe_db. Stripe calls go
+# through the pooled async client; the short database reads, and the caches
+# whose backend does file or socket I/O, are offloaded to the worker thread
+# pool so neither blocks the event loop.
+
+logger = logging.getLogger(__name__)
+
+conf = Config()
+
+
+def _in_process(cache):
+    # A process's own store answers at once; the shm and network backends are left off the loop
+    return cache.scope == MemoryBackend.scope
+
+
+async def _run_cached(cache, fn, *args, **kwargs):
+    # Runs fn, which reads or writes cache, on the loop or in the thread pool according to its backend
+    if _in_process(cache):
+        return fn(*args, **kwargs)
+    return await to_thread.run_sync(partial(fn, *args, **kwargs))
+
+
+async def _remember_customer(email, **fields):
+    return await _run_cached(stripe_db.customer_cache, stripe_db.remember_customer, email, **fields)
+
+
+async def find_user_by_email(email, sess=None):
+    return await to_thread.run_sync(stripe_db.find_user_by_email, email, sess)
+
+
+async def subscription_of(user, sess=None):
+    if "subscription" in inspect(user).unloaded:
+        return await to_thread.run_sync(stripe_db.find_subscription, user.id, sess)
+    return user.subscription
+
+
+async def resolve_customer(email):
+    entry = await _run_cached(stripe_db.customer_cache, stripe_db.customer_cache.get, email)
+    if entry:
+        return entry
+    customer_id = await to_thread.run_sync(stripe_db.find_stripe_customer_id, email)
+    if customer_id:
+        return await _remember_customer(email, customer_id=customer_id)
+    customers = await get_client().get("/v1/customers", email=email, limit=1)
+    if not customers["data"]:
+        return None
+    return await _remember_customer(email, customer_id=customers["data"][0]["id"])
+
+
+async def create_or_retrieve_stripe_customer(user_email, user_name):
+    try:
+        customer = await resolve_customer(user_email)
+        if customer:
+            return customer["customer_id"]
+        new_customer = await get_client().post("/v1/customers", email=user_email, name=user_name)
+        await _remember_customer(user_email, customer_id=new_customer["id"])
+        return new_customer["id"]
+    except stripe.error.RateLimitError:
+        raise
+    except stripe.error.StripeError as e:
+        logger.error("Stripe API error: %s", e)
+        return None
+
+
+async def get_price_index(refresh=False):
+    cache = stripe_db.catalog_cache
+    index = None if refresh else await _run_cached(cache, cache.get, stripe_db.PRICE_INDEX_KEY)
+    if index is None:
+        prices = [
+            price async for price in get_client().list_all("/v1/prices", active=True, expand=["data.product"])
+        ]
+        index = stripe_db.build_price_index(prices)
+        await _run_cached(cache, cache.set, stripe_db.PRICE_INDEX_KEY, index)
+    return index
+
+
+async def resolve_cart(items):
+    # The whole cart resolves from one cached listing, however many items it has
+    index = await get_price_index()
+    line_items, entries, missing = stripe_db.resolve_cart(index, items)
+    if missing and stripe_db.price_index_is_stale(index):
+        index = await get_price_index(refresh=True)
+        line_items, entries, missing = stripe_db.resolve_cart(index, items)
+    return line_items, entries, missing
+
+
+_checkout_flights = {}
+
+
+async def create_checkout_session(line_items, mode, customer_email, success_url, cancel_url, metadata=None,
+                                  idempotency_key=None):
+    return await get_client().post(
+        "/v1/checkout/sessions",
+        idempotency_key=idempotency_key,
+        payment_method_types=["card"],
+        line_items=line_items,
+        mode=mode,
+        success_url=success_url,
+        cancel_url=cancel_url,
+        customer_email=customer_email,
+        metadata=metadata or {},
+    )
+
+
+# Replayed sessions followed before giving up, e.g. a user who paid this cart several times today
+CHECKOUT_CHAIN_LIMIT = 5
+
+
+async def _create_usable_checkout_session(idempotency_prefix, previous_id, **params):
+    # Each key ends with the ID of the session it replaces, so concurrent clicks from any worker share
+    # one key, and a replaced session never comes back. Stripe replays the session of a key already
+    # used, e.g. after the cache lost the entry, so a replayed session that was paid or expired
+    # since is chained past.
+    for _ in range(CHECKOUT_CHAIN_LIMIT):
+        created = await create_checkout_session(
+            idempotency_key=f"{idempotency_prefix}-{previous_id or 'first'}", **params
+        )
+        if stripe_db.checkout_session_usable(created):
+            return created
+        previous_id = created["id"]
+    raise Exception("Could not create an open checkout session")
+
+
+async def get_or_create_checkout_session(token_sub, customer_email, line_items, entries, success_url, cancel_url):
+    # Repeated clicks for the same (user, cart) reuse the open session instead of creating another
+    cart = stripe_db.cart_key(line_items)
+    key = (customer_email, cart)
+    previous_id = None
+    session = await _run_cached(stripe_db.checkout_cache, stripe_db.checkout_cache.get, key)
+    if session:
+        if stripe_db.checkout_session_usable(session):
+            # The cached copy stays "open" until the queued checkout.session.completed is processed
+            current = await get_client().get(f"/v1/checkout/sessions/{session['id']}")
+            if stripe_db.checkout_session_usable(current):
+                return session
+        previous_id = session["id"]
+    flight = _checkout_flights.get(key)
+    if flight is None:
+        mode = stripe_db.checkout_mode(entries)
+        # create_subscription records the recurring price of the cart, if it has one
+        primary = next((entry for entry in entries if entry["mode"] == mode), entries[0])
+        flight = _checkout_flights[key] = asyncio.ensure_future(_create_usable_checkout_session(
+            f"checkout-{token_sub or customer_email}-{cart}",
+            previous_id,
+            line_items=line_items,
+            mode=mode,
+            customer_email=customer_email,
+            success_url=success_url,
+            cancel_url=cancel_url,
+            metadata={"price_id": primary["price_id"], "cart": cart},
+        ))
+        flight.add_done_callback(lambda _: _checkout_flights.pop(key, None))
+    created = await asyncio.shield(flight)
+    session = {
+        "id": created["id"], "url": created.get("url"), "expires_at": created["expires_at"], "status": created["status"]
+    }
+    await _run_cached(stripe_db.checkout_cache, stripe_db.checkout_cache.set, key, session)
+    return session
+
+
+async def get_subscription_id_from_email(email):
+    customer = await resolve_customer(email)
+    if not customer:
+        raise Exception(f"No customer found with email: {email}")
+    if customer.get("subscription_id"):
+        return customer["subscription_id"]
+    subscriptions = await get_client().get(
+        "/v1/subscriptions", customer=customer["customer_id"], limit=1
+    )
+    if not subscriptions["data"]:
+        raise Exception(f"No subscriptions found for customer with email: {email}")
+    subscription_id = subscriptions["data"][0]["id"]
+    await _remember_customer(email, subscription_id=subscription_id)
+    return subscription_id
+
+
+async def toggle_auto_renewal(user, sess):
+    """
+    Pauses a running subscription's renewals, or resumes paused ones, with
+    one Stripe call, and writes Stripe's answer through to the row.
+
+    Returns:
+      Whether renewals are now paused, or None if the user has no
+      subscription.
+
+    Raises:
+      stripe_db.SubscriptionStateError: The subscription is neither
+        active nor paused, e.g. cancelled or revoked by dunning.
+    """
+    subscription = await subscription_of(user, sess)
+    if not subscription:
+        return None
+    if not stripe_db.auto_renewal_toggleable(subscription):
+        raise stripe_db.SubscriptionStateError("Subscription is neither active nor paused")
+    pause = not stripe_db.auto_renewal_paused(subscription)
+    subscription_id = subscription.stripe_subscription_id or await get_subscription_id_from_email(user.email)
+    updated = await get_client().post(
+        f"/v1/subscriptions/{subscription_id}", **stripe_db.pause_collection_params(pause)
+    )
+    state = stripe_db.record_auto_renewal(user, subscription, updated)
+    # The account is cached once committed, in the commit's thread: the invalidation is broadcast
+    # through the database and must not block the event loop
+    stripe_db.replace_account_on_commit(sess, user.email, state)
+    await to_thread.run_sync(sess.commit)
+    return subscription.is_paused
+
+
+async def load_account(email):
+    # With the in-process backend, cached accounts are served without leaving the event loop;
+    # otherwise the lookup and any load share one trip to the thread pool
+    if _in_process(stripe_db.account_cache):
+        state = stripe_db.account_cache.get(email)
+        if state:
+            return state
+    return await to_thread.run_sync(stripe_db.load_account, email)
+
+
+async def get_payment_method_id_by_email(email):
+    customer = await resolve_customer(email)
+    if not customer:
+        raise Exception(f"No customer found with email: {email}")
+    # Listed every time, like the sync path: a cached choice would miss cards attached since
+    payment_methods = await get_client().get(
+        "/v1/payment_methods", customer=customer["customer_id"], type="card", limit=1
+    )
+    if not payment_methods["data"]:
+        raise Exception(f"No payment methods found for customer with email: {email}")
+    return payment_methods["data"][0]["id"]
+
+
+async def update_payment_method(user, payment_method_id, sess=None):
+    subscription = await subscription_of(user, sess)
+    if not subscription or not subscription.active:
+        raise Exception("Active subscription not found for user")
+    await get_client().post(
+        f"/v1/customers/{subscription.stripe_customer_id}",
+        invoice_settings={"default_payment_method": payment_method_id},
+    )
+
+
+async def get_payment_details(user, sess=None):
+    try:
+        subscription = await subscription_of(user, sess)
+
+        if not subscription:
+            return {"error": "Subscription not found"}
+        if user.is_beta_user == True:
+            return stripe_db.beta_payment_details(user, subscription)
+        projected = stripe_db.projected_payment_details(user, subscription)
+        if projected:
+            return projected
+
+        customer = await get_client().get(
+            f"/v1/customers/{subscription.stripe_customer_id}",
+            expand=["subscriptions.data.default_payment_method"],
+        )
+        subscription_id = await get_subscription_id_from_email(user.email)
+        return stripe_db.payment_details_from_customer(user, customer, subscription_id)
+
+    except stripe.error.RateLimitError:
+        raise
+    except stripe.error.StripeError as e:
+        logger.error("Stripe API error: %s", e)
+        return {"error": "Stripe API error occurred"}
+    except Exception:
+        logger.exception("Error retrieving payment details")
+        return {"error": "Error retrieving payment details"}
+
+
+async def cancel_subscription(user, token, sess=None):
+    await to_thread.run_sync(stripe_db.cancel_subscription, user, token, sess)
@@ -0,0 +1,250 @@
+"""
+Bulk pause, resume and cancel of subscriptions for lists of users.
+
+Users are processed in batches. Each batch resolves its Stripe subscriptions
+from the subscription table in one query, applies the Stripe changes
+concurrently through the gateway (which enforces the in-flight limit and
+retries rate limited calls), then writes the successful changes back in one
+transaction. After every batch a checkpoint file records the progress, so
+an interrupted run continues where it stopped when started again with the
+same checkpoint. Stripe writes use idempotency keys tied to the run, so an
+item retried after a crash is not applied twice.
+
+Cancelling here ends the Stripe subscription and marks it inactive; unlike
+/unsubscribe it does not delete the user.
+
+Usage:
+    python -m backend.db.bulk pause|resume|cancel (--emails a@x.com,b@x.com | --file emails.txt)
+        [--batch-size 200] [--concurrency 8] [--checkpoint FILE] [--dry-run]
+"""
+import os
+import sys
+import json
+import uuid
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.config import Config
+from backend.db import stripe_db, stripe_gateway
+from backend.db.models import Subscription, User
+from backend.utils.lazy import lazy_import
+
+stripe = lazy_import("stripe")
+
+conf = Config()
+
+
+def _pause(subscription_id, idempotency_key):
+    stripe_gateway.write(
+        stripe.Subscription.modify,
+        subscription_id,
+        pause_collection={"behavior": "keep_as_draft"},
+        idempotency_key=idempotency_key,
+    )
+
+
+def _resume(subscription_id, idempotency_key):
+    stripe_gateway.write(
+        stripe.Subscription.modify,
+        subscription_id,
+        pause_collection="",
+        idempotency_key=idempotency_key,
+    )
+
+
+def _cancel(subscription_id, idempotency_key):
+    stripe_gateway.write(stripe.Subscription.delete, subscription_id, idempotency_key=idempotency_key)
+
+
+# action -> (whether a row qualifies, the Stripe call, the columns written back).
+# A paused subscription stays active, as with /toggle-auto-renewal: only is_paused changes.
+# Only paused rows resume, and a paused row can still be cancelled.
+ACTIONS = {
+    "pause": (lambda row: row.active and not row.is_paused, _pause, {"is_paused": True}),
+    "resume": (lambda row: row.is_paused, _resume, {"is_paused": False}),
+    "cancel": (lambda row: row.active or row.is_paused, _cancel, {"active": False, "is_paused": False}),
+}
+
+
+def resolve_subscriptions(emails, sess=None):
+    # One query for the whole batch; rows not yet projected have no stripe_subscription_id
+    with stripe_db.read_session_scope(sess) as sess:
+        return (
+            sess.query(
+                User.email,
+                Subscription.id,
+                Subscription.active,
+                Subscription.is_paused,
+                Subscription.stripe_customer_id,
+                Subscription.stripe_subscription_id,
+            )
+            .join(Subscription, Subscription.user_id == User.id)
+            .filter(User.email.in_(emails))
+            .all()
+        )
+
+
+def _subscription_id(row):
+    if row.stripe_subscription_id:
+        return row.stripe_subscription_id
+    subscriptions = stripe_gateway.read(stripe.Subscription.list, customer=row.stripe_customer_id, limit=1)
+    if not subscriptions.data:
+        raise Exception(f"No subscriptions found for customer {row.stripe_customer_id}")
+    return subscriptions.data[0].id
+
+
+def _apply(action, row, run_id):
+    try:
+        subscription_id = _subscription_id(row)
+        ACTIONS[action][1](subscription_id, f"bulk-{run_id}-{action}-{subscription_id}")
+        return row, subscription_id, None
+    except Exception as e:
+        return row, None, str(e)
+
+
+def run_batch(action, emails, run_id, pool, dry_run=False):
+    """
+    Applies action to one batch of users.
+
+    Args:
+      action (str): "pause", "resume" or "cancel".
+      emails (list): The users' emails.
+      run_id (str): Identifies the run in the Stripe idempotency keys.
+      pool (ThreadPoolExecutor): Runs the Stripe calls concurrently.
+      dry_run (bool): Only report which users qualify.
+
+    Returns:
+      A tuple of (done, skipped, failures), where failures is a list of
+      {"email", "error"} dicts.
+    """
+    eligible, _, fields = ACTIONS[action]
+    rows = resolve_subscriptions(emails)
+    targets = [row for row in rows if eligible(row)]
+    skipped = len(emails) - len(targets)
+    if dry_run:
+        return len(targets), skipped, []
+
+    results = list(pool.map(lambda row: _apply(action, row, run_id), targets))
+    updates = [
+        dict(fields, id=row.id, stripe_subscription_id=subscription_id)
+        for row, subscription_id, error in results if error is None
+    ]
+    failures = [{"email": row.email, "error": error} for row, _, error in results if error is not None]
+    if updates:
+        with stripe_db.session_scope() as sess:
+            sess.bulk_update_mappings(Subscription, updates)
+            for row, _, error in results:
+                if error is None:
+                    stripe_db.forget_account_on_commit(sess, row.email)
+    return len(updates), skipped, failures
+
+
+def _input_digest(action, emails):
+    return hashlib.sha256(json.dumps([action, emails]).encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(path, action, emails):
+    # A checkpoint only resumes the run it was written for
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint.get("input") != _input_digest(action, emails):
+        raise Exception(f"Checkpoint {path} belongs to a different action or user list")
+    return checkpoint
+
+
+def save_checkpoint(path, checkpoint):
+    # Written to a temporary file and renamed so a crash never leaves a torn checkpoint
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, path)
+
+
+def run_bulk(action, emails, batch_size=None, concurrency=None, checkpoint_path=None, dry_run=False, progress=None):
+    """
+    Applies action to every user in emails.
+
+    Args:
+      action (str): "pause", "resume" or "cancel".
+      emails (list): The users' emails; duplicates are ignored.
+      batch_size (int): Users resolved and committed together.
+      concurrency (int): Stripe calls made in parallel.
+      checkpoint_path (str): A file recording progress after every batch.
+        If it exists, the run resumes from it.
+      dry_run (bool): Only report which users qualify.
+      progress (callable): Called with the checkpoint after every batch.
+
+    Returns:
+      The final checkpoint: position, done, skipped and failures.
+    """
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown action: {action}")
+    emails = list(dict.fromkeys(emails))
+    batch_size = batch_size or conf.BULK_BATCH_SIZE
+    checkpoint = load_checkpoint(checkpoint_path, action, emails) or {
+        "input": _input_digest(action, emails),
+        "run_id": uuid.uuid4().hex[:12],
+        "position": 0,
+        "done": 0,
+        "skipped": 0,
+        "failures": [],
+    }
+    with ThreadPoolExecutor(max_workers=concurrency or conf.BULK_CONCURRENCY) as pool:
+        while checkpoint["position"] < len(emails):
+            batch = emails[checkpoint["position"]:checkpoint["position"] + batch_size]
+            done, skipped, failures = run_batch(action, batch, checkpoint["run_id"], pool, dry_run)
+            checkpoint["position"] += len(batch)
+            checkpoint["done"] += done
+            checkpoint["skipped"] += skipped
+            checkpoint["failures"].extend(failures)
+            if checkpoint_path and not dry_run:
+                save_checkpoint(checkpoint_path, checkpoint)
+            if progress:
+                progress(checkpoint)
+    return checkpoint
+
+
+def _read_emails(args):
+    if args.emails:
+        return [email.strip() for email in args.emails.split(",") if email.strip()]
+    with open(args.file) as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("action", choices=sorted(ACTIONS))
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--emails", help="comma-separated user emails")
+    source.add_argument("--file", help="a file with one user email per line")
+    parser.add_argument("--batch-size", type=int, default=conf.BULK_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=conf.BULK_CONCURRENCY)
+    parser.add_argument("--checkpoint", help="progress file; rerun with the same file to resume")
+    parser.add_argument("--dry-run", action="store_true", help="Report which users qualify without changing them")
+    args = parser.parse_args()
+
+    emails = _read_emails(args)
+    start = time.monotonic()
+
+    def progress(checkpoint):
+        elapsed = time.monotonic() - start
+        print(
+            f"{checkpoint['position']}/{len(emails)} users: {checkpoint['done']} done, "
+            f"{checkpoint['skipped']} skipped, {len(checkpoint['failures'])} failed ({elapsed:.1f}s)"
+        )
+
+    checkpoint = run_bulk(
+        args.action, emails, args.batch_size, args.concurrency, args.checkpoint, args.dry_run, progress
+    )
+    for failure in checkpoint["failures"]:
+        print(f"failed: {failure['email']}: {failure['error']}")
+    if checkpoint["failures"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
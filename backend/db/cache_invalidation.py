@@ -0,0 +1,89 @@
+import json
+import asyncio
+import logging
+
+from sqlalchemy import func, select
+
+from backend.db import revocation, stripe_db
+from backend.utils import cache
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "cache_invalidation"
+RECONNECT_SECONDS = 5
+
+
+def publish(namespace, key):
+    # Broadcasts through Postgres NOTIFY, which every worker already has a connection to
+    host, process = cache.origin()
+    message = json.dumps({"namespace": namespace, "key": key, "host": host, "process": process})
+    with stripe_db.session_scope() as sess:
+        sess.execute(select(func.pg_notify(CHANNEL, message)))
+
+
+def publish_revocation(sess, digest, exp):
+    # In the transaction that records the revocation: NOTIFY is only delivered if it commits
+    host, process = cache.origin()
+    message = json.dumps({"revoked": digest, "exp": exp, "host": host, "process": process})
+    sess.execute(select(func.pg_notify(CHANNEL, message)))
+
+
+def _apply(payload):
+    try:
+        message = json.loads(payload)
+        if "revoked" in message:
+            revocation.add_digest(message["revoked"], message["exp"])
+            return
+        cache.apply_invalidation(message["namespace"], message["key"], message["host"], message["process"])
+    except Exception:
+        logger.exception("Bad cache invalidation %r", payload)
+
+
+def _connect():
+    # A dedicated connection outside the pool: it stays checked out for as long as the worker listens
+    import psycopg2
+
+    conn = psycopg2.connect(stripe_db.DATABASE_URI)
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f"LISTEN {CHANNEL}")
+    return conn
+
+
+async def listen():
+    """
+    Applies the invalidations broadcast by other workers until cancelled.
+
+    Notifications sent while the connection is down are lost, so every
+    cache shared only within the process or host is dropped on reconnect.
+    Revocations missed meanwhile are picked up by the periodic sync of
+    stripe_db.sync_revocation_cache.
+    """
+    loop = asyncio.get_running_loop()
+    reconnected = False
+    while True:
+        conn = None
+        try:
+            conn = await loop.run_in_executor(None, _connect)
+            if reconnected:
+                cache.drop_all()
+            readable = asyncio.Event()
+            loop.add_reader(conn.fileno(), readable.set)
+            try:
+                while True:
+                    await readable.wait()
+                    readable.clear()
+                    conn.poll()
+                    while conn.notifies:
+                        _apply(conn.notifies.pop(0).payload)
+            finally:
+                loop.remove_reader(conn.fileno())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Cache invalidation listener error, reconnecting in %ss", RECONNECT_SECONDS)
+        finally:
+            if conn is not None:
+                conn.close()
+        reconnected = True
+        await asyncio.sleep(RECONNECT_SECONDS)
@@ -0,0 +1,213 @@
+"""
+Retries failed subscription payments and revokes access when the grace
+period ends unpaid.
+
+stripe_db.handle_payment_failed puts a subscription on the dunning schedule
+with its next due time. run_due works through the entries that are due, a
+batch at a time, read from the index on due_at. Each batch is claimed in one
+transaction with FOR UPDATE SKIP LOCKED and the customers' advisory locks,
+so nodes running it at the same time take different entries. In that same
+transaction the entries whose grace period has ended are revoked with one
+update of the subscriptions and one of the users, and the others are leased
+for DUNNING_LEASE_SECONDS. The leased payments are then retried
+concurrently through the gateway, outside any transaction, and the outcomes
+written back in one more. An entry whose retry was never recorded, e.g.
+because the node died, comes due again when its lease ends.
+
+Usage:
+    python -m backend.db.dunning [--batch-size 500] [--concurrency 8]
+"""
+import time
+import logging
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import and_, bindparam, select, update
+
+from backend.config import Config
+from backend.db import coordination, stripe_db, stripe_gateway
+from backend.db.models import DunningEntry, Subscription, User
+from backend.utils.lazy import lazy_import
+
+stripe = lazy_import("stripe")
+
+logger = logging.getLogger(__name__)
+
+conf = Config()
+
+
+def claim(sess, batch_size, now):
+    """
+    Locks up to batch_size due entries for sess's transaction, skipping
+    those another node holds and those of customers being written to.
+    """
+    entries = (
+        sess.query(DunningEntry)
+        .filter(DunningEntry.due_at <= now)
+        .order_by(DunningEntry.due_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    locked = coordination.try_lock_customers(sess, {entry.stripe_customer_id for entry in entries})
+    return [entry for entry in entries if entry.stripe_customer_id in locked]
+
+
+def revoke(sess, entries, now):
+    """
+    Ends access for the subscriptions of entries, whatever their number,
+    with one update per table.
+
+    Returns:
+      The emails of the users revoked.
+    """
+    ids = [entry.subscription_id for entry in entries]
+    if not ids:
+        return []
+    sess.execute(
+        update(Subscription).where(Subscription.id.in_(ids)).values(active=False)
+        .execution_options(synchronize_session=False)
+    )
+    emails = sess.execute(
+        update(User)
+        .where(User.id.in_(select(Subscription.user_id).where(Subscription.id.in_(ids))))
+        .values(access=False)
+        .returning(User.email)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    for entry in entries:
+        entry.due_at = None
+        entry.revoked_at = now
+    stripe_db.forget_accounts_on_commit(sess, emails)
+    return emails
+
+
+def _retry(entry, lease):
+    # entry is (subscription_id, invoice_id, attempts); returns it with the error, None once paid.
+    # The key is unique per lease: Stripe replays the saved answer of a key for a day, so an entry
+    # retried after an error that counted no attempt must not send the same key again.
+    subscription_id, invoice_id, attempts = entry
+    try:
+        stripe_gateway.write(
+            stripe.Invoice.pay, invoice_id, idempotency_key=f"dunning-{invoice_id}-{attempts}-{lease}"
+        )
+        return entry, None
+    except stripe.error.StripeError as e:
+        return entry, e
+
+
+def record(results, schedule):
+    """
+    Writes the outcomes of one batch of retries in one transaction.
+
+    Paid entries are removed. A declined payment counts as an attempt and
+    moves the entry to its next due time; other errors count nothing and
+    the entry is retried when its lease ends. Entries changed meanwhile,
+    e.g. settled by an invoice.paid webhook, are left alone.
+
+    Returns:
+      A tuple of (paid, declined, errors) counts.
+    """
+    paid = [entry[0] for entry, error in results if error is None]
+    declined = []
+    errors = 0
+    for (subscription_id, _, attempts), error in results:
+        if error is None:
+            continue
+        if isinstance(error, stripe.error.CardError):
+            failed_at, grace_ends_at = schedule[subscription_id]
+            advanced = DunningEntry(attempts=attempts + 1, failed_at=failed_at, grace_ends_at=grace_ends_at)
+            declined.append({
+                "id": subscription_id,
+                "attempts_made": attempts,
+                "attempts": attempts + 1,
+                "due_at": stripe_db.dunning_due(advanced),
+                "last_error": str(error)[:1024],
+            })
+        else:
+            errors += 1
+            logger.error("Stripe error retrying the payment of subscription %s: %s", subscription_id, error)
+    with stripe_db.session_scope() as sess:
+        if paid:
+            (
+                sess.query(DunningEntry)
+                .filter(DunningEntry.subscription_id.in_(paid), DunningEntry.revoked_at == None)
+                .delete(synchronize_session=False)
+            )
+        if declined:
+            table = DunningEntry.__table__
+            sess.execute(
+                table.update()
+                .where(and_(table.c.subscription_id == bindparam("id"), table.c.attempts == bindparam("attempts_made")))
+                .values(attempts=bindparam("attempts"), due_at=bindparam("due_at"), last_error=bindparam("last_error")),
+                declined,
+            )
+    return len(paid), len(declined), errors
+
+
+def run_batch(batch_size, pool, now=None):
+    """
+    Processes one batch of due entries.
+
+    Returns:
+      A dict of the entries claimed, revoked, paid, declined, and retries
+      that failed for another reason.
+    """
+    now = now or datetime.utcnow()
+    with stripe_db.session_scope() as sess:
+        entries = claim(sess, batch_size, now)
+        expired = [entry for entry in entries if entry.grace_ends_at <= now]
+        retrying = [entry for entry in entries if entry.grace_ends_at > now]
+        revoke(sess, expired, now)
+        lease_ends_at = now + timedelta(seconds=conf.DUNNING_LEASE_SECONDS)
+        for entry in retrying:
+            entry.due_at = lease_ends_at
+        retries = [(entry.subscription_id, entry.invoice_id, entry.attempts) for entry in retrying]
+        schedule = {entry.subscription_id: (entry.failed_at, entry.grace_ends_at) for entry in retrying}
+    lease = int(lease_ends_at.timestamp())
+    results = list(pool.map(lambda entry: _retry(entry, lease), retries))
+    paid, declined, errors = record(results, schedule) if retries else (0, 0, 0)
+    return {
+        "claimed": len(entries),
+        "revoked": len(expired),
+        "paid": paid,
+        "declined": declined,
+        "errors": errors,
+    }
+
+
+def run_due(batch_size=None, concurrency=None):
+    """
+    Processes due entries batch after batch until fewer than a full batch
+    were claimed.
+
+    Returns:
+      The totals of run_batch's counts.
+    """
+    batch_size = batch_size or conf.DUNNING_BATCH_SIZE
+    totals = dict.fromkeys(("claimed", "revoked", "paid", "declined", "errors"), 0)
+    with ThreadPoolExecutor(max_workers=concurrency or conf.DUNNING_CONCURRENCY) as pool:
+        while True:
+            counts = run_batch(batch_size, pool)
+            for name, count in counts.items():
+                totals[name] += count
+            if counts["claimed"] < batch_size:
+                return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=conf.DUNNING_BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=conf.DUNNING_CONCURRENCY)
+    args = parser.parse_args()
+    start = time.monotonic()
+    totals = run_due(args.batch_size, args.concurrency)
+    print(
+        f"{totals['claimed']} due entries: {totals['revoked']} revoked, {totals['paid']} paid, "
+        f"{totals['declined']} declined, {totals['errors']} errors ({time.monotonic() - start:.1f}s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
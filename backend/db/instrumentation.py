@@ -0,0 +1,171 @@
+import re
+import time
+import logging
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from backend.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Counts and times the database queries and Stripe calls made while serving a
+# request. The per-request totals live in a context variable, which worker
+# threads and tasks started by the request inherit; the process-wide totals
+# are exported by /metrics.
+
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route and status", ("method", "route", "status")
+)
+http_durations = registry.histogram(
+    "http_request_duration_seconds", "Duration of HTTP requests", ("route",)
+)
+queries_per_request = registry.histogram(
+    "http_request_db_queries", "Database queries made per HTTP request", ("route",), COUNT_BUCKETS
+)
+stripe_calls_per_request = registry.histogram(
+    "http_request_stripe_calls", "Stripe API calls made per HTTP request", ("route",), COUNT_BUCKETS
+)
+db_queries = registry.histogram(
+    "db_query_duration_seconds", "Duration of database queries", ("pool",)
+)
+stripe_requests = registry.counter(
+    "stripe_requests_total", "Stripe API requests by operation and outcome", ("operation", "status")
+)
+stripe_durations = registry.histogram(
+    "stripe_request_duration_seconds", "Duration of Stripe API requests", ("operation",)
+)
+
+_current = ContextVar("request_stats", default=None)
+# Stripe object IDs: a lowercase prefix, an underscore, then a token with digits or capitals
+_ID_SEGMENT = re.compile(r"/[a-z]+_(?=[A-Za-z0-9]*[A-Z0-9])[A-Za-z0-9]+")
+
+
+class RequestStats:
+    """
+    The queries and Stripe calls made while serving one request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.stripe_calls = 0
+        self.stripe_seconds = 0.0
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """
+        Returns the value of the Server-Timing response header, in ms.
+        """
+        return (
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries", '
+            f'stripe;dur={self.stripe_seconds * 1000:.1f};desc="{self.stripe_calls} calls", '
+            f"total;dur={self.elapsed * 1000:.1f}"
+        )
+
+
+def start_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def observe_request(method, route, status, stats):
+    elapsed = stats.elapsed
+    http_requests.inc(method, route, str(status))
+    http_durations.observe(elapsed, route)
+    queries_per_request.observe(stats.db_queries, route)
+    stripe_calls_per_request.observe(stats.stripe_calls, route)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "%s %s %s in %.1f ms", method, route, status, elapsed * 1000,
+            extra={
+                "route": route,
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 2),
+                "db_queries": stats.db_queries,
+                "db_ms": round(stats.db_seconds * 1000, 2),
+                "stripe_calls": stats.stripe_calls,
+                "stripe_ms": round(stats.stripe_seconds * 1000, 2),
+            },
+        )
+
+
+def observe_stripe(operation, status, seconds):
+    stripe_requests.inc(operation, str(status))
+    stripe_durations.observe(seconds, operation)
+    stats = _current.get()
+    if stats is not None:
+        stats.stripe_calls += 1
+        stats.stripe_seconds += seconds
+
+
+def stripe_operation(method, path):
+    # "/v1/customers/cus_123" -> "GET /v1/customers/:id", keeping the label set small
+    return f"{method} {_ID_SEGMENT.sub('/:id', path)}"
+
+
+def instrument_engine(engine, pool):
+    """
+    Times every statement executed on engine.
+
+    Args:
+      engine (Engine): The engine to observe.
+      pool (str): The label its queries are exported under.
+    """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info["query_start"].pop()
+        db_queries.observe(seconds, pool)
+        stats = _current.get()
+        if stats is not None:
+            stats.db_queries += 1
+            stats.db_seconds += seconds
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        # Failed statements never reach after_cursor_execute
+        starts = context.connection.info.get("query_start") if context.connection else None
+        if starts:
+            starts.pop()
+
+
+def export_pools(pool_status):
+    """
+    Exports the connection pool snapshots as metrics.
+
+    Args:
+      pool_status (callable): Returns the PoolMetrics snapshots to export.
+    """
+    fields = (
+        ("db_pool_size", "size", "Configured size of the connection pool", "gauge"),
+        ("db_pool_checked_out", "checked_out", "Connections currently checked out", "gauge"),
+        ("db_pool_overflow", "overflow", "Overflow connections currently open", "gauge"),
+        ("db_pool_saturation", "saturation", "Checked out connections over pool capacity", "gauge"),
+        ("db_pool_checkouts_total", "checkouts", "Connection checkouts", "counter"),
+        ("db_pool_timeouts_total", "timeouts", "Connection checkouts that timed out", "counter"),
+        ("db_pool_max_wait_milliseconds", "max_wait_ms", "Longest wait for a connection", "gauge"),
+    )
+    for name, field, help, type in fields:
+        registry.callback(
+            name, help, ("pool",),
+            lambda field=field: [((snapshot["pool"],), snapshot[field]) for snapshot in pool_status()],
+            type,
+        )
@@ -0,0 +1,53 @@
+"""
+Applies the SQL files in backend/db/migrations that have not run yet, in
+name order, and records them in the schema_migrations table.
+
+Usage:
+    python -m backend.db.migrate
+"""
+from pathlib import Path
+
+from backend.db import stripe_db
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+
+
+def _statements(sql):
+    lines = [line for line in sql.splitlines() if not line.strip().startswith("--")]
+    return [statement.strip() for statement in "\n".join(lines).split(";") if statement.strip()]
+
+
+def migrate(engine=None):
+    """
+    Runs pending migrations.
+
+    Each statement runs in autocommit mode because CREATE INDEX CONCURRENTLY
+    cannot run inside a transaction. Migrations are therefore written to be
+    idempotent so a partially applied file can simply be run again.
+
+    Returns:
+      The names of the migrations that were applied.
+    """
+    engine = engine or stripe_db.get_engine()
+    applied_now = []
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS schema_migrations "
+            "(name VARCHAR(255) PRIMARY KEY, applied_at TIMESTAMP DEFAULT now())"
+        )
+        applied = {row[0] for row in conn.exec_driver_sql("SELECT name FROM schema_migrations")}
+        for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+            if path.name in applied:
+                continue
+            print(f"Applying {path.name}")
+            for statement in _statements(path.read_text()):
+                conn.exec_driver_sql(statement)
+            conn.exec_driver_sql(
+                "INSERT INTO schema_migrations (name) VALUES (%(name)s)", {"name": path.name}
+            )
+            applied_now.append(path.name)
+    return applied_now
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,11 @@
+-- Durable webhook queue (webhooks.enqueue / webhooks.drain)
+CREATE TABLE IF NOT EXISTS webhook_events (
+    id VARCHAR(255) PRIMARY KEY,
+    type VARCHAR(255) NOT NULL,
+    payload TEXT NOT NULL,
+    received_at TIMESTAMP,
+    processed_at TIMESTAMP,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error VARCHAR(1024)
+);
+CREATE INDEX IF NOT EXISTS ix_webhook_events_pending ON webhook_events (processed_at, received_at);
@@ -0,0 +1,6 @@
+-- Local projection of the Stripe subscription
+ALTER TABLE subscription ADD COLUMN IF NOT EXISTS stripe_subscription_id VARCHAR;
+ALTER TABLE subscription ADD COLUMN IF NOT EXISTS payment_method_id VARCHAR;
+ALTER TABLE subscription ADD COLUMN IF NOT EXISTS is_paused BOOLEAN DEFAULT FALSE;
+ALTER TABLE subscription ADD COLUMN IF NOT EXISTS cancel_at_period_end BOOLEAN DEFAULT FALSE;
+ALTER TABLE subscription ADD COLUMN IF NOT EXISTS synced_at TIMESTAMP;
@@ -0,0 +1,10 @@
+-- Fixed-length digest of the rejected token, backfilled from the stored token
+ALTER TABLE rejected_tokens ADD COLUMN IF NOT EXISTS token_digest VARCHAR(64);
+UPDATE rejected_tokens SET token_digest = encode(sha256(convert_to(token, 'UTF8')), 'hex') WHERE token_digest IS NULL;
+ALTER TABLE rejected_tokens ALTER COLUMN token_digest SET NOT NULL;
+
+-- Built concurrently so the tables stay writable while the indexes are created
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_rejected_tokens_token_digest ON rejected_tokens (token_digest);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_rejected_tokens_created_at ON rejected_tokens (created_at);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscription_user_id_active ON subscription (user_id, active);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscription_stripe_customer_id ON subscription (stripe_customer_id);
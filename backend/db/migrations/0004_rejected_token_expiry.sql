@@ -0,0 +1,6 @@
+-- Revocations only matter until the token's exp. Existing rows get created_at plus the
+-- 24 hour token lifetime, which is never earlier than the real exp.
+ALTER TABLE rejected_tokens ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP;
+UPDATE rejected_tokens SET expires_at = created_at + interval '1 day' WHERE expires_at IS NULL;
+ALTER TABLE rejected_tokens ALTER COLUMN expires_at SET NOT NULL;
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_rejected_tokens_expires_at ON rejected_tokens (expires_at);
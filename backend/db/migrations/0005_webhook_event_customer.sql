@@ -0,0 +1,8 @@
+-- The Stripe customer of each queued event, so workers on several nodes claim the events of
+-- different customers in parallel (webhooks.drain). Pending events are backfilled from their payload.
+ALTER TABLE webhook_events ADD COLUMN IF NOT EXISTS customer_id VARCHAR(255);
+UPDATE webhook_events SET customer_id = CASE
+    WHEN payload::json #>> '{data,object,object}' = 'customer' THEN payload::json #>> '{data,object,id}'
+    WHEN json_typeof(payload::json #> '{data,object,customer}') = 'string' THEN payload::json #>> '{data,object,customer}'
+END
+WHERE processed_at IS NULL AND customer_id IS NULL;
@@ -0,0 +1,23 @@
+-- Access flags read by /payment-details and the account state. Existing users keep access
+-- while they have an active subscription.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS access BOOLEAN;
+UPDATE users SET access = EXISTS (
+    SELECT 1 FROM subscription WHERE subscription.user_id = users.id AND subscription.active
+) WHERE access IS NULL;
+ALTER TABLE users ALTER COLUMN access SET DEFAULT FALSE;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS is_beta_user BOOLEAN DEFAULT FALSE;
+
+-- Retry state of subscriptions whose payment failed (stripe_db.handle_payment_failed, dunning.run_due)
+CREATE TABLE IF NOT EXISTS dunning_schedule (
+    subscription_id UUID PRIMARY KEY REFERENCES subscription (id) ON DELETE CASCADE,
+    stripe_customer_id VARCHAR(255) NOT NULL,
+    invoice_id VARCHAR(255) NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    failed_at TIMESTAMP NOT NULL,
+    grace_ends_at TIMESTAMP NOT NULL,
+    due_at TIMESTAMP,
+    revoked_at TIMESTAMP,
+    last_error VARCHAR(1024)
+);
+-- Only entries still waiting for a retry or for their grace period to end are indexed
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dunning_schedule_due_at ON dunning_schedule (due_at) WHERE due_at IS NOT NULL;
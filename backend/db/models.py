@@ -1,7 +1,8 @@
 import datetime
 import uuid
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, Text, Index, text
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
 from backend.utils.mysql_uuid import GUID
 
 Base = declarative_base()
@@ -23,6 +24,10 @@ class User(Base):
     target_score = Column(Integer)
     role = Column(Integer)
     is_subscribed = Column(Boolean, default=False)
+    access = Column(Boolean, default=False)  # Granted with a subscription, revoked when its grace period ends
+    is_beta_user = Column(Boolean, default=False)
+    # Loaded together with the user by stripe_db.load_user; a user has at most one subscription
+    subscription = relationship("Subscription", uselist=False, viewonly=True)
 
     def __repr__(self):
         return f"<User {self.email}>"
@@ -48,10 +53,17 @@ class RejectedToken(Base):
     Data model for rejected Tokens
     """
     __tablename__ = "rejected_tokens"
+    __table_args__ = (
+        Index("ix_rejected_tokens_token_digest", "token_digest"),
+        Index("ix_rejected_tokens_created_at", "created_at"),
+        Index("ix_rejected_tokens_expires_at", "expires_at"),
+    )
 
     id = Column(GUID, primary_key=True, default=uuid.uuid4)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     token = Column(String(1024), nullable=False)
+    token_digest = Column(String(64), nullable=False)  # SHA-256 hex of token, used for lookups
+    expires_at = Column(DateTime, nullable=False)  # The token's exp; the row can be purged after it
 
     def __repr__(self):
         return f"<Token {self.token}>"
@@ -62,6 +74,11 @@ class Subscription(Base):
     Subscription Table
     """
     __tablename__ = "subscription"
+    __table_args__ = (
+        # Also serves lookups on user_id alone as the leading column
+        Index("ix_subscription_user_id_active", "user_id", "active"),
+        Index("ix_subscription_stripe_customer_id", "stripe_customer_id"),
+    )
 
     id = Column(GUID, primary_key=True, default=uuid.uuid4)
     price_id = Column(String, nullable=False)
@@ -73,3 +90,54 @@ class Subscription(Base):
     last_four_card = Column(String, nullable=True)
     auto_renew_date = Column(String, nullable=True)
     stripe_customer_id = Column(String, nullable=True)
+    # Projection of the Stripe subscription, kept current by webhooks and reconciliation
+    stripe_subscription_id = Column(String, nullable=True)
+    payment_method_id = Column(String, nullable=True)
+    is_paused = Column(Boolean, default=False)
+    cancel_at_period_end = Column(Boolean, default=False)
+    synced_at = Column(DateTime, nullable=True)
+
+
+class WebhookEvent(Base):
+    """
+    Verified Stripe webhook events queued for background processing
+    """
+    __tablename__ = "webhook_events"
+    __table_args__ = (
+        Index("ix_webhook_events_pending", "processed_at", "received_at"),
+    )
+
+    id = Column(String(255), primary_key=True)  # Stripe event ID, used to dedupe retries
+    type = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)
+    received_at = Column(DateTime, default=datetime.datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(String(1024), nullable=True)
+    customer_id = Column(String(255), nullable=True)  # Events of one customer are processed by one node at a time
+
+    def __repr__(self):
+        return f"<WebhookEvent {self.id} {self.type}>"
+
+
+class DunningEntry(Base):
+    """
+    Retry state of a subscription whose payment failed
+    """
+    __tablename__ = "dunning_schedule"
+    __table_args__ = (
+        Index("ix_dunning_schedule_due_at", "due_at", postgresql_where=text("due_at IS NOT NULL")),
+    )
+
+    subscription_id = Column(GUID, ForeignKey("subscription.id", ondelete="CASCADE"), primary_key=True)
+    stripe_customer_id = Column(String(255), nullable=False)
+    invoice_id = Column(String(255), nullable=False)  # The latest failed invoice, paid again on each retry
+    attempts = Column(Integer, default=0, nullable=False)  # Retries made so far
+    failed_at = Column(DateTime, nullable=False)
+    grace_ends_at = Column(DateTime, nullable=False)
+    due_at = Column(DateTime, nullable=True)  # The next retry or the end of the grace period; None once revoked
+    revoked_at = Column(DateTime, nullable=True)
+    last_error = Column(String(1024), nullable=True)
+
+    def __repr__(self):
+        return f"<DunningEntry {self.subscription_id} {self.attempts}>"
@@ -0,0 +1,53 @@
+import threading
+
+
+class PoolMetrics:
+    """
+    Tracks connection checkout latency and saturation for an engine's pool.
+    """
+
+    def __init__(self, engine, name):
+        """
+        Initializes the metrics.
+
+        Args:
+          engine (Engine): The engine whose QueuePool is observed.
+          name (str): A label for the pool, e.g. "primary" or "replica".
+        """
+        self.engine = engine
+        self.name = name
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def observe_checkout(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += seconds
+            self.max_wait = max(self.max_wait, seconds)
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self):
+        """
+        Returns the current counters together with the pool's occupancy.
+        """
+        pool = self.engine.pool
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        checked_out = pool.checkedout()
+        with self._lock:
+            return {
+                "pool": self.name,
+                "size": pool.size(),
+                "checked_out": checked_out,
+                "overflow": pool.overflow(),
+                "saturation": checked_out / capacity if capacity else 0.0,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "avg_wait_ms": 1000 * self.total_wait / self.checkouts if self.checkouts else 0.0,
+                "max_wait_ms": 1000 * self.max_wait,
+            }
@@ -0,0 +1,146 @@
+"""
+Bulk reconciliation of the subscription table against Stripe.
+
+Usage:
+    python -m backend.db.reconcile [--batch-size 500] [--dry-run]
+"""
+import time
+import argparse
+from datetime import datetime
+
+from backend.config import Config
+from backend.db import stripe_db, stripe_gateway
+from backend.db.models import Subscription
+from backend.utils.lazy import lazy_import
+
+stripe = lazy_import("stripe")
+
+conf = Config()
+
+COMPARED_COLUMNS = (
+    "stripe_subscription_id",
+    "payment_method_id",
+    "last_four_card",
+    "auto_renew_date",
+    "is_paused",
+    "cancel_at_period_end",
+    "active",
+)
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def reconcile_chunk(objs, dry_run=False, claimed=None):
+    """
+    Compares one page of Stripe subscriptions with their local rows using a
+    single query and writes the differences back in bulk.
+
+    Args:
+      objs (list): Stripe subscriptions, newest first.
+      dry_run (bool): Compare without writing.
+      claimed (set): IDs of the rows already matched to a subscription
+        earlier in the run, updated in place. Rows in it are skipped, so an
+        older subscription on a later page never replaces a newer one.
+
+    Returns:
+      A tuple of (updated, unchanged, missing) row counts.
+    """
+    claimed = set() if claimed is None else claimed
+    now = datetime.utcnow()
+    with stripe_db.session_scope() as sess:
+        rows = (
+            sess.query(Subscription.id, Subscription.stripe_customer_id, *[
+                getattr(Subscription, column) for column in COMPARED_COLUMNS
+            ])
+            .filter(Subscription.stripe_customer_id.in_({obj["customer"] for obj in objs}))
+            .all()
+        )
+        by_customer = {row.stripe_customer_id: row for row in rows}
+        updates = []
+        unchanged = []
+        missing = 0
+        for obj in objs:
+            row = by_customer.get(obj["customer"])
+            if row is None:
+                missing += 1
+                continue
+            # Stripe lists newest first, so the first subscription seen for a customer wins
+            # and older canceled ones never replace the subscription a row points at
+            if row.id in claimed:
+                continue
+            if row.stripe_subscription_id not in (None, obj["id"]) and obj.get("status") in stripe_db.ENDED_STATUSES:
+                continue
+            claimed.add(row.id)
+            fields = stripe_db.subscription_fields(obj)
+            changes = {
+                name: value for name, value in fields.items()
+                if getattr(row, name) != value
+            }
+            if changes:
+                updates.append(dict(changes, id=row.id, synced_at=now))
+            else:
+                unchanged.append(row.id)
+        if not dry_run:
+            if updates:
+                sess.bulk_update_mappings(Subscription, updates)
+            if unchanged:
+                (
+                    sess.query(Subscription)
+                    .filter(Subscription.id.in_(unchanged))
+                    .update({"synced_at": now}, synchronize_session=False)
+                )
+        else:
+            sess.rollback()
+        return len(updates), len(unchanged), missing
+
+
+def stream_subscriptions():
+    # Pages explicitly so each page request goes through the gateway's retry policy
+    params = {"status": "all", "limit": 100, "expand": ["data.default_payment_method"]}
+    while True:
+        page = stripe_gateway.read(stripe.Subscription.list, **params)
+        yield from page.data
+        if not page.has_more or not page.data:
+            return
+        params["starting_after"] = page.data[-1].id
+
+
+def reconcile_all(batch_size=500, dry_run=False):
+    subscriptions = stream_subscriptions()
+    start = time.monotonic()
+    processed = updated = unchanged = missing = 0
+    # Stripe lists newest first across pages too; the first subscription seen for a row wins for the whole run
+    claimed = set()
+    for objs in _chunks(subscriptions, batch_size):
+        chunk_updated, chunk_unchanged, chunk_missing = reconcile_chunk(objs, dry_run, claimed)
+        processed += len(objs)
+        updated += chunk_updated
+        unchanged += chunk_unchanged
+        missing += chunk_missing
+        elapsed = time.monotonic() - start
+        print(
+            f"{processed} subscriptions: {updated} updated, {unchanged} unchanged, "
+            f"{missing} missing locally ({processed / elapsed:.0f}/s)"
+        )
+    return {"processed": processed, "updated": updated, "unchanged": unchanged, "missing": missing}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reconcile the subscription table against Stripe.")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="Report differences without writing them")
+    args = parser.parse_args()
+    reconcile_all(args.batch_size, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
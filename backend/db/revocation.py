@@ -0,0 +1,87 @@
+import time
+import hashlib
+import threading
+
+from backend.utils.lazy import lazy_import
+
+jwt = lazy_import("jwt")
+
+# Fallback lifetime for tokens whose exp claim cannot be read; matches generate_token
+DEFAULT_TOKEN_LIFETIME = 86400
+
+_lock = threading.Lock()
+_revoked = {}  # token digest -> exp timestamp
+_publisher = None
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def token_expiry(token):
+    try:
+        claims = jwt.decode(token, options={"verify_signature": False, "verify_exp": False})
+        return int(claims["exp"])
+    except (jwt.exceptions.DecodeError, KeyError, TypeError, ValueError):
+        return int(time.time()) + DEFAULT_TOKEN_LIFETIME
+
+
+def add(token):
+    add_digest(token_digest(token), token_expiry(token))
+
+
+def add_digest(digest, exp):
+    if exp <= time.time():
+        return
+    with _lock:
+        _revoked[digest] = exp
+
+
+def set_publisher(publish):
+    # publish(sess, digest, exp) broadcasts a revocation to the other workers from the
+    # transaction recording it; None leaves them to the periodic sync
+    global _publisher
+    _publisher = publish
+
+
+def publish(sess, digest, exp):
+    if _publisher is not None:
+        _publisher(sess, digest, exp)
+
+
+def warm(entries):
+    # entries is an iterable of (digest, exp timestamp) pairs
+    now = time.time()
+    live = {digest: exp for digest, exp in entries if exp > now}
+    with _lock:
+        _revoked.update(live)
+    return len(live)
+
+
+def contains(token):
+    return contains_digest(token_digest(token))
+
+
+def contains_digest(digest):
+    with _lock:
+        exp = _revoked.get(digest)
+        if exp is None:
+            return False
+        if exp <= time.time():
+            del _revoked[digest]
+            return False
+        return True
+
+
+def purge_expired():
+    now = time.time()
+    with _lock:
+        expired = [digest for digest, exp in _revoked.items() if exp <= now]
+        for digest in expired:
+            del _revoked[digest]
+    return len(expired)
+
+
+def size():
+    with _lock:
+        return len(_revoked)
@@ -0,0 +1,227 @@
+import time
+import uuid
+import asyncio
+from urllib.parse import urlencode
+
+from backend.config import Config
+from backend.db import instrumentation
+from backend.db.stripe_gateway import backoff_delay, is_retryable
+from backend.utils.lazy import lazy_import
+
+# Both are only imported once the client is first used
+httpx = lazy_import("httpx")
+stripe = lazy_import("stripe")
+
+conf = Config()
+
+
+def encode_params(params, prefix=None):
+    """
+    Flattens nested params into the bracketed form-encoding the Stripe API
+    expects, e.g. {"metadata": {"a": 1}} becomes [("metadata[a]", "1")].
+    """
+    pairs = []
+    for key, value in params.items():
+        name = f"{prefix}[{key}]" if prefix else key
+        pairs.extend(_encode_value(name, value))
+    return pairs
+
+
+def _encode_value(name, value):
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return encode_params(value, name)
+    if isinstance(value, (list, tuple)):
+        pairs = []
+        for index, item in enumerate(value):
+            pairs.extend(_encode_value(f"{name}[{index}]", item))
+        return pairs
+    if isinstance(value, bool):
+        return [(name, "true" if value else "false")]
+    return [(name, str(value))]
+
+
+def error_from_response(status, body, text, headers):
+    """
+    Builds the exception the Stripe SDK raises for an error answer, chosen
+    by status and error type the way the SDK does, so callers catch the
+    same classes on the sync and async paths.
+    """
+    error = body.get("error") if isinstance(body, dict) else None
+    error = error if isinstance(error, dict) else {}
+    message = error.get("message") or f"Stripe API error (HTTP {status})"
+    code = error.get("code")
+    details = {"http_body": text, "http_status": status, "json_body": body, "headers": headers}
+    if status == 429 or (status == 400 and code == "rate_limit"):
+        return stripe.error.RateLimitError(message, code=code, **details)
+    if status in (400, 404):
+        if error.get("type") == "idempotency_error":
+            return stripe.error.IdempotencyError(message, code=code, **details)
+        return stripe.error.InvalidRequestError(message, error.get("param"), code, **details)
+    if status == 401:
+        return stripe.error.AuthenticationError(message, code=code, **details)
+    if status == 402:
+        return stripe.error.CardError(message, error.get("param"), code, **details)
+    if status == 403:
+        return stripe.error.PermissionError(message, code=code, **details)
+    return stripe.error.APIError(message, code=code, **details)
+
+
+class AsyncStripeClient:
+    """
+    A minimal async client for the Stripe REST API that keeps a pool of
+    keep-alive connections open for the lifetime of the app.
+
+    Requests share the gateway policies of the sync path: a cap on in-flight
+    requests, jittered retries of 429 and 5xx answers, idempotency keys on
+    POSTs, and single-flight merging of identical concurrent GETs.
+    """
+
+    def __init__(self, api_key, api_base="https://api.stripe.com", max_connections=20, timeout=30,
+                 max_in_flight=20, max_retries=3):
+        """
+        Initializes the client.
+
+        Args:
+          api_key (str): The Stripe secret key.
+          api_base (str): The base URL of the API, overridable to point the
+            client at a local fake Stripe server.
+          max_connections (int): The size of the connection pool.
+          timeout (float): The per-request timeout in seconds.
+          max_in_flight (int): The maximum number of concurrent requests.
+          max_retries (int): How many times a retryable failure is retried.
+        """
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._max_retries = max_retries
+        self._flights = {}
+        self._http = httpx.AsyncClient(
+            base_url=api_base,
+            headers={"Authorization": f"Bearer {api_key}"},
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            ),
+            timeout=timeout,
+        )
+
+    async def request(self, method, path, params=None, idempotency_key=None):
+        """
+        Sends a request and returns the decoded JSON body.
+
+        Raises:
+          stripe.error.StripeError: The SDK's error class for the answer,
+            e.g. RateLimitError for a 429 still answered after retrying,
+            CardError for a 402, or APIError for a 5xx or an unreadable
+            body.
+        """
+        pairs = encode_params(params or {})
+        if method == "GET":
+            # Identical concurrent GETs share one request
+            key = (path, tuple(pairs))
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = asyncio.ensure_future(self._send(method, path, pairs))
+                flight.add_done_callback(lambda _: self._flights.pop(key, None))
+            return await asyncio.shield(flight)
+        if method == "POST" and not idempotency_key:
+            idempotency_key = str(uuid.uuid4())
+        return await self._send(method, path, pairs, idempotency_key)
+
+    async def _send(self, method, path, pairs, idempotency_key=None):
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    return await self._send_once(method, path, pairs, idempotency_key)
+            except stripe.error.StripeError as e:
+                if attempt >= self._max_retries or not is_retryable(e):
+                    raise
+                delay = backoff_delay(attempt, e)
+            except httpx.TransportError:
+                if attempt >= self._max_retries:
+                    raise
+                delay = backoff_delay(attempt)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _send_once(self, method, path, pairs, idempotency_key):
+        headers = {}
+        if idempotency_key:
+            headers["Idempotency-Key"] = idempotency_key
+        start = time.perf_counter()
+        status = "error"
+        try:
+            if method in ("GET", "DELETE"):
+                response = await self._http.request(method, path, params=pairs, headers=headers)
+            else:
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+                response = await self._http.request(method, path, content=urlencode(pairs), headers=headers)
+            status = "ok" if response.status_code < 400 else response.status_code
+        finally:
+            operation = instrumentation.stripe_operation(method, path)
+            instrumentation.observe_stripe(operation, status, time.perf_counter() - start)
+        try:
+            body = response.json()
+        except ValueError:
+            # e.g. an HTML or empty 5xx page from a proxy in front of Stripe
+            body = None
+        if response.status_code >= 400:
+            raise error_from_response(response.status_code, body, response.text, dict(response.headers))
+        if body is None:
+            raise stripe.error.APIError(
+                "Invalid response body from Stripe",
+                http_body=response.text,
+                http_status=response.status_code,
+                headers=dict(response.headers),
+            )
+        return body
+
+    async def get(self, path, **params):
+        return await self.request("GET", path, params)
+
+    async def post(self, path, idempotency_key=None, **params):
+        return await self.request("POST", path, params, idempotency_key=idempotency_key)
+
+    async def delete(self, path, **params):
+        return await self.request("DELETE", path, params)
+
+    async def list_all(self, path, **params):
+        """
+        Iterates over every object of a list endpoint, following pagination.
+        """
+        params.setdefault("limit", 100)
+        while True:
+            page = await self.get(path, **params)
+            for obj in page["data"]:
+                yield obj
+            if not page.get("has_more") or not page["data"]:
+                return
+            params["starting_after"] = page["data"][-1]["id"]
+
+    async def aclose(self):
+        await self._http.aclose()
+
+
+_client = None
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = AsyncStripeClient(
+            conf.STRIPE_SECRET_KEY,
+            api_base=conf.STRIPE_API_BASE,
+            max_connections=conf.STRIPE_MAX_CONNECTIONS,
+            timeout=conf.STRIPE_TIMEOUT,
+            max_in_flight=conf.STRIPE_MAX_IN_FLIGHT,
+            max_retries=conf.STRIPE_MAX_RETRIES,
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -1,18 +1,31 @@
-import jwt
+import time
 import uuid
-import stripe
+import hashlib
+import logging
+import threading
 from contextlib import contextmanager
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.orm import sessionmaker
-from datetime import datetime, timedelta
-from sqlalchemy import create_engine
+from sqlalchemy.orm import joinedload, object_session, sessionmaker
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import create_engine, event, inspect, select
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
 from backend.config import Config
+from backend.db import coordination, instrumentation, revocation, stripe_gateway
+from backend.db.pool_metrics import PoolMetrics
 from backend.db.models import (
+    DunningEntry,
     RejectedToken,
     User,
     Subscription
 )
+from backend.utils import cache
+from backend.utils.lazy import lazy_import
+
+jwt = lazy_import("jwt")
+stripe = lazy_import("stripe")
+
+logger = logging.getLogger(__name__)
 
 conf = Config()
 db_host = conf.DB_HOST
@@ -22,14 +35,134 @@ db_pass = conf.DB_PASSWORD
 db_name = conf.DB_NAME
 
 DATABASE_URI = f"postgresql://{db_user}:{db_pass}@{db_host}:{db_port}/{db_name}"
-Session = sessionmaker(bind=create_engine(DATABASE_URI))
+
+
+def _create_engine(uri):
+    return create_engine(
+        uri,
+        pool_size=conf.DB_POOL_SIZE,
+        max_overflow=conf.DB_MAX_OVERFLOW,
+        pool_timeout=conf.DB_POOL_TIMEOUT,
+        pool_recycle=conf.DB_POOL_RECYCLE,
+        pool_pre_ping=conf.DB_POOL_PRE_PING,
+    )
+
+
+class _Database:
+    # The engines, session factories and pool metrics, created together on first use
+    def __init__(self):
+        self.engine = _create_engine(DATABASE_URI)
+        self.Session = sessionmaker(bind=self.engine)
+        self.pool_metrics = [PoolMetrics(self.engine, "primary")]
+        instrumentation.instrument_engine(self.engine, "primary")
+
+        # Read-only helpers use the replica when one is configured, the primary otherwise
+        if conf.DB_REPLICA_HOST:
+            replica_uri = (
+                f"postgresql://{db_user}:{db_pass}@{conf.DB_REPLICA_HOST}:{conf.DB_REPLICA_PORT or db_port}/{db_name}"
+            )
+            self.read_engine = _create_engine(replica_uri)
+            self.pool_metrics.append(PoolMetrics(self.read_engine, "replica"))
+            instrumentation.instrument_engine(self.read_engine, "replica")
+        else:
+            self.read_engine = self.engine
+        self.ReadSession = sessionmaker(bind=self.read_engine)
+
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def database():
+    # Created lazily so importing the app needs neither a database nor its driver
+    global _database
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                _database = _Database()
+    return _database
+
+
+def get_engine():
+    return database().engine
+
+
+def get_read_engine():
+    return database().read_engine
+
+
+def warm_pool():
+    # Opens the first connection ahead of the first request
+    with get_engine().connect():
+        pass
+
+
+def dispose_engines():
+    global _database
+    with _database_lock:
+        if _database is not None:
+            _database.engine.dispose()
+            _database.read_engine.dispose()
+            _database = None
+
+
+def _cache_backend():
+    if conf.CACHE_BACKEND == "shm":
+        from backend.utils.shm_cache import SharedMemoryBackend
+
+        return SharedMemoryBackend(conf.CACHE_SHM_PATH, conf.CACHE_SHM_SLOTS, conf.CACHE_SHM_SLOT_SIZE)
+    if conf.CACHE_BACKEND == "network":
+        from backend.utils.network_cache import NetworkBackend
+
+        return NetworkBackend(conf.CACHE_URL, conf.CACHE_NETWORK_TIMEOUT, conf.CACHE_KEY_PREFIX)
+    if conf.CACHE_BACKEND != "memory":
+        raise ValueError(f"Unknown CACHE_BACKEND: {conf.CACHE_BACKEND}")
+    return cache.MemoryBackend()
+
+
+cache.configure(_cache_backend)
+# The price index is the whole active catalog in one entry, read by every checkout. It stays in each
+# process: too large for a shm slot, and costly to decode from a network cache on every read.
+catalog_cache = cache.Cache("catalog", maxsize=64, ttl=conf.CATALOG_CACHE_TTL, local=True)
+customer_cache = cache.Cache("customers", maxsize=conf.CUSTOMER_CACHE_SIZE, ttl=conf.CUSTOMER_CACHE_TTL)
+# Open checkout sessions keyed by (email, cart), reused by repeated checkout clicks
+checkout_cache = cache.Cache("checkout", maxsize=conf.CUSTOMER_CACHE_SIZE, ttl=conf.CHECKOUT_SESSION_CACHE_TTL)
+# What /renewtoken puts in a token, by email, so renewing needs no query
+account_cache = cache.Cache("accounts", maxsize=conf.CUSTOMER_CACHE_SIZE, ttl=conf.CUSTOMER_CACHE_TTL)
+
+
+def _checkout(session, metrics):
+    # Check the connection out up front so pool wait time is measured
+    start = time.perf_counter()
+    try:
+        session.connection()
+    except PoolTimeoutError:
+        metrics.observe_timeout()
+        raise
+    metrics.observe_checkout(time.perf_counter() - start)
+
+
+def pool_status():
+    # Reporting metrics does not create the engines
+    if _database is None:
+        return []
+    return [metrics.snapshot() for metrics in _database.pool_metrics]
+
+
+instrumentation.export_pools(pool_status)
 
 
 @contextmanager
-def session_scope():
-    session = Session()
+def session_scope(sess=None):
+    # Helpers passed a request's unit-of-work session reuse it; it is committed by its owner
+    if sess is not None:
+        yield sess
+        return
+    db = database()
+    session = db.Session()
     session.expire_on_commit = False
     try:
+        _checkout(session, db.pool_metrics[0])
         yield session
         session.commit()
     except Exception:
@@ -39,44 +172,214 @@ def session_scope():
         session.close()
 
 
-def is_rejected(token):
-    with session_scope() as sess:
-        token = sess.query(RejectedToken).filter(RejectedToken.token == token).first()
-        if token:
-            return True
-        return False
+@contextmanager
+def read_session_scope(sess=None):
+    if sess is not None:
+        yield sess
+        return
+    db = database()
+    session = db.ReadSession()
+    session.expire_on_commit = False
+    try:
+        _checkout(session, db.pool_metrics[-1])
+        yield session
+    finally:
+        # close() ends the read transaction without expiring what was loaded, as rollback() would
+        session.close()
+
+
+_revocations_synced_at = None
+_revocations_lock = threading.Lock()
+
+
+def _revocation_entries(query):
+    # Only unexpired revocations matter; expired tokens already fail jwt.decode
+    rows = query.filter(RejectedToken.expires_at > datetime.utcnow())
+    return [
+        (row.token_digest, row.expires_at.replace(tzinfo=timezone.utc).timestamp())
+        for row in rows
+    ]
+
+
+def _load_revocations():
+    global _revocations_synced_at
+    synced_at = datetime.utcnow()
+    with read_session_scope() as sess:
+        entries = _revocation_entries(sess.query(RejectedToken.token_digest, RejectedToken.expires_at))
+    revocation.warm(entries)
+    _revocations_synced_at = synced_at
+
+
+def warm_revocation_cache():
+    with _revocations_lock:
+        _load_revocations()
+
+
+def sync_revocation_cache():
+    # Pick up tokens rejected by other workers since the last sync: all of them without CACHE_INVALIDATION,
+    # otherwise those whose broadcast was missed
+    global _revocations_synced_at
+    if _revocations_synced_at is None:
+        # Requests arriving while the startup warm-up runs wait for it instead of each loading the table
+        with _revocations_lock:
+            if _revocations_synced_at is None:
+                _load_revocations()
+        return
+    synced_at = datetime.utcnow()
+    if synced_at - _revocations_synced_at < timedelta(seconds=conf.REVOCATION_SYNC_SECONDS):
+        return
+    # Overlap one interval so rows stamped by a worker with a lagging clock are not missed
+    since = _revocations_synced_at - timedelta(seconds=conf.REVOCATION_SYNC_SECONDS)
+    _revocations_synced_at = synced_at
+    with read_session_scope() as sess:
+        entries = _revocation_entries(
+            sess.query(RejectedToken.token_digest, RejectedToken.expires_at)
+            .filter(RejectedToken.created_at >= since)
+        )
+    revocation.warm(entries)
+    revocation.purge_expired()
+
+
+def is_rejected(token, digest=None):
+    sync_revocation_cache()
+    return revocation.contains_digest(digest or revocation.token_digest(token))
 
 
-def find_user_by_email(email):
-    with session_scope() as sess:
+def find_user_by_email(email, sess=None):
+    with read_session_scope(sess) as sess:
         return sess.query(User).filter(User.email == email).one_or_none()
 
 
-def reject_token(token):
-    with session_scope() as sess:
-        rejected_token = RejectedToken(token=token)
-        sess.add(rejected_token)
+def load_user(email, sess=None):
+    # The user and their subscription in one query
+    with read_session_scope(sess) as sess:
+        return (
+            sess.query(User)
+            .options(joinedload(User.subscription))
+            .filter(User.email == email)
+            .one_or_none()
+        )
+
 
+def reject_token(token, sess=None):
+    with session_scope(sess) as sess:
+        digest = revocation.token_digest(token)
+        already_rejected = sess.query(
+            sess.query(RejectedToken).filter(RejectedToken.token_digest == digest).exists()
+        ).scalar()
+        exp = revocation.token_expiry(token)
+        if not already_rejected:
+            sess.add(RejectedToken(
+                token=token,
+                token_digest=digest,
+                expires_at=datetime.utcfromtimestamp(exp),
+            ))
+            # Other workers refuse the token as soon as this commits, not at their next sync
+            revocation.publish(sess, digest, exp)
+    revocation.add_digest(digest, exp)
+
+
+def purge_expired_rejected_tokens(batch_size):
+    # Deletes in short batches so the purge never holds long locks on the table
+    total = 0
+    while True:
+        with session_scope() as sess:
+            expired = (
+                sess.query(RejectedToken.id)
+                .filter(RejectedToken.expires_at <= datetime.utcnow())
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+                .subquery()
+            )
+            deleted = (
+                sess.query(RejectedToken)
+                .filter(RejectedToken.id.in_(select(expired.c.id)))
+                .delete(synchronize_session=False)
+            )
+        total += deleted
+        if deleted < batch_size:
+            return total
 
-def generate_token(user, role, is_subscribed) -> str:
+
+def generate_token(account) -> str:
+    # account is an account_state dict; the identity is also top-level, where jwt_auth reads it
+    now = int(time.time())
     payload = {
-        "sub": str(uuid.uuid1()),
-        "iat": datetime.timestamp(datetime.now()),
-        "exp": int(datetime.timestamp(datetime.now())) + 86400,
+        "sub": str(uuid.uuid4()),
+        "iat": now,
+        "exp": now + 86400,
+        "user-email": account["email"],
+        "user-name": account["first_name"],
         "user": {
-            "user-email": user.email,
-            "user-name": user.first_name,
-            "last_name": user.last_name,
+            "user-email": account["email"],
+            "user-name": account["first_name"],
+            "last_name": account["last_name"],
         },
-        "role_name": role,
-        "is_subscribed": is_subscribed
+        "role_name": account["role"],
+        "is_subscribed": account["is_subscribed"]
     }
     token = jwt.encode(payload, conf.JWT_SECRET, "HS256")
     return token
 
 
-def create_subscription(user_email, price_id, session_id, stripe_customer_id=None):
-    with session_scope() as sess:
+def account_state(user, subscription):
+    # A paused subscription still counts: pausing only stops the next renewals
+    subscribed = subscription is not None and bool(subscription.active or subscription.is_paused)
+    return {
+        "email": user.email,
+        "first_name": user.first_name,
+        "last_name": user.last_name,
+        "role": user.role_name,
+        "is_subscribed": bool(user.is_subscribed) or subscribed,
+    }
+
+
+def remember_account(user, subscription):
+    state = account_state(user, subscription)
+    account_cache.set(user.email, state)
+    return state
+
+
+def load_account(email, sess=None):
+    state = account_cache.get(email)
+    if state:
+        return state
+    user = load_user(email, sess)
+    if not user:
+        return None
+    return remember_account(user, user.subscription)
+
+
+def forget_account_on_commit(sess, email):
+    # After the commit, so no worker re-reads and caches the state being replaced
+    event.listen(sess, "after_commit", lambda _: account_cache.invalidate(email), once=True)
+
+
+def replace_account_on_commit(sess, email, state):
+    # Like forget_account_on_commit, then caches the state just committed so it is not re-read
+    def replace(_):
+        account_cache.invalidate(email)
+        account_cache.set(email, state)
+
+    event.listen(sess, "after_commit", replace, once=True)
+
+
+# Past this many accounts, one broadcast dropping the namespace is cheaper than one per email
+FORGET_ACCOUNTS_LIMIT = 50
+
+
+def forget_accounts_on_commit(sess, emails):
+    if len(emails) > FORGET_ACCOUNTS_LIMIT:
+        event.listen(sess, "after_commit", lambda _: account_cache.clear(), once=True)
+        return
+    for email in emails:
+        forget_account_on_commit(sess, email)
+
+
+def create_subscription(user_email, price_id, session_id, stripe_customer_id=None, sess=None):
+    with session_scope(sess) as sess:
+        if stripe_customer_id:
+            coordination.lock_customer(sess, stripe_customer_id)
         user = sess.query(User).filter(User.email == user_email).one_or_none()
         if user:
             subscribe_user = sess.query(Subscription).filter_by(user_id=user.id).one_or_none()
@@ -90,24 +393,24 @@ def create_subscription(user_email, price_id, session_id, stripe_customer_id=Non
                 )
                 sess.add(subscription)
             else:
-                subscribe_user.price_id = price_id,
-                subscribe_user.session_id = session_id,
-                subscribe_user.stripe_customer_id = stripe_customer_id,
+                subscribe_user.price_id = price_id
+                subscribe_user.session_id = session_id
+                subscribe_user.stripe_customer_id = stripe_customer_id
                 subscribe_user.active = True
             user.access = True
-            sess.commit()
+            forget_account_on_commit(sess, user_email)
 
 
-def update_user_subscription(user_email):
-    with session_scope() as sess:
+def update_user_subscription(user_email, sess=None):
+    with session_scope(sess) as sess:
         user = sess.query(User).filter(User.email == user_email).one_or_none()
         if user:
             user.is_subscribed = True
-            sess.commit()
+            forget_account_on_commit(sess, user_email)
 
 
-def add_subscription_detail(user_email):
-    with session_scope() as sess:
+def add_subscription_detail(user_email, sess=None):
+    with session_scope(sess) as sess:
         user = sess.query(User).filter(User.email == user_email).one_or_none()
         if user:
             subscribe_user = sess.query(Subscription).filter_by(user_id=user.id).one_or_none()
@@ -116,30 +419,166 @@ def add_subscription_detail(user_email):
                     start_date = datetime.utcnow()
                     expire_date = (start_date + timedelta(days=365)).strftime("%d-%m-%Y")
                     subscribe_user.auto_renew_date = expire_date
-                    charge = stripe.Charge.retrieve(subscribe_user.stripe_customer_id)
+                    charge = stripe_gateway.read(stripe.Charge.retrieve, subscribe_user.stripe_customer_id)
                     if charge and charge.payment_method_details:
                         subscribe_user.last_four_card = charge.payment_method_details["card"]["last4"]
                 else:
-                    detail = get_payment_details(user)
+                    detail = get_payment_details(user, sess)
                     subscribe_user.auto_renew_date = detail["next_renewal_date"]
                     subscribe_user.last_four_card = detail["last4"]
-            sess.commit()
+
+
+def invalidate_catalog():
+    catalog_cache.clear()
+
+
+PRICE_INDEX_KEY = "prices"
+
+
+def price_entry(price):
+    # The catalog fields of a Stripe price listed with its product expanded
+    product = price["product"]
+    return {
+        "price_id": price["id"],
+        "product_id": product["id"],
+        "product_name": product.get("name"),
+        "currency": price.get("currency"),
+        "mode": "subscription" if price.get("recurring") else "payment",
+    }
+
+
+def build_price_index(prices):
+    # Active prices by ID, and each product's default price by product name
+    index = {"built_at": time.time(), "prices": {}, "products": {}}
+    for price in prices:
+        entry = price_entry(price)
+        index["prices"][entry["price_id"]] = entry
+        product = price["product"]
+        if product.get("default_price") == price["id"]:
+            index["products"][product["name"]] = price["id"]
+    return index
+
+
+def price_index_is_stale(index):
+    # Carts naming an unknown price refresh the index, at most once per interval
+    return time.time() - index["built_at"] >= conf.PRICE_INDEX_REFRESH_SECONDS
+
+
+def resolve_cart(index, items):
+    # items are (price_id, product_name, quantity) tuples; a product name stands for its default price.
+    # Returns the merged Stripe line items, their price index entries, and the items that did not resolve.
+    quantities = {}
+    missing = []
+    for price_id, product_name, quantity in items:
+        if not price_id:
+            price_id = index["products"].get(product_name)
+        if price_id not in index["prices"]:
+            missing.append(price_id or product_name)
+            continue
+        quantities[price_id] = quantities.get(price_id, 0) + quantity
+    line_items = [{"price": price_id, "quantity": quantity} for price_id, quantity in quantities.items()]
+    entries = [index["prices"][price_id] for price_id in quantities]
+    return line_items, entries, missing
+
+
+def checkout_mode(entries):
+    # A subscription checkout may also carry one-time prices; a payment checkout may not carry recurring ones
+    return "subscription" if any(entry["mode"] == "subscription" for entry in entries) else "payment"
+
+
+def cart_key(line_items):
+    # Identifies a cart regardless of item order, for the checkout cache and idempotency keys
+    canonical = ",".join(f"{item['price']}:{item['quantity']}" for item in sorted(line_items, key=lambda i: i["price"]))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+
+def remember_customer(email, **fields):
+    entry = dict(customer_cache.get(email) or {})
+    entry.update(fields)
+    customer_cache.set(email, entry)
+    return entry
+
+
+def find_stripe_customer_id(email, sess=None):
+    with read_session_scope(sess) as sess:
+        row = (
+            sess.query(Subscription.stripe_customer_id)
+            .join(User, User.id == Subscription.user_id)
+            .filter(User.email == email, Subscription.stripe_customer_id != None)
+            .first()
+        )
+        return row.stripe_customer_id if row else None
+
+
+def resolve_customer(email):
+    # Local cache first, then the subscription table, and Stripe only on a miss
+    entry = customer_cache.get(email)
+    if entry:
+        return entry
+    customer_id = find_stripe_customer_id(email)
+    if customer_id:
+        return remember_customer(email, customer_id=customer_id)
+    customers = stripe_gateway.read(stripe.Customer.list, email=email, limit=1)
+    if not customers.data:
+        return None
+    return remember_customer(email, customer_id=customers.data[0].id)
+
+
+def refresh_customer(obj, sess=None):
+    # obj is the data object of a customer.* webhook event
+    if obj["object"] == "customer":
+        if obj.get("email"):
+            # Every worker drops its entry; the derived subscription ID is re-resolved lazily
+            customer_cache.invalidate(obj["email"])
+            if not obj.get("deleted"):
+                customer_cache.set(obj["email"], {"customer_id": obj["id"]})
+        return
+    customer_id = obj.get("customer")
+    if not customer_id:
+        return
+    with read_session_scope(sess) as sess:
+        row = (
+            sess.query(User.email)
+            .join(Subscription, Subscription.user_id == User.id)
+            .filter(Subscription.stripe_customer_id == customer_id)
+            .first()
+        )
+    if row:
+        customer_cache.invalidate(row.email)
+        customer_cache.set(row.email, {"customer_id": customer_id})
+
+
+def checkout_session_usable(session):
+    # Still open and not about to expire; a paid or expired session is never handed out again
+    return session.get("status", "open") == "open" and session["expires_at"] > time.time() + 60
+
+
+def forget_checkout_session(session):
+    # session is the data object of a checkout.session.* webhook event
+    metadata = session.get("metadata") or {}
+    key = metadata.get("cart")
+    if not key and metadata.get("price_id"):
+        # Sessions created before carts were keyed by their single price
+        key = cart_key([{"price": metadata["price_id"], "quantity": 1}])
+    if session.get("customer_email") and key:
+        checkout_cache.invalidate((session["customer_email"], key))
 
 
 def create_or_retrieve_stripe_customer(user_email, user_name):
     try:
-        existing_customers = stripe.Customer.list(email=user_email).data
-        if existing_customers:
-            return existing_customers[0].id
-        new_customer = stripe.Customer.create(email=user_email, name=user_name)
+        customer = resolve_customer(user_email)
+        if customer:
+            return customer["customer_id"]
+        new_customer = stripe_gateway.write(stripe.Customer.create, email=user_email, name=user_name)
+        remember_customer(user_email, customer_id=new_customer.id)
         return new_customer.id
     except stripe.error.StripeError as e:
-        print(f"Stripe API error: {e}")
+        logger.error("Stripe API error: %s", e)
         return None
 
 
-def update_payment_method(user, payment_method_id):
-    with session_scope() as sess:
+def update_payment_method(user, payment_method_id, sess=None):
+    with session_scope(sess) as sess:
         subscription = (
             sess.query(Subscription)
             .filter(Subscription.user_id == user.id, Subscription.active == True)
@@ -149,151 +588,319 @@ def update_payment_method(user, payment_method_id):
         if not subscription:
             raise Exception("Active subscription not found for user")
 
-        customer = stripe.Customer.retrieve(subscription.stripe_customer_id)
+        customer = stripe_gateway.read(stripe.Customer.retrieve, subscription.stripe_customer_id)
 
-        stripe.Customer.modify(
+        stripe_gateway.write(
+            stripe.Customer.modify,
             customer.id, invoice_settings={"default_payment_method": payment_method_id}
         )
 
 
-def get_payment_details(user):
-    try:
-        with session_scope() as sess:
-            subscription = (
-                sess.query(Subscription)
-                .filter(Subscription.user_id == user.id)
-                .one_or_none()
-            )
+def find_subscription(user_id, sess=None):
+    with read_session_scope(sess) as sess:
+        return sess.query(Subscription).filter(Subscription.user_id == user_id).one_or_none()
 
-            if not subscription:
-                return {"error": "Subscription not found"}
-            if user.is_beta_user == True:
-                return {
-                    "last4": subscription.last_four_card,
-                    "next_renewal_date": subscription.auto_renew_date,
-                    "is_paused": False,  # One-time product can't be paused
-                    "subscription_cancel": False,  # One-time purchase, no cancellation
-                    "active": user.access
-                }
-
-            customer = stripe.Customer.retrieve(
-                subscription.stripe_customer_id,
-                expand=["subscriptions.data.default_payment_method"],
-            )
 
-            if not customer.get("subscriptions") or not customer["subscriptions"].get("data"):
-                return {"error": "Subscription data not found for the customer"}
-            subscription_id = get_subscription_id_from_email(user.email)
-            subscription_data = [
-                sub for sub in customer["subscriptions"]["data"]
-                if sub["id"] == subscription_id
-            ]
-            if not subscription_data:
-                return {"error": "No relevant subscription data found"}
-
-            subscription_info = subscription_data[0]
-
-            default_payment_method = subscription_info.get("default_payment_method")
-            if not default_payment_method or not default_payment_method.get("card"):
-                return {"error": "Payment method details not found"}
-
-            last4 = default_payment_method["card"].get("last4")
-            next_renewal_date_timestamp = subscription_info.get("current_period_end")
-
-            if not last4 or not next_renewal_date_timestamp:
-                return {"error": "Incomplete payment details found"}
-
-            # Check if the subscription is paused
-            pause_collection = subscription_info.get("pause_collection")
-            is_paused = pause_collection is not None and pause_collection.get("behavior") is not None
-            subscription_cancel = subscription_info.get("cancel_at_period_end")
-            print(f"Pause Collection: {pause_collection}")  # Debugging output
-            print(f"Is Paused: {is_paused}")  # Debugging output
-
-            next_renewal_date = datetime.fromtimestamp(
-                next_renewal_date_timestamp
-            ).strftime("%d-%m-%Y")
-
-            return {
-                "last4": last4,
-                "next_renewal_date": next_renewal_date,
-                "is_paused": is_paused,
-                "subscription_cancel": subscription_cancel,
-                "active": user.access
-            }
+def subscription_of(user, sess=None):
+    # Reuses the subscription load_user fetched with the user, querying only when it was not loaded
+    if "subscription" in inspect(user).unloaded:
+        return find_subscription(user.id, sess)
+    return user.subscription
 
-    except stripe.error.StripeError as e:
-        print(f"Stripe API error: {e}")
-        return {"error": "Stripe API error occurred"}
-    except Exception as e:
-        print(f"Error retrieving payment details: {e}")
-        return {"error": "Error retrieving payment details"}
 
+def payment_details_from_customer(user, customer, subscription_id):
+    # customer is a Stripe customer with subscriptions.data.default_payment_method expanded
+    if not customer.get("subscriptions") or not customer["subscriptions"].get("data"):
+        return {"error": "Subscription data not found for the customer"}
+    subscription_data = [
+        sub for sub in customer["subscriptions"]["data"]
+        if sub["id"] == subscription_id
+    ]
+    if not subscription_data:
+        return {"error": "No relevant subscription data found"}
 
-def pause_auto_renewal(user):
-    with session_scope() as sess:
-        subscription = (
-            sess.query(Subscription)
-            .filter(Subscription.user_id == user.id, Subscription.active == True)
-            .one_or_none()
-        )
+    subscription_info = subscription_data[0]
+
+    default_payment_method = subscription_info.get("default_payment_method")
+    if not default_payment_method or not default_payment_method.get("card"):
+        return {"error": "Payment method details not found"}
+
+    last4 = default_payment_method["card"].get("last4")
+    next_renewal_date_timestamp = subscription_info.get("current_period_end")
+
+    if not last4 or not next_renewal_date_timestamp:
+        return {"error": "Incomplete payment details found"}
+
+    # Check if the subscription is paused
+    pause_collection = subscription_info.get("pause_collection")
+    is_paused = pause_collection is not None and pause_collection.get("behavior") is not None
+    subscription_cancel = subscription_info.get("cancel_at_period_end")
+    logger.debug("Pause collection of %s: %s (paused: %s)", subscription_id, pause_collection, is_paused)
+
+    next_renewal_date = datetime.fromtimestamp(
+        next_renewal_date_timestamp
+    ).strftime("%d-%m-%Y")
+
+    return {
+        "last4": last4,
+        "next_renewal_date": next_renewal_date,
+        "is_paused": is_paused,
+        "subscription_cancel": subscription_cancel,
+        "active": user.access
+    }
+
+
+def beta_payment_details(user, subscription):
+    return {
+        "last4": subscription.last_four_card,
+        "next_renewal_date": subscription.auto_renew_date,
+        "is_paused": False,  # One-time product can't be paused
+        "subscription_cancel": False,  # One-time purchase, no cancellation
+        "active": user.access
+    }
+
+
+def _renewal_date(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%d-%m-%Y")
+
+
+# Stripe statuses of a subscription that has ended for good, e.g. in customer.subscription.deleted
+ENDED_STATUSES = ("canceled", "incomplete_expired")
+
+
+def subscription_fields(obj):
+    # The subscription columns /payment-details needs, derived from a Stripe subscription
+    pause_collection = obj.get("pause_collection")
+    fields = {
+        "stripe_subscription_id": obj["id"],
+        "is_paused": bool(pause_collection and pause_collection.get("behavior")),
+        "cancel_at_period_end": bool(obj.get("cancel_at_period_end")),
+    }
+    if obj.get("status") in ENDED_STATUSES:
+        # An ended subscription is neither running nor paused, whatever pause_collection it kept
+        fields["active"] = False
+        fields["is_paused"] = False
+    if obj.get("current_period_end"):
+        fields["auto_renew_date"] = _renewal_date(obj["current_period_end"])
+    payment_method = obj.get("default_payment_method")
+    if payment_method and not isinstance(payment_method, str):
+        fields["payment_method_id"] = payment_method["id"]
+        if payment_method.get("card"):
+            fields["last_four_card"] = payment_method["card"]["last4"]
+    return fields
+
+
+def apply_stripe_subscription(subscription, obj):
+    fields = subscription_fields(obj)
+    if "active" in fields and subscription.stripe_subscription_id not in (None, obj["id"]):
+        # The end of a subscription this row has since replaced
+        return
+    ending = "active" in fields and bool(subscription.active)
+    if fields["is_paused"] != bool(subscription.is_paused) or ending:
+        # Pausing and ending change the account state /renewtoken caches
+        sess = object_session(subscription)
+        email = sess.query(User.email).filter(User.id == subscription.user_id).scalar()
+        if email:
+            forget_account_on_commit(sess, email)
+    payment_method = obj.get("default_payment_method")
+    if isinstance(payment_method, str) and payment_method != subscription.payment_method_id:
+        # Webhook payloads carry only the ID; look the card up once when it changes
+        card = stripe_gateway.read(stripe.PaymentMethod.retrieve, payment_method).get("card")
+        fields["payment_method_id"] = payment_method
+        fields["last_four_card"] = card["last4"] if card else None
+    for name, value in fields.items():
+        setattr(subscription, name, value)
+    subscription.synced_at = datetime.utcnow()
+
+
+def _find_by_customer(sess, customer_id):
+    return sess.query(Subscription).filter(Subscription.stripe_customer_id == customer_id).one_or_none()
+
+
+def project_subscription(obj, sess=None):
+    with session_scope(sess) as sess:
+        subscription = _find_by_customer(sess, obj["customer"])
         if subscription:
-            try:
-                subscription_id = get_subscription_id_from_email(user.email)
-                stripe.Subscription.modify(
-                    subscription_id,
-                    pause_collection={"behavior": "keep_as_draft"},
-                )
-                subscription.active = False
-                sess.commit()
-            except Exception as e:
-                print(f"Stripe API Error: {e}")
-                raise
+            apply_stripe_subscription(subscription, obj)
+
+
+def project_payment_method(obj, sess=None):
+    if not obj.get("customer") or not obj.get("card"):
+        return
+    with session_scope(sess) as sess:
+        subscription = _find_by_customer(sess, obj["customer"])
+        if subscription and subscription.payment_method_id in (None, obj["id"]):
+            subscription.payment_method_id = obj["id"]
+            subscription.last_four_card = obj["card"]["last4"]
+            subscription.synced_at = datetime.utcnow()
+
+
+def project_invoice(obj, sess=None):
+    lines = (obj.get("lines") or {}).get("data") or []
+    period_ends = [line["period"]["end"] for line in lines if line.get("period")]
+    if not obj.get("customer") or not period_ends:
+        return
+    with session_scope(sess) as sess:
+        subscription = _find_by_customer(sess, obj["customer"])
+        if subscription:
+            subscription.auto_renew_date = _renewal_date(max(period_ends))
+            subscription.synced_at = datetime.utcnow()
 
 
-def resume_auto_renewal(user):
-    with session_scope() as sess:
-        subscription = (
+def reconcile_subscriptions(limit, sess=None):
+    # Re-reads the least recently synced subscriptions from Stripe to repair drift
+    with session_scope(sess) as sess:
+        subscriptions = (
             sess.query(Subscription)
-            .filter(Subscription.user_id == user.id, Subscription.active == False)
-            .one_or_none()
+            .filter(Subscription.stripe_customer_id != None)
+            .order_by(Subscription.synced_at.asc().nullsfirst())
+            .limit(limit)
+            # Nodes reconciling at the same time take different rows instead of reading Stripe twice
+            .with_for_update(skip_locked=True)
+            .all()
         )
-        if subscription:
+        for subscription in subscriptions:
             try:
-                subscription_id = get_subscription_id_from_email(user.email)
-                # Use the recommended method from Stripe documentation
-                stripe.Subscription.modify(
-                    subscription_id,
-                    pause_collection='',
-                )
+                if subscription.stripe_subscription_id:
+                    obj = stripe_gateway.read(
+                        stripe.Subscription.retrieve,
+                        subscription.stripe_subscription_id, expand=["default_payment_method"]
+                    )
+                else:
+                    found = stripe_gateway.read(
+                        stripe.Subscription.list,
+                        customer=subscription.stripe_customer_id,
+                        limit=1,
+                        expand=["data.default_payment_method"],
+                    ).data
+                    if not found:
+                        subscription.synced_at = datetime.utcnow()
+                        continue
+                    obj = found[0]
+                apply_stripe_subscription(subscription, obj)
+            except stripe.error.StripeError as e:
+                logger.error("Stripe error reconciling subscription %s: %s", subscription.id, e)
+        return len(subscriptions)
+
+
+def projected_payment_details(user, subscription):
+    if not subscription.synced_at or not subscription.last_four_card or not subscription.auto_renew_date:
+        return None
+    return {
+        "last4": subscription.last_four_card,
+        "next_renewal_date": subscription.auto_renew_date,
+        "is_paused": bool(subscription.is_paused),
+        "subscription_cancel": bool(subscription.cancel_at_period_end),
+        "active": user.access
+    }
+
+
+def get_payment_details(user, sess=None):
+    try:
+        subscription = subscription_of(user, sess)
 
-                # Retrieve the updated subscription to verify the update
-                updated_subscription = stripe.Subscription.retrieve(subscription_id)
-                print("HERE", updated_subscription.pause_collection)  # Debugging output
+        if not subscription:
+            return {"error": "Subscription not found"}
+        if user.is_beta_user == True:
+            return beta_payment_details(user, subscription)
+        projected = projected_payment_details(user, subscription)
+        if projected:
+            return projected
+
+        customer = stripe_gateway.read(
+            stripe.Customer.retrieve,
+            subscription.stripe_customer_id,
+            expand=["subscriptions.data.default_payment_method"],
+        )
+        subscription_id = get_subscription_id_from_email(user.email)
+        return payment_details_from_customer(user, customer, subscription_id)
+
+    except stripe.error.StripeError as e:
+        logger.error("Stripe API error: %s", e)
+        return {"error": "Stripe API error occurred"}
+    except Exception:
+        logger.exception("Error retrieving payment details")
+        return {"error": "Error retrieving payment details"}
+
+
+class SubscriptionStateError(Exception):
+    """
+    The subscription is in no state the requested change applies to.
+    """
+
+
+# Stripe statuses of a subscription that is being paid for; past_due and unpaid ones are left to dunning
+ACTIVE_STATUSES = ("active", "trialing")
+
+
+def auto_renewal_paused(subscription):
+    # Paused here, in bulk, or from the customer portal as projected by webhooks
+    return bool(subscription.is_paused)
+
+
+def auto_renewal_toggleable(subscription):
+    # Running or paused; a cancelled subscription, or one whose access dunning revoked, is not resumed here
+    return bool(subscription.active) or bool(subscription.is_paused)
+
+
+def local_subscription_id(user, subscription):
+    # The projected ID, then the customer cache; only rows never projected ask Stripe
+    return subscription.stripe_subscription_id or get_subscription_id_from_email(user.email)
+
+
+def pause_collection_params(pause):
+    return {"pause_collection": {"behavior": "keep_as_draft"} if pause else ""}
+
+
+def record_auto_renewal(user, subscription, obj):
+    # Writes Stripe's answer to a modify through to the row; the caller commits, then caches the account
+    for name, value in subscription_fields(obj).items():
+        setattr(subscription, name, value)
+    if obj.get("status"):
+        subscription.active = obj["status"] in ACTIVE_STATUSES
+    subscription.synced_at = datetime.utcnow()
+    return account_state(user, subscription)
 
-                subscription.active = True
-                sess.commit()
 
-                return updated_subscription
-            except Exception as e:
-                print(f"Stripe API Error: {e}")
-                raise
+def set_auto_renewal(user, pause, sess=None):
+    # One Stripe modify; its answer is the new state, so nothing is re-read
+    with session_scope(sess) as sess:
+        subscription = subscription_of(user, sess)
+        if not subscription or auto_renewal_paused(subscription) == pause:
+            return None
+        if not auto_renewal_toggleable(subscription):
+            raise SubscriptionStateError("Subscription is neither active nor paused")
+        if object_session(subscription) is not sess:
+            # The user was loaded by another session; write through this one
+            subscription = sess.merge(subscription)
+        subscription_id = local_subscription_id(user, subscription)
+        updated = stripe_gateway.write(stripe.Subscription.modify, subscription_id, **pause_collection_params(pause))
+        record_auto_renewal(user, subscription, updated)
+        forget_account_on_commit(sess, user.email)
+        return updated
+
+
+def pause_auto_renewal(user, sess=None):
+    return set_auto_renewal(user, True, sess)
+
+
+def resume_auto_renewal(user, sess=None):
+    return set_auto_renewal(user, False, sess)
 
 
 def get_subscription_id_from_email(email):
     try:
-        # Step 1: Retrieve the customer object using the email
-        customers = stripe.Customer.list(email=email)
+        # Step 1: Resolve the customer using the email
+        customer = resolve_customer(email)
 
-        if not customers.data:
+        if not customer:
             raise Exception(f"No customer found with email: {email}")
 
-        customer = customers.data[
-            0
-        ]  # Assuming the email is unique and we take the first match
+        if customer.get("subscription_id"):
+            return customer["subscription_id"]
 
         # Step 2: Retrieve the subscriptions for the customer
-        subscriptions = stripe.Subscription.list(customer=customer.id)
+        subscriptions = stripe_gateway.read(stripe.Subscription.list, customer=customer["customer_id"], limit=1)
 
         if not subscriptions.data:
             raise Exception(f"No subscriptions found for customer with email: {email}")
@@ -302,68 +909,68 @@ def get_subscription_id_from_email(email):
             0
         ]  # Assuming there's at least one subscription and we take the first match
 
+        remember_customer(email, subscription_id=subscription.id)
         return subscription.id
 
     except stripe.error.StripeError as e:
         # Handle Stripe API errors
-        print(f"Stripe error: {e}")
+        logger.error("Stripe error: %s", e)
         raise
     except Exception as e:
         # Handle other errors
-        print(f"Error: {e}")
+        logger.error("Error: %s", e)
         raise
 
 
 def delete_user_and_associated_records(sess, user_id):
     try:
         # Delete the user and assoiciated tables
-        sess.query(User).filter(User.id == user_id).delete()
+        sess.query(Subscription).filter(Subscription.user_id == user_id).delete(synchronize_session=False)
+        sess.query(User).filter(User.id == user_id).delete(synchronize_session=False)
     except Exception as e:
-        print("Error deleting user and associated records:", e)
+        logger.error("Error deleting user and associated records: %s", e)
         raise
 
 
-def cancel_subscription(user, token):
-    with session_scope() as sess:
-        subscription = (
-            sess.query(Subscription)
-            .filter(Subscription.user_id == user.id)
-            .one_or_none()
-        )
+def cancel_subscription(user, token, sess=None):
+    with session_scope(sess) as sess:
+        subscription = subscription_of(user, sess)
 
+        if subscription and subscription.stripe_customer_id:
+            coordination.lock_customer(sess, subscription.stripe_customer_id)
+            if not sess.query(sess.query(Subscription).filter(Subscription.id == subscription.id).exists()).scalar():
+                # Cancelled by a concurrent request, e.g. a double click landing on another node
+                return
         if subscription:
             try:
-                # Retrieve the subscription ID using the email
-                subscription_id = get_subscription_id_from_email(user.email)
+                subscription_id = local_subscription_id(user, subscription)
 
                 # Cancel the subscription
-                stripe.Subscription.delete(subscription_id)
+                stripe_gateway.call(stripe.Subscription.delete, subscription_id)
 
                 # Update the local subscription record
                 subscription.active = False
                 sess.add(subscription)
-                reject_token(token)
+                reject_token(token, sess)
+                forget_account_on_commit(sess, user.email)
                 # Delete user and associated records
                 delete_user_and_associated_records(sess, user.id)
             except stripe.error.InvalidRequestError as e:
-                print("Stripe error:", e)
+                logger.error("Stripe error: %s", e)
                 raise Exception("Error unsubscribing: {}".format(e))
 
 
 def get_payment_method_id_by_email(email):
     try:
-        # Retrieve the customer object using the email
-        customers = stripe.Customer.list(email=email)
+        # Resolve the customer using the email
+        customer = resolve_customer(email)
 
-        if not customers.data:
+        if not customer:
             raise Exception(f"No customer found with email: {email}")
 
-        customer = customers.data[
-            0
-        ]  # Assuming the email is unique and we take the first match
-
-        # Retrieve the payment methods for the customer
-        payment_methods = stripe.PaymentMethod.list(customer=customer.id, type="card")
+        # Retrieve the payment methods for the customer. Not cached: cards are attached and
+        # detached in Stripe without a customer.* event, so a cached choice could go stale
+        payment_methods = stripe_gateway.read(stripe.PaymentMethod.list, customer=customer["customer_id"], type="card", limit=1)
 
         if not payment_methods.data:
             raise Exception(
@@ -372,24 +979,72 @@ def get_payment_method_id_by_email(email):
 
         # Select the first payment method (or implement your own logic to choose)
         payment_method = payment_methods.data[0]
-
         return payment_method.id
 
     except stripe.error.StripeError as e:
-        print(f"Stripe error: {e}")
+        logger.error("Stripe error: %s", e)
         raise
     except Exception as e:
-        print(f"Error retrieving payment method ID: {e}")
+        logger.error("Error retrieving payment method ID: %s", e)
         raise
 
 
-def handle_payment_failed(invoice, user_email):
+DUNNING_RETRY_DELAYS = [timedelta(hours=float(hours)) for hours in conf.DUNNING_RETRY_HOURS.split(",") if hours.strip()]
+DUNNING_GRACE = timedelta(hours=conf.DUNNING_GRACE_HOURS)
+
+
+def dunning_due(entry):
+    # The next retry counted from the first failure, then the end of the grace period
+    if entry.attempts < len(DUNNING_RETRY_DELAYS):
+        return min(entry.failed_at + DUNNING_RETRY_DELAYS[entry.attempts], entry.grace_ends_at)
+    return entry.grace_ends_at
+
+
+def handle_payment_failed(invoice, sess=None):
+    """
+    Puts the invoice's subscription on the dunning schedule.
+
+    Access is kept through the grace period; dunning.run_due retries the
+    payment at the configured times and revokes access if the grace period
+    ends unpaid. Failures of a subscription already on the schedule, such
+    as those of the retries themselves, only record the latest invoice.
+    """
     customer_id = invoice['customer']
-    subscription_id = invoice['subscription']
-    with session_scope() as sess:
-        subscription = sess.query(Subscription).filter(Subscription.stripe_customer_id == customer_id).one_or_none()
-        if subscription:
-            user = sess.query(User).filter_by(email=user_email).first()
-            subscription.active = False
-            user.access = False
-            sess.commit()
+    with session_scope(sess) as sess:
+        coordination.lock_customer(sess, customer_id)
+        subscription = _find_by_customer(sess, customer_id)
+        if not subscription:
+            return
+        entry = sess.get(DunningEntry, subscription.id)
+        if entry:
+            entry.invoice_id = invoice['id']
+            return
+        now = datetime.utcnow()
+        entry = DunningEntry(
+            subscription_id=subscription.id,
+            stripe_customer_id=customer_id,
+            invoice_id=invoice['id'],
+            attempts=0,
+            failed_at=now,
+            grace_ends_at=now + DUNNING_GRACE,
+        )
+        entry.due_at = dunning_due(entry)
+        sess.add(entry)
+
+
+def settle_dunning(invoice, sess=None):
+    # A paid invoice ends dunning and gives back access revoked meanwhile
+    if not invoice.get("customer"):
+        return
+    with session_scope(sess) as sess:
+        coordination.lock_customer(sess, invoice["customer"])
+        subscription = _find_by_customer(sess, invoice["customer"])
+        entry = subscription and sess.get(DunningEntry, subscription.id)
+        if not entry:
+            return
+        if entry.revoked_at:
+            user = sess.get(User, subscription.user_id)
+            subscription.active = True
+            user.access = True
+            forget_account_on_commit(sess, user.email)
+        sess.delete(entry)
@@ -0,0 +1,126 @@
+import time
+import uuid
+import random
+import threading
+
+from backend.config import Config
+from backend.db import instrumentation
+from backend.utils.lazy import lazy_import
+
+conf = Config()
+
+
+def _configure(module):
+    module.api_key = conf.STRIPE_SECRET_KEY
+    module.api_base = conf.STRIPE_API_BASE
+
+
+# The SDK is imported on first use and configured here, once, for every module using it
+stripe = lazy_import("stripe", on_load=_configure)
+
+# Every synchronous Stripe SDK call goes through read, write or call below; the
+# async client in stripe_client applies the same policies to its requests.
+
+_semaphore = threading.BoundedSemaphore(conf.STRIPE_MAX_IN_FLIGHT)
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def is_retryable(error):
+    status = getattr(error, "http_status", None)
+    if isinstance(error, (stripe.error.RateLimitError, stripe.error.APIConnectionError)):
+        return True
+    return status is not None and (status == 429 or status >= 500)
+
+
+def backoff_delay(attempt, error=None):
+    # Full jitter: a random delay up to the capped exponential backoff
+    headers = getattr(error, "headers", None) or {}
+    retry_after = headers.get("Retry-After") or headers.get("retry-after")
+    if retry_after:
+        try:
+            return min(float(retry_after), conf.STRIPE_RETRY_MAX_DELAY)
+        except ValueError:
+            pass
+    cap = min(conf.STRIPE_RETRY_MAX_DELAY, conf.STRIPE_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+def request_key(fn, args, kwargs):
+    # Identifies identical reads, e.g. (stripe.Customer, "list", ..., email=...)
+    owner = getattr(fn, "__self__", None)
+    return (owner, getattr(fn, "__name__", repr(fn)), repr(args), repr(sorted(kwargs.items())))
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _single_flight(key, fn):
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+    if not leader:
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    try:
+        flight.result = fn()
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def operation_name(fn):
+    # e.g. "Customer.list", the label the call is exported under in /metrics
+    owner = getattr(fn, "__self__", None)
+    name = getattr(fn, "__name__", repr(fn))
+    return f"{owner.__name__}.{name}" if isinstance(owner, type) else name
+
+
+def _timed(fn, args, kwargs):
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        return fn(*args, **kwargs)
+    except stripe.error.StripeError as e:
+        status = getattr(e, "http_status", None) or type(e).__name__
+        raise
+    finally:
+        instrumentation.observe_stripe(operation_name(fn), status, time.perf_counter() - start)
+
+
+def call(fn, *args, **kwargs):
+    # Runs fn within the in-flight limit, retrying 429, 5xx and connection errors
+    attempt = 0
+    while True:
+        try:
+            with _semaphore:
+                return _timed(fn, args, kwargs)
+        except stripe.error.StripeError as e:
+            if attempt >= conf.STRIPE_MAX_RETRIES or not is_retryable(e):
+                raise
+            delay = backoff_delay(attempt, e)
+        time.sleep(delay)
+        attempt += 1
+
+
+def read(fn, *args, **kwargs):
+    # Identical concurrent reads share one request
+    return _single_flight(request_key(fn, args, kwargs), lambda: call(fn, *args, **kwargs))
+
+
+def write(fn, *args, idempotency_key=None, **kwargs):
+    # One idempotency key across retries so a retried create or modify is applied once
+    return call(fn, *args, idempotency_key=idempotency_key or str(uuid.uuid4()), **kwargs)
@@ -0,0 +1,195 @@
+import json
+import random
+import asyncio
+import logging
+from datetime import datetime
+
+from anyio import to_thread
+from sqlalchemy.dialects.postgresql import insert
+
+from backend.config import Config
+from backend.db import coordination, stripe_db
+from backend.db.models import WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+conf = Config()
+
+_handlers = {}
+_wakeup = None
+
+# Pending events read per event claimed, so workers on other nodes find customers of their own
+CLAIM_WINDOW = 8
+
+
+def handler(*event_types):
+    # Registers fn for exact event types or wildcard prefixes such as "customer.*"
+    def register(fn):
+        for event_type in event_types:
+            _handlers.setdefault(event_type, []).append(fn)
+        return fn
+    return register
+
+
+def handlers_for(event_type):
+    found = list(_handlers.get(event_type, ()))
+    prefix = event_type
+    while "." in prefix:
+        prefix = prefix.rsplit(".", 1)[0]
+        found.extend(_handlers.get(f"{prefix}.*", ()))
+    return found
+
+
+def enqueue(event_id, event_type, payload, customer_id=None, sess=None):
+    # Stripe retries deliver the same event ID; those inserts are dropped
+    with stripe_db.session_scope(sess) as sess:
+        result = sess.execute(
+            insert(WebhookEvent)
+            .values(id=event_id, type=event_type, payload=payload, attempts=0, customer_id=customer_id)
+            .on_conflict_do_nothing(index_elements=["id"])
+        )
+        return result.rowcount == 1
+
+
+def notify():
+    if _wakeup is not None:
+        _wakeup.set()
+
+
+def dispatch(event, sess):
+    for fn in handlers_for(event["type"]):
+        fn(event["data"]["object"], sess)
+
+
+def _pending():
+    return (
+        WebhookEvent.processed_at == None,
+        WebhookEvent.attempts < conf.WEBHOOK_MAX_ATTEMPTS,
+    )
+
+
+def claim(sess, batch_size):
+    """
+    Claims up to batch_size pending events for sess's transaction.
+
+    The oldest pending events are read without locks, and the customers of
+    about batch_size of them, starting at a random one so concurrent workers
+    spread out, are locked with try-locks. The events of the customers
+    locked, plus events without a customer, are then claimed with FOR UPDATE
+    SKIP LOCKED. Workers on every node therefore process different
+    customers in parallel, each customer's events in order on one node, and
+    never wait on each other.
+    """
+    candidates = (
+        sess.query(WebhookEvent.id, WebhookEvent.customer_id)
+        .filter(*_pending())
+        .order_by(WebhookEvent.received_at)
+        .limit(batch_size * CLAIM_WINDOW)
+        .all()
+    )
+    counts = {}
+    for _, customer in candidates:
+        if customer:
+            counts[customer] = counts.get(customer, 0) + 1
+    customers = list(counts)
+    if customers:
+        offset = random.randrange(len(customers))
+        customers = customers[offset:] + customers[:offset]
+    wanted, covered = [], 0
+    for customer in customers:
+        if covered >= batch_size:
+            break
+        wanted.append(customer)
+        covered += counts[customer]
+    locked = coordination.try_lock_customers(sess, wanted)
+    ids = [event_id for event_id, customer in candidates if customer is None or customer in locked][:batch_size]
+    if not ids:
+        return []
+    return (
+        sess.query(WebhookEvent)
+        .filter(WebhookEvent.id.in_(ids), *_pending())
+        .order_by(WebhookEvent.received_at)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+
+
+def drain(batch_size, sess=None):
+    with stripe_db.session_scope(sess) as sess:
+        events = claim(sess, batch_size)
+        for row in events:
+            try:
+                # A savepoint per event so one bad event does not roll back the batch
+                with sess.begin_nested():
+                    dispatch(json.loads(row.payload), sess)
+                row.processed_at = datetime.utcnow()
+            except Exception as e:
+                logger.error("Error processing webhook event %s: %s", row.id, e)
+                row.attempts += 1
+                row.last_error = str(e)[:1024]
+        return len(events)
+
+
+async def run_worker():
+    global _wakeup
+    _wakeup = asyncio.Event()
+    while True:
+        try:
+            processed = await to_thread.run_sync(drain, conf.WEBHOOK_BATCH_SIZE)
+        except Exception:
+            logger.exception("Webhook worker error")
+            processed = 0
+        if processed < conf.WEBHOOK_BATCH_SIZE:
+            _wakeup.clear()
+            try:
+                await asyncio.wait_for(_wakeup.wait(), conf.WEBHOOK_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+
+@handler("checkout.session.completed")
+def handle_checkout_completed(session, sess):
+    stripe_db.forget_checkout_session(session)
+    stripe_db.create_subscription(
+        session["customer_email"],
+        session["metadata"].get("price_id"),
+        session["id"],
+        session["customer"],
+        sess=sess,
+    )
+
+
+@handler("checkout.session.expired")
+def handle_checkout_expired(session, sess):
+    stripe_db.forget_checkout_session(session)
+
+
+@handler("customer.*")
+def handle_customer_event(obj, sess):
+    stripe_db.refresh_customer(obj, sess)
+
+
+@handler("product.*", "price.*")
+def handle_catalog_event(obj, sess):
+    stripe_db.invalidate_catalog()
+
+
+@handler("customer.subscription.*")
+def handle_subscription_event(subscription, sess):
+    stripe_db.project_subscription(subscription, sess)
+
+
+@handler("payment_method.attached", "payment_method.updated", "payment_method.automatically_updated")
+def handle_payment_method_event(payment_method, sess):
+    stripe_db.project_payment_method(payment_method, sess)
+
+
+@handler("invoice.paid", "invoice.payment_succeeded")
+def handle_invoice_paid(invoice, sess):
+    stripe_db.project_invoice(invoice, sess)
+    stripe_db.settle_dunning(invoice, sess)
+
+
+@handler("invoice.payment_failed")
+def handle_invoice_payment_failed(invoice, sess):
+    stripe_db.handle_payment_failed(invoice, sess)
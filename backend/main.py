@@ -1,11 +1,122 @@
-import jwt
-import stripe
-from jwt.exceptions import DecodeError
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+from backend.config import Config
+from backend.db import (
+    async_stripe_db, bulk, cache_invalidation, coordination, dunning, export, instrumentation, revocation,
+    stripe_db, webhooks,
+)
+from backend.db.stripe_client import close_client
+from backend.utils import lazy
+from backend.utils.cache import Cache, set_publisher
+from backend.utils.log import configure_logging
+from backend.utils.metrics import registry
+
+# Imported on first use to keep cold starts short; the stripe SDK is configured by stripe_gateway
+jwt = lazy.lazy_import("jwt")
+stripe = lazy.lazy_import("stripe")
+
+config = Config()
+configure_logging(config.LOG_LEVEL, config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+security = HTTPBearer()
+# Verified token claims keyed by token digest, each kept until the token's exp
+verified_tokens = Cache("tokens", maxsize=config.JWT_CACHE_SIZE, ttl=config.JWT_CACHE_TTL)
+
+
+async def reconcile_periodically():
+    while True:
+        await asyncio.sleep(config.RECONCILE_INTERVAL_SECONDS)
+        try:
+            await run_in_threadpool(stripe_db.reconcile_subscriptions, config.RECONCILE_BATCH_SIZE)
+        except Exception:
+            logger.exception("Reconciliation error")
+
+
+async def purge_rejected_tokens_periodically():
+    while True:
+        try:
+            await run_in_threadpool(
+                stripe_db.purge_expired_rejected_tokens, config.REVOCATION_PURGE_BATCH_SIZE
+            )
+        except Exception:
+            logger.exception("Rejected token purge error")
+        await asyncio.sleep(config.REVOCATION_PURGE_SECONDS)
+
+
+async def run_dunning_periodically():
+    while True:
+        try:
+            await run_in_threadpool(dunning.run_due, config.DUNNING_BATCH_SIZE, config.DUNNING_CONCURRENCY)
+        except Exception:
+            logger.exception("Dunning error")
+        await asyncio.sleep(config.DUNNING_INTERVAL_SECONDS)
+
+
+# Everything here also happens lazily on first use; warming moves that cost off the first requests
+WARM_UP_HOOKS = {
+    "database": lambda: run_in_threadpool(stripe_db.warm_pool),
+    "revocations": lambda: run_in_threadpool(stripe_db.warm_revocation_cache),
+    # Checkout resolves every cart, the STRIPE_PRODUCT default included, from the price index
+    "catalog": lambda: async_stripe_db.get_price_index(refresh=True),
+    "stripe": lambda: run_in_threadpool(lazy.load, stripe),
+    "jwt": lambda: run_in_threadpool(lazy.load, jwt),
+}
+
+
+async def warm_up(names):
+    for name in names:
+        start = time.perf_counter()
+        try:
+            await WARM_UP_HOOKS[name]()
+        except Exception:
+            # A cold cache is not fatal: the first request that needs it loads it
+            logger.exception("Warm-up %s failed", name)
+        else:
+            logger.info("Warmed up %s in %.0f ms", name, (time.perf_counter() - start) * 1000)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    hooks = [name.strip() for name in config.WARM_UP.split(",") if name.strip()]
+    unknown = [name for name in hooks if name not in WARM_UP_HOOKS]
+    if unknown:
+        raise ValueError(f"Unknown WARM_UP hooks: {', '.join(unknown)}")
+    tasks = [
+        asyncio.create_task(webhooks.run_worker()),
+        asyncio.create_task(reconcile_periodically()),
+        asyncio.create_task(purge_rejected_tokens_periodically()),
+        asyncio.create_task(run_dunning_periodically()),
+    ]
+    if config.CACHE_INVALIDATION:
+        # Invalidations and token revocations made here reach the other workers, and theirs reach this one
+        set_publisher(cache_invalidation.publish)
+        revocation.set_publisher(cache_invalidation.publish_revocation)
+        tasks.append(asyncio.create_task(cache_invalidation.listen()))
+    # In the background by default, so the worker takes traffic at once
+    if config.WARM_UP_BLOCKING:
+        await warm_up(hooks)
+    else:
+        tasks.append(asyncio.create_task(warm_up(hooks)))
+    try:
+        yield
+    finally:
+        set_publisher(None)
+        revocation.set_publisher(None)
+        for task in tasks:
+            task.cancel()
+        await close_client()
+        stripe_db.dispose_engines()
 
-from config import Config
-from db import stripe_db
 
 app = FastAPI(
     title="Stripe Payment API",
@@ -18,112 +129,234 @@ app = FastAPI(
     license_info={
         "name": "MIT",
         "url": "https://opensource.org/licenses/MIT",
-    }
+    },
+    lifespan=lifespan,
 )
 
-config = Config()
-stripe.api_key = config.STRIPE_SECRET_KEY
-security = HTTPBearer()
+
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    # Counts the queries and Stripe calls made by the request; see instrumentation
+    stats, token = instrumentation.start_request()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["Server-Timing"] = stats.server_timing()
+        return response
+    finally:
+        instrumentation.end_request(token)
+        route = request.scope.get("route")
+        instrumentation.observe_request(request.method, route.path if route else "unmatched", status, stats)
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 
 @app.get("/")
 def read_root():
     return {"message": "Hello, Welcome to Stripe Integration!"}
 
 
+def stripe_busy():
+    # Stripe kept rate limiting after the gateway's retries; ask the client to retry
+    return HTTPException(
+        status_code=503,
+        detail="Payment provider is busy, please retry shortly",
+        headers={"Retry-After": "2"},
+    )
+
+
+def get_db():
+    # One session per request: a single connection checkout and a single commit
+    with stripe_db.session_scope() as sess:
+        yield sess
+
+
 def jwt_auth(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        token = credentials.credentials
-        user_identity = jwt.decode(token, config.JWT_SECRET, algorithms=["HS256"])
-        if stripe_db.is_rejected(token):
-            raise HTTPException(status_code=403, detail="Token is rejected")
-        return user_identity
-    except DecodeError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+    token = credentials.credentials
+    digest = revocation.token_digest(token)
+    claims = verified_tokens.get(digest)
+    if claims is None:
+        try:
+            claims = jwt.decode(token, config.JWT_SECRET, algorithms=["HS256"])
+        except jwt.InvalidTokenError:
+            # Also expired and not-yet-valid tokens, which are not DecodeErrors
+            raise HTTPException(status_code=401, detail="Invalid token")
+        # Never past the token's exp, so an expired token is decoded again and refused
+        ttl = config.JWT_CACHE_TTL
+        if "exp" in claims:
+            ttl = min(ttl, claims["exp"] - time.time())
+        verified_tokens.set(digest, claims, ttl=ttl)
+    # The raw token is kept with the claims so /unsubscribe can reject it, but never stored in a shared cache
+    user_identity = dict(claims, token=token)
+    if stripe_db.is_rejected(token, digest):
+        raise HTTPException(status_code=403, detail="Token is rejected")
+    return user_identity
+
+
+def current_user(user_identity: dict = Depends(jwt_auth), sess=Depends(get_db)):
+    # FastAPI resolves a dependency once per request, so the user is loaded at most once
+    user = stripe_db.load_user(user_identity.get("user-email"), sess)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    return user
+
+
+class CartItem(BaseModel):
+    price_id: Optional[str] = None
+    product: Optional[str] = None  # A product name, standing for its default price
+    quantity: int = Field(1, ge=1, le=999)
+
+
+class CheckoutRequest(BaseModel):
+    items: List[CartItem] = Field(default_factory=list, max_length=100)
+
+
+def require_admin(user_identity: dict = Depends(jwt_auth)):
+    if user_identity.get("role_name") != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return user_identity
+
+
+class BulkRequest(BaseModel):
+    emails: List[str] = Field(min_length=1)
 
 
 @app.post("/create-checkout-session")
-async def create_checkout_session(user_identity: dict = Depends(jwt_auth)):
+async def create_checkout_session(cart: Optional[CheckoutRequest] = None, user_identity: dict = Depends(jwt_auth)):
     user_email = user_identity.get("user-email")
     user_name = user_identity.get("user-name")
-    products = stripe.Product.list()
+    # Without a cart, checkout is for the configured product, as before
+    items = [(item.price_id, item.product, item.quantity) for item in cart.items] if cart and cart.items else [
+        (None, config.STRIPE_PRODUCT, 1)
+    ]
 
-    stripe_customer_id = stripe_db.create_or_retrieve_stripe_customer(user_email, user_name)
+    try:
+        stripe_customer_id = await async_stripe_db.create_or_retrieve_stripe_customer(user_email, user_name)
+        line_items, entries, missing = await async_stripe_db.resolve_cart(items)
+    except stripe.error.RateLimitError:
+        raise stripe_busy()
     if not stripe_customer_id:
         raise HTTPException(status_code=500, detail="Error creating or retrieving customer")
 
-    latest_product = next((p for p in products['data'] if p['name'] == config.STRIPE_PRODUCT), None)
-    if not latest_product:
-        raise HTTPException(status_code=400, detail="No product available!")
-
-    price_id = latest_product.get("default_price")
-    line_items = [{"price": price_id, "quantity": 1}]
-
-    payment_mode = 'payment'
-    for item in line_items:
-        price_data = stripe.Price.retrieve(item['price'])
-        if price_data.recurring:
-            payment_mode = 'subscription'
-            break
+    if missing:
+        raise HTTPException(status_code=400, detail=f"No product available: {', '.join(map(str, missing))}")
+    if len({entry["currency"] for entry in entries}) > 1:
+        raise HTTPException(status_code=400, detail="Cart items must share one currency")
 
     try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
+        session = await async_stripe_db.get_or_create_checkout_session(
+            token_sub=user_identity.get("sub"),
+            customer_email=user_email,
             line_items=line_items,
-            mode=payment_mode,
+            entries=entries,
             success_url=f'{config.FE_BASE_URL}/success/{{CHECKOUT_SESSION_ID}}',
             cancel_url=f'{config.FE_BASE_URL}/cancel',
-            customer_email=user_email,
-            metadata={}
         )
-        return {"id": session.id}
+        return {"id": session["id"]}
+    except stripe.error.RateLimitError:
+        raise stripe_busy()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error creating session: {str(e)}")
 
 
 @app.post("/unsubscribe")
-async def unsubscribe(user_identity: dict = Depends(jwt_auth)):
-    user_email = user_identity.get("user-email")
-    user = stripe_db.find_user_by_email(user_email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def unsubscribe(user_identity: dict = Depends(jwt_auth), user=Depends(current_user), sess=Depends(get_db)):
     try:
-        stripe_db.cancel_subscription(user, user_identity.get("token"))
+        await async_stripe_db.cancel_subscription(user, user_identity.get("token"), sess)
         return {"status": "unsubscribed and user deleted"}
+    except stripe.error.RateLimitError:
+        raise stripe_busy()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error unsubscribing: {str(e)}")
 
 
 @app.post("/update-payment-method")
-async def update_payment_method(user_identity: dict = Depends(jwt_auth)):
-    user_email = user_identity.get("user-email")
-    user = stripe_db.find_user_by_email(user_email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def update_payment_method(user=Depends(current_user), sess=Depends(get_db)):
     try:
-        payment_method_id = stripe_db.get_payment_method_id_by_email(user_email)
-        stripe_db.update_payment_method(user, payment_method_id)
+        payment_method_id = await async_stripe_db.get_payment_method_id_by_email(user.email)
+        await async_stripe_db.update_payment_method(user, payment_method_id, sess)
         return {"status": "payment method updated"}
+    except stripe.error.RateLimitError:
+        raise stripe_busy()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating payment method: {str(e)}")
 
 
 @app.get("/payment-details")
-async def payment_details(user_identity: dict = Depends(jwt_auth)):
-    user_email = user_identity.get("user-email")
-    user = stripe_db.find_user_by_email(user_email)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def payment_details(user=Depends(current_user), sess=Depends(get_db)):
     try:
-        payment_info = stripe_db.get_payment_details(user)
+        payment_info = await async_stripe_db.get_payment_details(user, sess)
         required_fields = ['last4', 'next_renewal_date']
         missing_fields = [field for field in required_fields if not payment_info.get(field)]
         if missing_fields:
             raise HTTPException(status_code=400, detail=f"Missing payment details: {', '.join(missing_fields)}")
         return payment_info
+    except stripe.error.RateLimitError:
+        raise stripe_busy()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving payment details: {str(e)}")
 
 
+@app.post("/toggle-auto-renewal")
+async def toggle_auto_renewal(user=Depends(current_user), sess=Depends(get_db)):
+    try:
+        paused = await async_stripe_db.toggle_auto_renewal(user, sess)
+    except stripe_db.SubscriptionStateError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except stripe.error.RateLimitError:
+        raise stripe_busy()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error toggling auto-renewal: {str(e)}")
+    if paused is None:
+        raise HTTPException(status_code=404, detail="Subscription not found")
+    return {"status": "paused" if paused else "resumed", "auto_renewal": not paused}
+
+
+@app.post("/renewtoken")
+async def renew_token(user_identity: dict = Depends(jwt_auth)):
+    # Served from the account cache; only a miss reads the user and subscription
+    account = await async_stripe_db.load_account(user_identity.get("user-email"))
+    if not account:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"token": stripe_db.generate_token(account)}
+
+
+@app.post("/admin/subscriptions/{action}")
+async def bulk_subscriptions(action: str, request: BulkRequest, admin: dict = Depends(require_admin)):
+    # Larger runs belong in the resumable CLI: python -m backend.db.bulk
+    if action not in bulk.ACTIONS:
+        raise HTTPException(status_code=404, detail=f"Unknown action: {action}")
+    if len(request.emails) > config.BULK_API_MAX_USERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {config.BULK_API_MAX_USERS} users per request; use the bulk CLI for more",
+        )
+    result = await run_in_threadpool(bulk.run_bulk, action, request.emails)
+    return {
+        "action": action,
+        "done": result["done"],
+        "skipped": result["skipped"],
+        "failures": result["failures"],
+    }
+
+
+@app.get("/admin/export/subscriptions")
+def export_subscriptions(format: str = "ndjson", admin: dict = Depends(require_admin)):
+    # A sync generator: Starlette pulls each page in the threadpool, so the event loop never waits on the DB
+    if format not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format: {format}")
+    filename = f"subscriptions-{time.strftime('%Y-%m-%d')}.{'csv' if format == 'csv' else 'ndjson'}"
+    return StreamingResponse(
+        export.export(format),
+        media_type=export.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 @app.post("/webhook")
 async def stripe_webhook(request: Request):
     payload = await request.body()
@@ -136,13 +369,13 @@ async def stripe_webhook(request: Request):
     except stripe.error.SignatureVerificationError:
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    if event['type'] == 'checkout.session.completed':
-        session = event['data']['object']
-        user_email = session['customer_email']
-        stripe_db.create_subscription(user_email, session['id'], session['customer'])
-        return {"status": "success"}
-    elif event['type'] == 'invoice.payment_failed':
-        session = event['data']['object']
-        user_email = session['customer_email']
-        # Handle payment failure logic
+    # Acknowledge fast; the event is processed by the background webhook worker
+    await run_in_threadpool(
+        webhooks.enqueue,
+        event['id'],
+        event['type'],
+        payload.decode('utf-8'),
+        coordination.customer_of(event['data']['object']),
+    )
+    webhooks.notify()
     return {"status": "received"}
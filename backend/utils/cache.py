@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from collections import OrderedDict
+
+from backend.utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache whose entries expire after a fixed time-to-live.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        """
+        Initializes the cache.
+
+        Args:
+          maxsize (int): The maximum number of entries kept before the least
+            recently used entry is evicted.
+          ttl (float): The number of seconds an entry stays valid.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for key, or default if it is missing or has
+        expired.
+        """
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Stores value under key, evicting the least recently used entry if the
+        cache is full.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Removes key from the cache if present.
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """
+        Removes every entry from the cache.
+        """
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class MemoryBackend:
+    """
+    Keeps every namespace in a TTLCache of its own process. Each worker has
+    its own copy, so changes must be broadcast to the others.
+    """
+
+    scope = "process"
+
+    def namespace(self, name, maxsize, ttl):
+        return TTLCache(maxsize=maxsize, ttl=ttl)
+
+
+cache_requests = registry.counter(
+    "cache_requests_total", "Cache lookups by namespace and result", ("namespace", "result")
+)
+cache_invalidations = registry.counter(
+    "cache_invalidations_total",
+    "Cache invalidations by namespace, made here (local) or received from another worker (remote)",
+    ("namespace", "source"),
+)
+cache_errors = registry.counter(
+    "cache_errors_total", "Cache backend failures, served as misses", ("namespace",)
+)
+
+_caches = {}
+_backend = None
+_backend_factory = MemoryBackend
+_backend_lock = threading.Lock()
+_publisher = None
+
+
+def _hit_ratios():
+    for name in sorted(_caches):
+        hits = cache_requests.value(name, "hit")
+        total = hits + cache_requests.value(name, "miss")
+        yield (name,), hits / total if total else 0.0
+
+
+registry.callback("cache_hit_ratio", "Share of cache lookups that hit since startup", ("namespace",), _hit_ratios)
+
+
+def configure(backend_factory):
+    """
+    Sets how the backend shared by every Cache is created. It is created on
+    first use, so configuring it opens no file or connection.
+
+    Args:
+      backend_factory (callable): Returns a backend: an object with a scope
+        ("process", "host" or "global") and a namespace(name, maxsize, ttl)
+        method returning a store with get, set, invalidate and clear.
+    """
+    global _backend, _backend_factory
+    with _backend_lock:
+        _backend_factory = backend_factory
+        _backend = None
+        for cache in _caches.values():
+            cache._store = None
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _backend_factory()
+    return _backend
+
+
+def set_publisher(publish):
+    """
+    Sets the function broadcasting invalidations to the other workers, called
+    with (namespace, key), where a None key stands for the whole namespace.
+    """
+    global _publisher
+    _publisher = publish
+
+
+def origin():
+    # Identifies this worker process and its host in broadcast invalidations
+    host = socket.gethostname()
+    return host, f"{host}:{os.getpid()}"
+
+
+def canonical_key(key):
+    # Keys are strings in every backend and in broadcasts; tuples and other JSON values are encoded
+    return key if isinstance(key, str) else json.dumps(key, separators=(",", ":"))
+
+
+def apply_invalidation(namespace, key, host, process):
+    """
+    Applies an invalidation broadcast by another worker to this one.
+
+    Stores this worker shares with the sender already reflect the change:
+    the process's own in-memory store, the host's shared memory, or a
+    network cache shared by every host.
+    """
+    cache = _caches.get(namespace)
+    if cache is None:
+        return
+    scope = cache.scope
+    this_host, this_process = origin()
+    if scope == "global" or (scope == "host" and host == this_host) or process == this_process:
+        return
+    cache_invalidations.inc(namespace, "remote")
+    cache.drop(key)
+
+
+def drop_all():
+    # After broadcasts may have been missed, e.g. while reconnecting to the channel
+    for cache in list(_caches.values()):
+        if cache.scope != "global":
+            cache.drop(None)
+
+
+class Cache:
+    """
+    A namespace of the configured cache backend.
+
+    It has the interface of TTLCache, counts hits and misses per namespace,
+    and broadcasts invalidations so other workers drop their copies. Backend
+    failures are logged and served as misses: the cache is never required
+    for a request to succeed.
+    """
+
+    def __init__(self, namespace, maxsize=1024, ttl=300, local=False):
+        """
+        Initializes the cache.
+
+        Args:
+          namespace (str): The name the cache is shared, broadcast and
+            reported under.
+          maxsize (int): The maximum number of entries, for backends that
+            bound each namespace.
+          ttl (float): The default number of seconds an entry stays valid.
+          local (bool): Keep the namespace in this process whatever the
+            configured backend, for a few large entries read often. Its
+            invalidations are still broadcast.
+        """
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.local = local
+        self._store = None
+        _caches[namespace] = self
+
+    @property
+    def scope(self):
+        return MemoryBackend.scope if self.local else backend().scope
+
+    @property
+    def store(self):
+        if self._store is None:
+            if self.local:
+                self._store = MemoryBackend().namespace(self.namespace, self.maxsize, self.ttl)
+            else:
+                self._store = backend().namespace(self.namespace, self.maxsize, self.ttl)
+        return self._store
+
+    def get(self, key, default=None):
+        try:
+            value = self.store.get(canonical_key(key), _MISSING)
+        except Exception as e:
+            cache_errors.inc(self.namespace)
+            logger.warning("Cache %s unavailable: %s", self.namespace, e)
+            value = _MISSING
+        if value is _MISSING:
+            cache_requests.inc(self.namespace, "miss")
+            return default
+        cache_requests.inc(self.namespace, "hit")
+        return value
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.store.set(canonical_key(key), value, ttl=self.ttl if ttl is None else ttl)
+        except Exception as e:
+            cache_errors.inc(self.namespace)
+            logger.warning("Cache %s unavailable: %s", self.namespace, e)
+
+    def invalidate(self, key):
+        """
+        Removes key here and from every other worker.
+        """
+        self._invalidate(canonical_key(key))
+
+    def clear(self):
+        """
+        Removes every entry of the namespace here and from every other worker.
+        """
+        self._invalidate(None)
+
+    def _invalidate(self, key):
+        cache_invalidations.inc(self.namespace, "local")
+        self.drop(key)
+        if _publisher is not None and self.scope != "global":
+            try:
+                _publisher(self.namespace, key)
+            except Exception:
+                logger.exception("Could not broadcast the invalidation of cache %s", self.namespace)
+
+    def drop(self, key):
+        # Removes key, or the whole namespace when None, from this worker's store only
+        try:
+            if key is None:
+                self.store.clear()
+            else:
+                self.store.invalidate(key)
+        except Exception as e:
+            cache_errors.inc(self.namespace)
+            logger.warning("Cache %s unavailable: %s", self.namespace, e)
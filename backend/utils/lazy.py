@@ -0,0 +1,76 @@
+import importlib
+import threading
+
+_lock = threading.RLock()
+_modules = {}
+
+
+class LazyModule:
+    """
+    Stands in for a module that is only imported on first attribute access.
+
+    Heavy SDKs such as stripe take most of the app's import time, while a
+    freshly started worker can serve requests that never touch them. Reads
+    and writes of attributes are forwarded to the real module once loaded.
+    """
+
+    def __init__(self, name):
+        """
+        Initializes the proxy.
+
+        Args:
+          name (str): The dotted name of the module to import.
+        """
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_module", None)
+        object.__setattr__(self, "_hooks", [])
+
+    def __getattr__(self, attr):
+        return getattr(load(self), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(load(self), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name, on_load=None):
+    """
+    Returns the shared proxy for a module, imported on first use.
+
+    Args:
+      name (str): The dotted name of the module.
+      on_load (callable): Called with the module right after it is imported,
+        e.g. to configure it; called at once if it is already loaded.
+
+    Returns:
+      A LazyModule.
+    """
+    with _lock:
+        module = _modules.get(name)
+        if module is None:
+            module = _modules[name] = LazyModule(name)
+        if on_load is not None:
+            if module._module is not None:
+                on_load(module._module)
+            else:
+                module._hooks.append(on_load)
+        return module
+
+
+def load(module):
+    # The lock is reentrant so on_load hooks may themselves use lazy modules
+    if module._module is None:
+        with _lock:
+            if module._module is None:
+                loaded = importlib.import_module(module._name)
+                for hook in module._hooks:
+                    hook(loaded)
+                object.__setattr__(module, "_module", loaded)
+    return module._module
+
+
+def is_loaded(module):
+    return module._module is not None
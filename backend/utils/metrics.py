@@ -0,0 +1,174 @@
+import bisect
+import threading
+
+# Default histogram buckets in seconds, from sub-millisecond queries to slow Stripe calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing count, optionally split by labels.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        """
+        Initializes the counter.
+
+        Args:
+          name (str): The metric name, e.g. "http_requests_total".
+          help (str): The description shown in the exposition.
+          labels (tuple): The label names; values are passed to inc in order.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield self.name, _label_text(self.labels, label_values), value
+
+
+class Histogram:
+    """
+    Observations counted into cumulative buckets, optionally split by labels.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Initializes the histogram.
+
+        Args:
+          name (str): The metric name, e.g. "db_query_duration_seconds".
+          help (str): The description shown in the exposition.
+          labels (tuple): The label names; values are passed to observe in order.
+          buckets (tuple): The ascending upper bounds of the buckets.
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _label_text(self.labels + ("le",), label_values + (_number(bound),))
+                yield f"{self.name}_bucket", labels, cumulative
+            labels = _label_text(self.labels + ("le",), label_values + ("+Inf",))
+            yield f"{self.name}_bucket", labels, values[-1]
+            labels = _label_text(self.labels, label_values)
+            yield f"{self.name}_sum", labels, values[-2]
+            yield f"{self.name}_count", labels, values[-1]
+
+
+class Callback:
+    """
+    Values read when the metrics are rendered, from a function returning
+    (label values, value) pairs; used to export state kept elsewhere.
+    """
+
+    def __init__(self, name, help, labels, collect, type="gauge"):
+        """
+        Initializes the metric.
+
+        Args:
+          name (str): The metric name.
+          help (str): The description shown in the exposition.
+          labels (tuple): The label names.
+          collect (callable): Returns the current (label values, value) pairs.
+          type (str): The exposed metric type, "gauge" or "counter".
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.type = type
+
+    def samples(self):
+        for label_values, value in self.collect():
+            yield self.name, _label_text(self.labels, label_values), value
+
+
+class Registry:
+    """
+    A set of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, labels, collect, type="gauge"):
+        return self.register(Callback(name, help, labels, collect, type))
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -1,14 +1,30 @@
 import uuid
-from sqlalchemy.types import TypeDecorator, CHAR
+from sqlalchemy.types import TypeDecorator, CHAR, BINARY
 from sqlalchemy.dialects.postgresql import UUID
 
 
 class GUID(TypeDecorator):
     """
     A class to handle platform-independent GUID type.
+
+    Uses the native UUID type on PostgreSQL. Elsewhere values are stored as
+    CHAR(32) hex strings, or as compact BINARY(16) when created with
+    ``GUID(binary=True)``.
     """
 
     impl = CHAR
+    cache_ok = True
+
+    def __init__(self, binary=False, *args, **kwargs):
+        """
+        Initializes the type.
+
+        Args:
+          binary (bool): Store values as BINARY(16) instead of CHAR(32) on
+            dialects without a native UUID type, such as MySQL and SQLite.
+        """
+        super().__init__(*args, **kwargs)
+        self.binary = binary
 
     def load_dialect_impl(self, dialect):
         """
@@ -20,55 +36,78 @@ class GUID(TypeDecorator):
         Returns:
           Returns the type descriptor for the given dialect. If the dialect is
           'postgresql', it returns a UUID type descriptor, otherwise it returns
-          a CHAR(32) type descriptor.
+          a BINARY(16) type descriptor if the type is binary, or a CHAR(32)
+          type descriptor.
         """
         if dialect.name == "postgresql":
             return dialect.type_descriptor(UUID())
+        elif self.binary:
+            return dialect.type_descriptor(BINARY(16))
         else:
             return dialect.type_descriptor(CHAR(32))
 
-    def process_bind_param(self, value, dialect):
+    def bind_processor(self, dialect):
         """
-        Process the bind parameter based on the value and dialect provided.
+        Returns the function that converts Python values to bind parameters.
+
+        The conversion is chosen once per dialect rather than on every value,
+        and uuid.UUID instances skip re-parsing.
 
         Args:
-          value: The value to be processed.
-          dialect: The dialect based on which the value is processed.
+          dialect (Dialect): The dialect the parameters are bound for.
 
         Returns:
-          Returns the processed value based on the conditions met. If value is
-          None, it returns None. If dialect is 'postgresql', it returns the
-          string representation of the value. If value is not an instance of
-          uuid.UUID, it returns a 32-character hexadecimal number. Otherwise,
-          it returns the hexadecimal representation of the value.
+          Returns a function that maps None to None and any other value to
+          its string form on 'postgresql', its 16 raw bytes if the type is
+          binary, or its 32-character hexadecimal form otherwise.
         """
+        uuid_type = uuid.UUID
 
-        if value is None:
-            return value
-        elif dialect.name == "postgresql":
-            return str(value)
+        if dialect.name == "postgresql":
+            def process(value):
+                if value is None:
+                    return value
+                return str(value)
+        elif self.binary:
+            def process(value):
+                if value is None:
+                    return value
+                if value.__class__ is not uuid_type:
+                    value = uuid_type(value)
+                return value.bytes
         else:
-            if not isinstance(value, uuid.UUID):
-                return "%.32x" % uuid.UUID(value)
-            else:
-                # hexstring
+            def process(value):
+                if value is None:
+                    return value
+                if value.__class__ is not uuid_type:
+                    value = uuid_type(value)
                 return value.hex
+        return process
 
-    def process_result_value(self, value, dialect):
+    def result_processor(self, dialect, coltype):
         """
-        Process the given value and return a UUID object if the value is not
-        None.
+        Returns the function that converts result values to uuid.UUID.
 
         Args:
-          value (Any): The value to be processed.
-          dialect (Any): The dialect to be used. This parameter is not used in
+          dialect (Dialect): The dialect the rows were loaded with.
+          coltype (Any): The DBAPI column type. This parameter is not used in
             the function.
 
         Returns:
-          Returns a UUID object if the value is not None, otherwise returns
-          None.
+          Returns a function that maps None to None and any other value to a
+          UUID object. Values the driver already returns as UUID objects are
+          passed through unchanged.
         """
-        if value is None:
-            return value
+        uuid_type = uuid.UUID
+
+        if self.binary and dialect.name != "postgresql":
+            def process(value):
+                if value is None or value.__class__ is uuid_type:
+                    return value
+                return uuid_type(bytes=bytes(value))
         else:
-            return uuid.UUID(value)
+            def process(value):
+                if value is None or value.__class__ is uuid_type:
+                    return value
+                return uuid_type(value)
+        return process
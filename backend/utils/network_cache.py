@@ -0,0 +1,159 @@
+import json
+import queue
+import socket
+from urllib.parse import urlsplit
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def _encode(*args):
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+class _Connection:
+    # One socket speaking RESP, the Redis protocol, with blocking reads bounded by the timeout
+    def __init__(self, host, port, db, timeout):
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+        if db:
+            self.command("SELECT", db)
+
+    def command(self, *args):
+        self.sock.sendall(_encode(*args))
+        return self._reply()
+
+    def _reply(self):
+        line = self.file.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the cache server")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body
+        if kind == b"-":
+            raise ProtocolError(body.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = self.file.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by the cache server")
+            return data[:-2]
+        if kind == b"*":
+            length = int(body)
+            return None if length < 0 else [self._reply() for _ in range(length)]
+        raise ProtocolError(f"Unexpected reply {line!r}")
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.sock.close()
+
+
+class NetworkBackend:
+    """
+    Keeps every namespace in a Redis-compatible server shared by all hosts.
+
+    Values are stored as JSON under "<prefix>:<namespace>:<key>" and expire
+    on the server. Connections are pooled and every command is bounded by a
+    short timeout; a connection that fails is discarded, and the error is
+    left to the Cache to serve as a miss.
+    """
+
+    scope = "global"
+
+    def __init__(self, url, timeout=0.05, prefix="stripe-api", max_idle=16):
+        """
+        Initializes the backend. No connection is opened until first use.
+
+        Args:
+          url (str): The server, e.g. redis://127.0.0.1:6379/0.
+          timeout (float): Seconds allowed for connecting and for each reply.
+          prefix (str): Prepended to every key, so several apps can share a
+            server.
+          max_idle (int): The number of idle connections kept for reuse.
+        """
+        parts = urlsplit(url)
+        self.host = parts.hostname or "127.0.0.1"
+        self.port = parts.port or 6379
+        self.db = int(parts.path.strip("/") or 0)
+        self.timeout = timeout
+        self.prefix = prefix
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def namespace(self, name, maxsize, ttl):
+        return NetworkNamespace(self, name)
+
+    def command(self, *args):
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = _Connection(self.host, self.port, self.db, self.timeout)
+        try:
+            reply = conn.command(*args)
+        except ProtocolError:
+            self._release(conn)
+            raise
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn)
+        return reply
+
+    def _release(self, conn):
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class NetworkNamespace:
+    """
+    One namespace of a NetworkBackend, with the interface of TTLCache.
+    """
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.prefix = f"{backend.prefix}:{name}:"
+
+    def get(self, key, default=None):
+        data = self.backend.command("GET", self.prefix + key)
+        return default if data is None else json.loads(data)
+
+    def set(self, key, value, ttl):
+        milliseconds = int(ttl * 1000)
+        if milliseconds <= 0:
+            return
+        self.backend.command("SET", self.prefix + key, json.dumps(value, separators=(",", ":")), "PX", milliseconds)
+
+    def invalidate(self, key):
+        self.backend.command("DEL", self.prefix + key)
+
+    def clear(self):
+        # SCAN rather than KEYS, so a large server is not blocked while the namespace is listed
+        pattern = self.prefix.replace("*", r"\*").replace("?", r"\?").replace("[", r"\[") + "*"
+        cursor = b"0"
+        while True:
+            cursor, keys = self.backend.command("SCAN", cursor, "MATCH", pattern, "COUNT", 500)
+            if keys:
+                self.backend.command("DEL", *keys)
+            if cursor == b"0":
+                return
@@ -0,0 +1,180 @@
+import os
+import mmap
+import json
+import time
+import fcntl
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+
+_MISSING = object()
+
+MAGIC = b"SCACHE01"
+GENERATIONS = 64  # Namespace generation counters in the header; clearing a namespace bumps its counter
+HEADER_SIZE = 4096
+PROBE = 4  # Consecutive slots a key may occupy
+# Slot header: key hash, expiry as a UNIX timestamp, payload length
+SLOT_HEADER = struct.Struct("<QdI")
+SLOT_HEADER_SIZE = 24
+
+
+def _hash(*parts):
+    digest = hashlib.blake2b("\0".join(parts).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") or 1  # 0 marks an empty slot
+
+
+class SharedMemoryBackend:
+    """
+    A fixed-size hash table in a memory-mapped file shared by every worker
+    process on the host, e.g. under /dev/shm.
+
+    The file is split into equal slots. A key hashes to a window of PROBE
+    consecutive slots and takes a matching, empty or expired slot there,
+    evicting the one closest to expiry when all are live. Processes lock the
+    window with fcntl byte-range locks and threads of one process with a
+    lock of their own, so an entry is never read half written. Values are
+    stored as JSON together with their key, which is checked on every read;
+    values larger than a slot are refused.
+    """
+
+    scope = "host"
+
+    def __init__(self, path, slots=8192, slot_size=8192):
+        """
+        Initializes the backend, creating the file if needed.
+
+        Args:
+          path (str): The file backing the table. Workers sharing it share
+            the cache; the file is sparse, so only written slots use memory.
+          slots (int): The number of slots.
+          slot_size (int): The size of a slot in bytes, header included; it
+            bounds the size of a value.
+        """
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self.size = HEADER_SIZE + slots * slot_size
+        self._lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX, HEADER_SIZE, 0)
+            try:
+                if os.fstat(fd).st_size != self.size or os.pread(fd, len(MAGIC), 0) != MAGIC:
+                    # A new file, or one laid out for another size: start empty
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self.size)
+                    os.pwrite(fd, MAGIC, 0)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, HEADER_SIZE, 0)
+            self._map = mmap.mmap(fd, self.size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+
+    def namespace(self, name, maxsize, ttl):
+        return SharedMemoryNamespace(self, name)
+
+    def _generation_offset(self, namespace):
+        return len(MAGIC) + 8 * (_hash(namespace) % GENERATIONS)
+
+    def generation(self, namespace):
+        return struct.unpack_from("<Q", self._map, self._generation_offset(namespace))[0]
+
+    def bump_generation(self, namespace):
+        offset = self._generation_offset(namespace)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 8, offset)
+            try:
+                generation = struct.unpack_from("<Q", self._map, offset)[0] + 1
+                struct.pack_into("<Q", self._map, offset, generation)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 8, offset)
+
+    def _window(self, key_hash):
+        first = key_hash % (self.slots - PROBE + 1)
+        return HEADER_SIZE + first * self.slot_size
+
+    @contextmanager
+    def _locked(self, start, exclusive):
+        with self._lock:
+            length = PROBE * self.slot_size
+            fcntl.lockf(self._fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, length, start)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, start)
+
+    def read(self, key_hash, key):
+        start = self._window(key_hash)
+        now = time.time()
+        with self._locked(start, exclusive=False):
+            for offset in range(start, start + PROBE * self.slot_size, self.slot_size):
+                slot_hash, expires_at, length = SLOT_HEADER.unpack_from(self._map, offset)
+                if slot_hash == key_hash and expires_at > now:
+                    payload = self._map[offset + SLOT_HEADER_SIZE:offset + SLOT_HEADER_SIZE + length]
+                    break
+            else:
+                return _MISSING
+        stored_key, value = json.loads(payload)
+        return value if stored_key == key else _MISSING
+
+    def write(self, key_hash, key, value, ttl):
+        payload = json.dumps([key, value], separators=(",", ":")).encode("utf-8")
+        if len(payload) > self.slot_size - SLOT_HEADER_SIZE:
+            # Counted and logged by the Cache; raise CACHE_SHM_SLOT_SIZE if this happens for good
+            raise ValueError(f"{len(payload)} byte entry exceeds the {self.slot_size} byte slot")
+        start = self._window(key_hash)
+        now = time.time()
+        with self._locked(start, exclusive=True):
+            target, target_expiry = None, float("inf")
+            for offset in range(start, start + PROBE * self.slot_size, self.slot_size):
+                slot_hash, expires_at, _ = SLOT_HEADER.unpack_from(self._map, offset)
+                if slot_hash == key_hash:
+                    target = offset
+                    break
+                # Empty and expired slots have the earliest expiry, so they are taken first
+                expiry = expires_at if slot_hash else 0
+                if expiry < target_expiry:
+                    target, target_expiry = offset, expiry
+            self._map[target + SLOT_HEADER_SIZE:target + SLOT_HEADER_SIZE + len(payload)] = payload
+            SLOT_HEADER.pack_into(self._map, target, key_hash, now + ttl, len(payload))
+
+    def erase(self, key_hash):
+        start = self._window(key_hash)
+        with self._locked(start, exclusive=True):
+            for offset in range(start, start + PROBE * self.slot_size, self.slot_size):
+                if SLOT_HEADER.unpack_from(self._map, offset)[0] == key_hash:
+                    SLOT_HEADER.pack_into(self._map, offset, 0, 0, 0)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class SharedMemoryNamespace:
+    """
+    One namespace of a SharedMemoryBackend, with the interface of TTLCache.
+    """
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def _hash(self, key):
+        # The generation is part of the hash, so entries from before a clear are never found
+        return _hash(self.name, str(self.backend.generation(self.name)), key)
+
+    def get(self, key, default=None):
+        value = self.backend.read(self._hash(key), key)
+        return default if value is _MISSING else value
+
+    def set(self, key, value, ttl):
+        self.backend.write(self._hash(key), key, value, ttl)
+
+    def invalidate(self, key):
+        self.backend.erase(self._hash(key))
+
+    def clear(self):
+        self.backend.bump_generation(self.name)